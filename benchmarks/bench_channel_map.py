@@ -0,0 +1,62 @@
+# Compares deriving records from wide PRecords with ChannelMap against copying the whole dict
+# Usage: python benchmarks/bench_channel_map.py [num_channels] [num_records]
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipex.pdatastructures import PRecord, PAtom, _infer_format_from_type
+
+
+def make_precord(num_channels):
+    channel_atoms = {
+        "channel_{}".format(i): PAtom(value=np.zeros(4), format='numpy.ndarray')
+        for i in range(num_channels)
+    }
+    return PRecord(id='id', channel_atoms=channel_atoms, active_channel='channel_0')
+
+
+def dict_copy_with_value(precord, value):
+    # What PRecord.with_value did before ChannelMap
+    channel_atoms = precord.channel_atoms.copy()
+    channel_atoms[precord.active_channel] = PAtom(
+        value=value,
+        format=_infer_format_from_type(precord.active_channel, value)
+    )
+    return PRecord(
+        id=precord.id,
+        timestamp=precord.timestamp,
+        active_channel=precord.active_channel,
+        channel_atoms=channel_atoms,
+    )
+
+
+def run(derive, precords, num_stages):
+    begin = time.perf_counter()
+    for precord in precords:
+        for i in range(num_stages):
+            precord = derive(precord, i)
+    return time.perf_counter() - begin
+
+
+def main():
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    num_records = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    num_stages = 10
+
+    wide = make_precord(num_channels)
+    # Plain dicts of atoms to measure the old behaviour
+    plain = [PRecord(id='id', channel_atoms=wide.channel_atoms.copy(), active_channel='channel_0')
+             for _ in range(num_records)]
+    plain_elapsed = run(dict_copy_with_value, plain, num_stages)
+    shared_elapsed = run(lambda precord, value: precord.with_value(value), [wide] * num_records, num_stages)
+
+    print("{} records x {} stages, {} channels".format(num_records, num_stages, num_channels))
+    print("  dict copy    : {:.3f}s".format(plain_elapsed))
+    print("  ChannelMap   : {:.3f}s ({:.1f}x)".format(shared_elapsed, plain_elapsed / shared_elapsed))
+
+
+if __name__ == '__main__':
+    main()
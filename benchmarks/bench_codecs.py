@@ -0,0 +1,86 @@
+# Reports encode/decode throughput and compression ratio of PBucket codecs on sample images and feature arrays
+# Usage: python benchmarks/bench_codecs.py [image_side] [repeat]
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipex.storages.pstorage.codecs import make_codec
+
+
+def make_image(side):
+    # Smooth gradients with some noise, closer to camera frames than pure noise
+    y, x = np.mgrid[0:side, 0:side]
+    noise = np.random.RandomState(0).randint(0, 16, (side, side, 3))
+    image = np.stack([x * 255 // side, y * 255 // side, (x + y) * 127 // side], axis=-1) + noise
+    return image.clip(0, 255).astype(np.uint8)
+
+
+def make_features(side):
+    return np.random.RandomState(0).randn(side, 256).astype(np.float32)
+
+
+IMAGE_CODECS = [
+    'png',
+    {'name': 'png', 'compress_level': 1},
+    {'name': 'png', 'compress_level': 0},
+    'raw',
+    {'name': 'zlib', 'level': 1},
+    {'name': 'lzma', 'preset': 0},
+    'npz',
+    'npy',
+]
+
+ARRAY_CODECS = [
+    'npz',
+    'npy',
+    'raw',
+    {'name': 'zlib', 'level': 1},
+    {'name': 'zlib', 'level': 6},
+    {'name': 'lzma', 'preset': 0},
+]
+
+
+def label(spec):
+    if isinstance(spec, str):
+        return spec
+    params = dict(spec)
+    name = params.pop('name')
+    return "{}({})".format(name, ", ".join("{}={}".format(key, value) for key, value in params.items()))
+
+
+def measure(codec, value, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        data = codec.encode(value)
+    encode_time = (time.perf_counter() - begin) / repeat
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        codec.decode(data)
+    decode_time = (time.perf_counter() - begin) / repeat
+    return encode_time, decode_time, len(data)
+
+
+def report(title, value, specs, repeat):
+    print("{} ({}, {}, {:.1f} MB)".format(title, value.shape, value.dtype, value.nbytes / 1e6))
+    print("{:<28} {:>12} {:>12} {:>8}".format("codec", "encode MB/s", "decode MB/s", "ratio"))
+    for spec in specs:
+        codec = make_codec(spec)
+        encode_time, decode_time, size = measure(codec, value, repeat)
+        print("{:<28} {:>12.1f} {:>12.1f} {:>8.3f}".format(
+            label(spec), value.nbytes / encode_time / 1e6, value.nbytes / decode_time / 1e6, size / value.nbytes,
+        ))
+    print()
+
+
+def main():
+    side = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    report("image", make_image(side), IMAGE_CODECS, repeat)
+    report("features", make_features(side), ARRAY_CODECS, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Compares passing chunks of image records between processes through multiprocessing.Queue
+# against OutOfBandQueue (pickle protocol 5, buffers sent out-of-band)
+# Usage: python benchmarks/bench_ipc.py [num_chunks] [chunk_size] [image_side]
+import os
+import sys
+import time
+import numpy as np
+
+from multiprocessing import get_context
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipex.pdatastructures import PRecord, PAtom
+from pipex.pqueue import OutOfBandQueue
+
+
+def make_chunk(chunk_size, image_side):
+    return [
+        PRecord(
+            id=str(i),
+            channel_atoms={
+                'image': PAtom(value=np.full((image_side, image_side, 3), i % 256, dtype=np.uint8), format='image'),
+                'label': PAtom(value=i, format='data'),
+            },
+            active_channel='image',
+        )
+        for i in range(chunk_size)
+    ]
+
+
+def produce(q, num_chunks, chunk_size, image_side):
+    chunk = make_chunk(chunk_size, image_side)
+    for _ in range(num_chunks):
+        q.put(chunk)
+    q.put(None)
+
+
+def run(ctx, q, num_chunks, chunk_size, image_side):
+    proc = ctx.Process(target=produce, args=(q, num_chunks, chunk_size, image_side))
+    proc.start()
+    # Excludes the start of the process
+    first = q.get()
+    begin = time.perf_counter()
+    num_bytes = 0
+    chunk = first
+    while chunk is not None:
+        num_bytes += sum(precord.value.nbytes for precord in chunk)
+        chunk = q.get()
+    elapsed = time.perf_counter() - begin
+    proc.join()
+    return elapsed, num_bytes
+
+
+def main():
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    image_side = int(sys.argv[3]) if len(sys.argv) > 3 else 512
+
+    ctx = get_context('spawn')
+    queues = [
+        ("multiprocessing.Queue", ctx.Queue(20)),
+        ("OutOfBandQueue", OutOfBandQueue(20, ctx=ctx)),
+    ]
+    print("{} chunks of {} records with {}x{}x3 images".format(num_chunks, chunk_size, image_side, image_side))
+    for name, q in queues:
+        elapsed, num_bytes = run(ctx, q, num_chunks, chunk_size, image_side)
+        print("{:<24} {:>8.3f}s {:>10.1f} MB/s".format(name, elapsed, num_bytes / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
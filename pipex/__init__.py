@@ -1,5 +1,6 @@
-from .poperators import pipe, source, sink, value_sink, pipe_map
-from .pdatastructures import PRecord, PAtom
+from .poperators import pipe, source, sink, value_sink, pipe_map, pipe_batch
+from .pdatastructures import PRecord, PAtom, PRecordBatch
+from .pbase import We, register_hasher
 from .operators import *
 
 from . import image
@@ -1,4 +1,5 @@
 from .funcs import *
 from .sources import * 
 from .concurrency import *
+from .pool import *
 from .file import *
@@ -1,18 +1,44 @@
+import os
+import sys
+import time
+import warnings
+import ctypes
 import logging
+import multiprocessing
 
 from ..poperators import pipe
-from ..pbase import PipeChain, Source, Sink, Transformer
+from ..pbase import PipeChain, Source, Sink, Transformer, instrumentation_of, tracer_of
+from ..pinstrument import stage_name, queue_occupancy
+from ..pqueue import OutOfBandQueue
 
-from threading import Thread, Lock
-from queue import Queue as ThreadingQueue, Full, Empty
+from threading import Thread, Event, Lock, Semaphore
+from queue import Queue as ThreadingQueue, Empty, Full
 from multiprocessing import Process, cpu_count, Queue as ProcessingQueue, get_context
-from typing import Optional, Type
+from typing import Callable, Optional, Type
 from itertools import islice
+from collections import deque
+from functools import partial
 
 
 class WorkerQuit(BaseException):
     pass
 
+
+class CancelFlag:
+    # Cancels a stage running in processes. Unlike a multiprocessing Event, reading it
+    # takes no lock, so that it can be checked on every record.
+    def __init__(self, ctx=None):
+        self._value = (ctx or multiprocessing).RawValue(ctypes.c_bool, False)
+
+    def set(self):
+        self._value.value = True
+
+    def clear(self):
+        self._value.value = False
+
+    def is_set(self) -> bool:
+        return self._value.value
+
 def safe_call(obj, mtdname):
     if hasattr(obj, mtdname):
         getattr(obj, mtdname)()
@@ -34,111 +60,327 @@ def _do_slice_chunk(precords, chunk_size):
             break
         yield chunk
 
+def _do_slice_sized_chunk(precords, sizer):
+    it = precords
+    while True:
+        chunk = list(islice(it, sizer.size))
+        if not chunk:
+            break
+        yield chunk
+
 def _slice_chunk(precords, chunk_size):
+    if isinstance(chunk_size, ChunkSizer):
+        return _do_slice_sized_chunk(precords, chunk_size)
     return _do_slice_chunk(precords, chunk_size)
 
+def _until_cancelled(precords, cancel):
+    for precord in precords:
+        if cancel.is_set():
+            break
+        yield precord
+
+def _reorder(tagged_chunks, window):
+    # Chunks in flight are bounded by the window,
+    # so is the number of chunks waiting here for a slower one
+    buffer = {}
+    next_seq = 0
+    for seq, precord_chunk in tagged_chunks:
+        buffer[seq] = precord_chunk
+        while next_seq in buffer:
+            precord_chunk = buffer.pop(next_seq)
+            next_seq += 1
+            window.release()
+            yield precord_chunk
+    # Chunks lost to ignored errors leave holes behind
+    for seq in sorted(buffer):
+        yield buffer[seq]
+
+def _map_chunk(fn, precord_chunk, tagged):
+    if tagged:
+        seq, precord_chunk = precord_chunk
+        return seq, fn(precord_chunk)
+    return fn(precord_chunk)
+
+
+class ChunkSizer:
+    '''
+    Chooses the size of the next chunk from the processing and transfer times workers report,
+    so that a chunk takes about target_latency, transfer included.
+
+    Transfer times include time spent waiting on queues, so the least one seen lately is taken as the cost.
+    Sizes change by at most twice or half at a time.
+    '''
+    def __init__(self, min_size: int, max_size: int, target_latency: float, smoothing: float = 0.2):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.size = min_size
+        self.record_time = None  # type: Optional[float]
+        self.transfer_times = deque(maxlen=32)
+
+    @property
+    def transfer_time(self) -> Optional[float]:
+        if not self.transfer_times:
+            return None
+        return min(self.transfer_times)
+
+    def update(self, num_records: int, compute_time: float, transfer_time: float):
+        if num_records <= 0:
+            return
+        record_time = compute_time / num_records
+        if self.record_time is None:
+            self.record_time = record_time
+        else:
+            self.record_time += self.smoothing * (record_time - self.record_time)
+        self.transfer_times.append(transfer_time)
+
+        transfer_time = self.transfer_time
+        # Past half the target, transfer costs are bounded to half a chunk's latency instead
+        budget = max(self.target_latency - transfer_time, transfer_time)
+        if self.record_time > 0:
+            ideal = budget / self.record_time
+        else:
+            ideal = float(self.max_size)
+        size = min(max(ideal, self.size / 2), self.size * 2)
+        self.size = int(min(max(size, self.min_size), self.max_size))
+
+
+class ChunkTiming:
+    # Wraps a chunk sent by a worker with the times it took, when chunks are sized adaptively
+    __slots__ = ('chunk', 'num_records', 'compute_time', 'transfer_time')
+    def __init__(self, chunk, num_records: int, compute_time: float, transfer_time: float):
+        self.chunk = chunk
+        self.num_records = num_records
+        self.compute_time = compute_time
+        self.transfer_time = transfer_time
+
+    def __reduce__(self):
+        return (ChunkTiming, (self.chunk, self.num_records, self.compute_time, self.transfer_time))
+
+
+class WorkerScaler(Thread):
+    '''
+    Adds or retires workers of a fork-join stage between min_workers and max_workers,
+    from how full its queues stay over consecutive samples.
+
+    A worker is added while in_q stays nearly full, that is, while busy workers fall behind the producer,
+    unless out_q backs up as well. One is retired, by a sentinel of its own, while out_q stays nearly full
+    or in_q stays empty, that is, while downstream or upstream is the bottleneck.
+    '''
+    def __init__(self, spawn_worker, num_workers, in_q, out_q, capacity, cancel,
+                 min_workers, max_workers, interval, patience=2):
+        super().__init__(daemon=True)
+        self.spawn_worker = spawn_worker
+        self.num_active = num_workers
+        self.in_q = in_q
+        self.out_q = out_q
+        self.high_water = max(1, capacity * 3 // 4)
+        self.cancel = cancel
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.patience = patience
+        self.lock = Lock()
+        self.closed = False
+        self.stopped = Event()
+
+    def run(self):
+        logger = logging.getLogger("WorkerScaler")
+        high_water = self.high_water
+        ups = downs = 0
+        while not self.stopped.wait(self.interval):
+            if self.cancel.is_set():
+                break
+            in_occupancy, out_occupancy = queue_occupancy(self.in_q), queue_occupancy(self.out_q)
+            if in_occupancy is None or out_occupancy is None:
+                logger.warning("Queue sizes are not available. Worker count stays as it is.")
+                break
+            if in_occupancy >= high_water and out_occupancy < high_water:
+                ups, downs = ups + 1, 0
+            elif out_occupancy >= high_water or in_occupancy == 0:
+                ups, downs = 0, downs + 1
+            else:
+                ups = downs = 0
+            if ups >= self.patience:
+                ups = 0
+                self._scale_up()
+            elif downs >= self.patience:
+                downs = 0
+                self._scale_down()
+
+    def _scale_up(self):
+        with self.lock:
+            if self.closed or self.num_active >= self.max_workers:
+                return
+            self.spawn_worker()
+            self.num_active += 1
+
+    def _scale_down(self):
+        with self.lock:
+            if self.closed or self.num_active <= self.min_workers:
+                return
+            try:
+                # Whichever worker takes it quits. in_q is likely full when out_q backs up; wait for room a while.
+                self.in_q.put(None, timeout=self.interval)
+            except Full:
+                return
+            self.num_active -= 1
+
+    def close(self) -> int:
+        # Called by the producer before it sends sentinels. No worker comes or goes afterwards.
+        with self.lock:
+            self.closed = True
+            return self.num_active
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
 
 class ProducerThread(Thread):
-    def __init__(self, chunk_size, poll_interval, in_q, ctl_in_q, precords, workers):
+    def __init__(self, chunk_size, in_q, cancel, precords, workers,
+                 in_q_stats=None, tracer=None, window=None, transport=None, chunk_stats=None, scaler=None):
         super().__init__(daemon=True)
+        self.scaler = scaler
+        self.chunk_stats = chunk_stats
+        self.transport = transport
+        self.in_q_stats = in_q_stats
+        self.tracer = tracer
+        # If given, chunks are tagged with sequence numbers and at most
+        # as many as the window allows are in flight
+        self.window = window
+        # Either a fixed size or a ChunkSizer
         self.chunk_size = chunk_size
-        self.poll_interval = poll_interval
         self.in_q = in_q
-        self.ctl_in_q = ctl_in_q
+        # Shared by the producer, the workers and the consumer. Whoever sets it stops the whole stage.
+        self.cancel = cancel
         self.precords = precords
         self.raised_exception = None
         self.workers = workers
-        self.asked_to_quit = False
-        self.lock = Lock()
-
 
     def run(self):
         logger = logging.getLogger("WorkerProducer")
-        in_q, precords = self.in_q, self.precords
+        in_q, precords, cancel = self.in_q, self.precords, self.cancel
+        in_q_stats, tracer, window = self.in_q_stats, self.tracer, self.window
+        transport, chunk_stats = self.transport, self.chunk_stats
         try:
-            for precord_chunk in _slice_chunk(precords, self.chunk_size):
-                while True:
-                    if self.asked_to_quit:
-                        logger.debug("Someone asked me to quit quiting")
-                        raise WorkerQuit
-                    try:
-                        logger.debug("Adding precord")
-                        in_q.put(precord_chunk, timeout=self.poll_interval)
-                        break
-                    except Full:
-                        pass
-            logger.debug("All precords has been produced! Sending sentinels to workers")
-            for _ in range(len(self.workers)):
-                while True:
-                    if self.asked_to_quit:
-                        logger.debug("Someone asked me to quit quiting")
-                        raise WorkerQuit
-                    try:
-                        in_q.put(None, timeout=self.poll_interval)
-                        break
-                    except Full:
-                        pass
-
-            logger.debug("Sentinels produced!")
-        except WorkerQuit:
-            logger.debug("Worker Quit!")
+            # Stops reading the source as soon as cancelled, even amid a chunk
+            chunks = _slice_chunk(_until_cancelled(precords, cancel), self.chunk_size)
+            for seq, precord_chunk in enumerate(chunks):
+                if window is not None:
+                    # The canceller releases the window once to wake us up
+                    window.acquire()
+                # A blocked put is woken up by workers draining in_q when cancelled.
+                if cancel.is_set():
+                    logger.debug("Cancelled")
+                    break
+                if chunk_stats is not None:
+                    chunk_stats.record(len(precord_chunk))
+                if transport is not None:
+                    precord_chunk = transport.encode_chunk(precord_chunk)
+                if window is not None:
+                    precord_chunk = (seq, precord_chunk)
+                begin = time.perf_counter()
+                in_q.put(precord_chunk)
+                if in_q_stats is not None:
+                    elapsed = time.perf_counter() - begin
+                    in_q_stats.record_put(in_q, elapsed)
+                    if tracer is not None:
+                        tracer.complete("in_q.put", "queue", begin, elapsed)
         except Exception as exc:
             self.raised_exception = exc
-            self.ask_quit(None)
+            cancel.set()
         except KeyboardInterrupt:
-            self.ask_quit("KeyboardInterrupt")
-
-    def ask_quit(self, reason=None):
-        with self.lock:
-            self.asked_to_quit = True
-        for _ in self.workers:
-            self.ctl_in_q.put(reason or True)
+            cancel.set()
+        finally:
+            # Each worker takes exactly one sentinel, whether it ran to the end or was cancelled
+            logger.debug("Sending sentinels to workers")
+            if self.scaler is not None:
+                # Workers the scaler retired took a sentinel already
+                num_sentinels = self.scaler.close()
+            else:
+                num_sentinels = len(self.workers)
+            for _ in range(num_sentinels):
+                in_q.put(None)
+            # Release the files or workers of the stages upstream
+            try:
+                safe_call(precords, 'close')
+            except Exception as exc:
+                if self.raised_exception is None:
+                    self.raised_exception = exc
 
 
 class SourceFromProducerInWorker(Source):
+    def __init__(self, owner: "Worker", on_chunk: Optional[Callable[[list], None]] = None):
+        self.owner = owner
+        # Called with each input chunk as it is taken, once the chain is done with the previous one
+        self.on_chunk = on_chunk
+
+    def generate_precords(self, our):
+        owner = self.owner
+        cancel = owner.cancel
+        on_chunk = self.on_chunk
+        for precord_chunk in owner._input_chunks(our):
+            if on_chunk is not None:
+                on_chunk(precord_chunk)
+            for precord in precord_chunk:
+                if cancel.is_set():
+                    owner._abort()
+                yield precord
+
+
+class SourceFromChunkInWorker(Source):
+    # Feeds the chunk being processed, so that outputs are attributed to their input chunk
     def __init__(self, owner: "Worker"):
         self.owner = owner
+        self.precord_chunk = []
 
     def generate_precords(self, our):
-        in_q = self.owner.in_q
-        poll_interval = self.owner.poll_interval
-        while True:
-            self.owner._check_interrupt()
-            try:
-                precord_chunk = in_q.get(timeout=poll_interval)
-                if precord_chunk is None: # met sentinel, which is the same as EOF. quit.
-                    break
-                yield from precord_chunk
-            except Empty:
-                pass
+        owner = self.owner
+        cancel = owner.cancel
+        for precord in self.precord_chunk:
+            if cancel.is_set():
+                owner._abort()
+            yield precord
 
 
 class Worker:
     def __init__(self, *,
                  index,
                  chunk_size,
-                 poll_interval,
                  ignore_error, error_logger,
                  name, our, target_chain,
-                 in_q, out_q, ctl_in_q, ctl_out_q):
+                 in_q, out_q, cancel, ctl_out_q,
+                 preserve_order=False,
+                 report_timing=False,
+                 transport=None,
+                 send_sentinel=True,
+                 close_out_q=False):
         self.index = index
+        self.preserve_order = preserve_order
+        # Output chunks are wrapped in ChunkTiming for the parent to size the chunks
+        self.report_timing = report_timing
+        self.transport = transport
         self.chunk_size = chunk_size
-        self.poll_interval = poll_interval
         self.ignore_error = ignore_error
         self.error_logger = error_logger
         self.name = name
         self.our = our
         self.target_chain = target_chain
 
-        # in_q     -> Process/Thread(target=<Worker>) -> out_q
-        # ctl_in_q ->                                 -> ctl_out_q (Control queue)
+        # in_q   -> Process/Thread(target=<Worker>) -> out_q
+        # cancel ->                                 -> ctl_out_q (Control queue)
         self.in_q = in_q
         self.out_q = out_q
 
-        # Just setting 'done' flag is not enough; processes don't share memory
-        # We need another channel to control workers
-        self.ctl_in_q = ctl_in_q
+        # An Event or a CancelFlag, checked on each record taken from in_q
+        self.cancel = cancel
         self.ctl_out_q = ctl_out_q
+        # Without a sentinel of our own, whoever reads ctl_out_q sends sentinels downstream.
+        # A process then closes out_q to flush what it put before telling it is done.
+        self.send_sentinel = send_sentinel
+        self.close_out_q = close_out_q
 
         # Only meaningful in main thread
         self.is_done = False
@@ -146,178 +388,483 @@ class Worker:
     def run(self):
         self.logger = logger = logging.getLogger(self.name)
         logger.debug("Worker Started")
+        self._run_begin = time.perf_counter()
+        self.got_sentinel = False
+        self._get_time = self._put_time = self._compute_time = 0.0
+        self._num_input_records = 0
+        # Statistics are collected apart and shipped to the parent when done
+        our = self.our.child()
+        instrumentation = our.instrumentation
+        out_q = self.out_q
+        out_q_stats = instrumentation.queue('out_q') if instrumentation is not None else None
+        report_timing = self.report_timing
+        if self.preserve_order:
+            out_chunks = self._generate_chunkwise(our)
+        elif report_timing:
+            out_chunks = self._generate_timed(our)
+        else:
+            out_chunks = _slice_chunk(self._generate(our), self.chunk_size)
+        transport = self.transport
         try:
-            for precord_chunk in _slice_chunk(self._generate(), self.chunk_size):
-                while True:
-                    self._check_interrupt()
-                    try:
-                        self.out_q.put(precord_chunk, timeout=self.poll_interval)
-                        break
-                    except Full:
-                        pass
+            for precord_chunk in out_chunks:
+                if transport is not None:
+                    precord_chunk = _map_chunk(transport.encode_chunk, precord_chunk, self.preserve_order)
+                if report_timing:
+                    # The put of a chunk is reported along with the next one
+                    precord_chunk = ChunkTiming(
+                        precord_chunk, self._num_input_records, self._compute_time,
+                        self._get_time + self._put_time,
+                    )
+                begin = time.perf_counter()
+                out_q.put(precord_chunk)
+                self._put_time = elapsed = time.perf_counter() - begin
+                if out_q_stats is not None:
+                    out_q_stats.record_put(out_q, elapsed)
 
         except WorkerQuit:
-            self._notify_parent_done()
+            self._notify_parent_done(our)
         except Exception as exc:
             self.error_logger("Error raised in {}".format(self.name))
             self._ask_parent_raise(exc)
+            if not self.ignore_error:
+                # The parent cancels the stage on our error. Take our sentinel from the producer.
+                self._drain_input()
             raise
         else:
-            self._notify_parent_done()
+            self._notify_parent_done(our)
+
+    def _input_chunks(self, our):
+        in_q, cancel = self.in_q, self.cancel
+        instrumentation = instrumentation_of(our)
+        in_q_stats = instrumentation.queue('in_q') if instrumentation is not None else None
+        while True:
+            begin = time.perf_counter()
+            precord_chunk = in_q.get()
+            if in_q_stats is not None:
+                in_q_stats.record_get(in_q, time.perf_counter() - begin)
+            if precord_chunk is None: # met sentinel, which is the same as EOF. quit.
+                self.got_sentinel = True
+                break
+            if self.transport is not None:
+                precord_chunk = _map_chunk(self.transport.decode_chunk, precord_chunk, self.preserve_order)
+            self._get_time = time.perf_counter() - begin
+            if cancel.is_set():
+                del precord_chunk
+                self._abort()
+            yield precord_chunk
 
-    def _generate(self):
+    def _abort(self):
+        # Gives up the chunk at hand once cancelled
+        self._drain_input()
+        raise WorkerQuit
+
+    def _drain_input(self):
+        # Discards what is left up to our sentinel, so that the producer never stays blocked on a full in_q
+        in_q, transport = self.in_q, self.transport
+        while not self.got_sentinel:
+            precord_chunk = in_q.get()
+            if precord_chunk is None:
+                self.got_sentinel = True
+            elif transport is not None:
+                # Frees the shared memory slots of the chunk
+                _map_chunk(transport.decode_chunk, precord_chunk, self.preserve_order)
+
+    def _generate(self, our):
         target_chain = SourceFromProducerInWorker(self) >> self.target_chain
-        for precord in target_chain.execute(self.our):
+        for precord in target_chain.execute(our):
             yield precord
 
+    def _generate_timed(self, our):
+        # The chain runs once for the whole run, so that sinks and stateful transformers see every record.
+        # Outputs are cut where the chain goes on to the next input chunk, and sent along with
+        # the timing of that input chunk.
+        ready = deque()
+        out_chunk = []
+        current = [None, 0]  # when the chain took the input chunk at hand, and its size
+
+        def on_chunk(precord_chunk):
+            now = time.perf_counter()
+            begin, num_records = current
+            if begin is not None:
+                ready.append((list(out_chunk), num_records, now - begin - self._get_time))
+                out_chunk.clear()
+            current[:] = [now, len(precord_chunk)]
+
+        target_chain = SourceFromProducerInWorker(self, on_chunk) >> self.target_chain
+        for precord in target_chain.execute(our):
+            while ready:
+                chunk, self._num_input_records, self._compute_time = ready.popleft()
+                yield chunk
+            out_chunk.append(precord)
+        while ready:
+            chunk, self._num_input_records, self._compute_time = ready.popleft()
+            yield chunk
+        begin, num_records = current
+        if begin is not None or out_chunk:
+            compute_time = time.perf_counter() - begin if begin is not None else 0.0
+            self._num_input_records, self._compute_time = num_records, compute_time
+            yield out_chunk
+
+    def _generate_chunkwise(self, our):
+        # One output chunk per input chunk, even an empty one.
+        # Tagged with the sequence number of the input chunk if ordered.
+        # The target chain is executed once per chunk, so it may neither be a sink nor keep state.
+        source = SourceFromChunkInWorker(self)
+        target_chain = source >> self.target_chain
+        preserve_order = self.preserve_order
+        for precord_chunk in self._input_chunks(our):
+            if preserve_order:
+                seq, precord_chunk = precord_chunk
+            source.precord_chunk = precord_chunk
+            begin = time.perf_counter()
+            out_chunk = list(target_chain.execute(our))
+            self._compute_time = time.perf_counter() - begin
+            self._num_input_records = len(precord_chunk)
+            yield (seq, out_chunk) if preserve_order else out_chunk
+
     def _ask_parent_raise(self, exc):
         if not self.ignore_error:
-            self.ctl_out_q.put((False, exc, self.index))
+            self._flush_output()
+            self.ctl_out_q.put((False, exc, self.index, None))
+            if self.send_sentinel:
+                self.out_q.put(None)
+
+    def _flush_output(self):
+        if not self.send_sentinel and self.close_out_q:
+            self.out_q.close()
+            self.out_q.join_thread()
+
+    def _notify_parent_done(self, our):
+        instrumentation = our.instrumentation
+        exported = None
+        if instrumentation is not None:
+            tracer = instrumentation.tracer
+            if tracer is not None:
+                begin = self._run_begin
+                tracer.complete("Worker.run", "worker", begin, time.perf_counter() - begin, {"worker": self.name})
+            exported = instrumentation.export()
+        self._flush_output()
+        self.ctl_out_q.put((True, None, self.index, exported))
+        if self.send_sentinel:
             self.out_q.put(None)
 
-    def _notify_parent_done(self):
-        self.ctl_out_q.put((True, None, self.index))
-        self.out_q.put(None)
+def _check_ordered_target(target_chain):
+    # Keeping the order runs the target chain once per chunk. A sink would process
+    # (flush its metadata, hash its data) that many times; put it after the stage instead.
+    # Stateful transformers would start over on each chunk.
+    if isinstance(target_chain, Sink):
+        raise ValueError("preserve_order is not supported with a sink {!r}".format(target_chain))
+    if target_chain.keeps_state():
+        raise ValueError(
+            "preserve_order is not supported with {!r}, which keeps state across records".format(target_chain)
+        )
 
-    def _check_interrupt(self):
-        try:
-            self.ctl_in_q.get_nowait()
-            raise WorkerQuit
-        except Empty:
-            pass
 
 # Fork-Join Model
 class base_fork_join(pipe):
     queue_class = None # type: Optional[Type]
     process_class = None # type: Optional[Type]
+    event_class = None # type: Optional[Type]
+    # For in_q and out_q, if other than queue_class
+    data_queue_class = None # type: Optional[Type]
+    # Whether workers are processes rather than threads, which a worker pool has to match
+    uses_processes = None # type: Optional[bool]
 
     def __init__(self,
                  target_chain: PipeChain,
                  num_workers=None,
                  chunk_size=1,
-                 queue_size=20,
+                 queue_size=None,
                  ignore_error=False,
-                 poll_interval=2.0,
-                 error_logger=logging.error):
+                 poll_interval=None,
+                 error_logger=logging.error,
+                 preserve_order=False,
+                 pool=None,
+                 min_chunk_size=1,
+                 max_chunk_size=1024,
+                 target_chunk_latency=0.01,
+                 min_workers=1,
+                 max_workers=None,
+                 scale_interval=0.5):
         if not isinstance(target_chain, (Sink, Transformer)):
             raise TypeError("{!r} not sink or transformer".format(target_chain))
+        if poll_interval is not None:
+            # Workers are woken up by sentinels and a cancel event rather than polling
+            warnings.warn("poll_interval is ignored and will be removed", DeprecationWarning, stacklevel=2)
+        if preserve_order:
+            _check_ordered_target(target_chain)
+        if isinstance(chunk_size, str) and chunk_size != 'auto':
+            raise ValueError("chunk_size should be a positive integer or 'auto'")
+        if not 1 <= min_chunk_size <= max_chunk_size:
+            raise ValueError("expected 1 <= min_chunk_size <= max_chunk_size")
         self.target_chain = target_chain
+        self.preserve_order = preserve_order
+        # A WorkerPool running this stage instead of workers spawned for each run
+        self.pool = pool
+        if pool is not None:
+            if pool.use_processes != self.uses_processes:
+                raise ValueError("{!r} runs its workers in {}, {} expects {}".format(
+                    pool,
+                    "processes" if pool.use_processes else "threads",
+                    self.__class__.__name__,
+                    "processes" if self.uses_processes else "threads",
+                ))
+            if num_workers == 'auto':
+                raise ValueError("A worker pool has a fixed number of workers")
+            if num_workers is not None and num_workers != pool.num_workers:
+                raise ValueError("num_workers={!r} conflicts with {!r}".format(num_workers, pool))
+            if queue_size is not None and queue_size != pool.queue_size:
+                raise ValueError("queue_size={!r} conflicts with the queue_size {!r} of {!r}".format(
+                    queue_size, pool.queue_size, pool,
+                ))
+            num_workers, queue_size = pool.num_workers, pool.queue_size
+        # 'auto' to scale between min_workers and max_workers, starting from min_workers
+        self.autoscale = num_workers == 'auto'
+        self.min_workers = min_workers
+        self.max_workers = max_workers or cpu_count()
+        self.scale_interval = scale_interval
+        if self.autoscale:
+            if not 1 <= min_workers <= self.max_workers:
+                raise ValueError("expected 1 <= min_workers <= max_workers")
+            num_workers = min_workers
+        elif isinstance(num_workers, str):
+            raise ValueError("num_workers should be a positive integer or 'auto'")
         self.num_workers = num_workers or cpu_count()
+        # 'auto' to size chunks so that each takes about target_chunk_latency seconds in a worker
         self.chunk_size = chunk_size
-        self.queue_size = queue_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_chunk_latency = target_chunk_latency
+        self.queue_size = queue_size if queue_size is not None else 20
         self.ignore_error = ignore_error
-        self.poll_interval = poll_interval
         self.error_logger = error_logger
 
+    def keeps_state(self):
+        return isinstance(self.target_chain, Transformer) and self.target_chain.keeps_state()
+
     @property
     def _real_queue_size(self):
         return self.queue_size
 
-    def _run_workers(self, our):
-        in_q, out_q = self.queue_class(self._real_queue_size), self.queue_class(self._real_queue_size)
-        ctl_in_q, ctl_out_q = self.queue_class(0), self.queue_class(0)
-        workers = []
-        for index in range(self.num_workers):
-            name = self.get_worker_name(index)
-            workers.append(
-                Worker(
-                    index=index,
-                    chunk_size=self.chunk_size,
-                    poll_interval=self.poll_interval,
-                    ignore_error=self.ignore_error,
-                    error_logger=self.error_logger,
-                    target_chain=self.target_chain,
-                    name=name,
-                    our=our,
-                    in_q=in_q,
-                    out_q=out_q,
-                    ctl_in_q=ctl_in_q,
-                    ctl_out_q=ctl_out_q,
-                )
-            )
+    @property
+    def adaptive_chunk_size(self) -> bool:
+        return self.chunk_size == 'auto'
 
-        processes = []
-        for worker in workers:
-            process = self.process_class(
-                target=worker.run,
-                daemon=True,
-            )
-            process.start()
-            processes.append(process)
-        return workers, processes, in_q, out_q, ctl_in_q, ctl_out_q
+    def _make_sizer(self) -> Optional[ChunkSizer]:
+        if not self.adaptive_chunk_size:
+            return None
+        return ChunkSizer(self.min_chunk_size, self.max_chunk_size, self.target_chunk_latency)
+
+    def _make_transport(self):
+        # Encodes chunks before they are put into queues and decodes them after.
+        # None to send chunks as they are.
+        return None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, stage_name(self.target_chain))
+
+    def _queue_stats(self, our, name):
+        # Shares the key under which worker statistics get merged
+        instrumentation = instrumentation_of(our)
+        if instrumentation is None:
+            return None
+        return instrumentation.queue(((id(self), 'worker'), name), stage_name(self) + " / " + name)
+
+    def _make_worker(self, our, index, in_q, out_q, cancel, ctl_out_q, transport=None):
+        return Worker(
+            index=index,
+            chunk_size=self.chunk_size,
+            ignore_error=self.ignore_error,
+            error_logger=self.error_logger,
+            target_chain=self.target_chain,
+            name=self.get_worker_name(index),
+            our=our,
+            in_q=in_q,
+            out_q=out_q,
+            cancel=cancel,
+            ctl_out_q=ctl_out_q,
+            preserve_order=self.preserve_order,
+            report_timing=self.adaptive_chunk_size,
+            transport=transport,
+        )
+
+    def _start_worker(self, worker):
+        process = self.process_class(
+            target=worker.run,
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _run_workers(self, our, transport=None):
+        data_queue_class = self.data_queue_class or self.queue_class
+        in_q, out_q = data_queue_class(self._real_queue_size), data_queue_class(self._real_queue_size)
+        cancel, ctl_out_q = self.event_class(), self.queue_class(0)
+        workers = [
+            self._make_worker(our, index, in_q, out_q, cancel, ctl_out_q, transport)
+            for index in range(self.num_workers)
+        ]
+        processes = [self._start_worker(worker) for worker in workers]
+        return workers, processes, in_q, out_q, cancel, ctl_out_q
+
+    def _run_scaler(self, our, workers, processes, in_q, out_q, cancel, ctl_out_q, transport=None):
+        def spawn_worker():
+            worker = self._make_worker(our, len(workers), in_q, out_q, cancel, ctl_out_q, transport)
+            # The consumer waits for as many workers as are listed
+            workers.append(worker)
+            processes.append(self._start_worker(worker))
+
+        scaler = WorkerScaler(
+            spawn_worker, len(workers), in_q, out_q, self._real_queue_size, cancel,
+            self.min_workers, self.max_workers, self.scale_interval,
+        )
+        scaler.start()
+        return scaler
 
-    def _run_producer(self, precords, workers, in_q, ctl_in_q):
+    def _run_producer(self, our, precords, workers, in_q, cancel, window=None, transport=None, sizer=None, scaler=None):
+        chunk_stats = None
+        instrumentation = instrumentation_of(our)
+        if instrumentation is not None:
+            chunk_stats = instrumentation.chunk((id(self), 'chunks'), stage_name(self) + " / chunks")
         producer = ProducerThread(
-            self.chunk_size,
-            self.poll_interval,
+            sizer or self.chunk_size,
             in_q,
-            ctl_in_q,
+            cancel,
             precords,
             workers,
+            self._queue_stats(our, 'in_q'),
+            tracer_of(our),
+            window,
+            transport,
+            chunk_stats,
+            scaler,
         )
         producer.start()
         return producer
 
-    def _pop_done_state(self, workers, ctl_out_q):
-        try:
-            success, exc, index = ctl_out_q.get_nowait()
-            worker = workers[index]
-            worker.is_done = True
-            if not success:
-                # Reraise
-                raise exc
-            return True
-        except Empty:
-            return None
+    def _pop_done_state(self, our, workers, ctl_out_q):
+        # A worker sends its state before its sentinel, yet through another queue.
+        # Block until the state arrives.
+        success, exc, index, exported = ctl_out_q.get()
+        worker = workers[index]
+        worker.is_done = True
+        instrumentation = instrumentation_of(our)
+        if exported is not None and instrumentation is not None:
+            instrumentation.merge_exported(exported, (id(self), 'worker'), stage_name(self) + " / ")
+        if not success:
+            # Reraise
+            raise exc
+        return True
 
-    def _run_consumer(self, workers, out_q, ctl_in_q, ctl_out_q):
-        N = len(workers)
+    def _run_consumer(self, our, workers, out_q, ctl_out_q, transport=None, sizer=None):
+        # Workers may be added on the way. Once all listed are done, the producer is, and no more are added.
         num_done_workers = 0
+        out_q_stats = self._queue_stats(our, 'out_q')
+
+        while num_done_workers < len(workers) or not out_q.empty():
+            begin = time.perf_counter()
+            precord_chunk = out_q.get()
+            if out_q_stats is not None:
+                out_q_stats.record_get(out_q, time.perf_counter() - begin)
+            if precord_chunk is not None:
+                if isinstance(precord_chunk, ChunkTiming):
+                    if sizer is not None:
+                        sizer.update(precord_chunk.num_records, precord_chunk.compute_time, precord_chunk.transfer_time)
+                    precord_chunk = precord_chunk.chunk
+                if transport is not None:
+                    precord_chunk = _map_chunk(transport.decode_chunk, precord_chunk, self.preserve_order)
+                yield precord_chunk
+            else:
+                num_done_workers += 1
+                self._pop_done_state(our, workers, ctl_out_q)
 
+        # Flush remaining objects inside the out queue
         try:
-            while num_done_workers < N or not out_q.empty():
-                precord_chunk = out_q.get()
+            while True:
+                precord_chunk = out_q.get_nowait()
                 if precord_chunk is not None:
-                    yield from precord_chunk
-                else:
-                    num_done_workers += 1
-                    self._pop_done_state(workers, ctl_out_q)
-        except Exception:
-            for _ in workers:
-                ctl_in_q.put(True)
-            while num_done_workers < N:
-                precord_chunk = out_q.get()
-                if precord_chunk is None:
-                    num_done_workers += 1
-            raise
-        else:
-            # Flush remaining objects inside the out queue
-            try:
-                while True:
-                    precord_chunk = out_q.get_nowait()
-                    if precord_chunk is not None:
-                        yield from precord_chunk
-            except Empty:
-                pass
+                    if isinstance(precord_chunk, ChunkTiming):
+                        precord_chunk = precord_chunk.chunk
+                    if transport is not None:
+                        precord_chunk = _map_chunk(transport.decode_chunk, precord_chunk, self.preserve_order)
+                    yield precord_chunk
+        except Empty:
+            pass
 
+    def _drain_output(self, our, workers, out_q, ctl_out_q, transport=None):
+        # Discards what workers still put until each of them is done, so that none stays blocked on a full out_q
+        while not all(worker.is_done for worker in workers):
+            precord_chunk = out_q.get()
+            if precord_chunk is None:
+                try:
+                    self._pop_done_state(our, workers, ctl_out_q)
+                except Exception:
+                    # The run is cancelled already
+                    pass
+            elif transport is not None:
+                if isinstance(precord_chunk, ChunkTiming):
+                    precord_chunk = precord_chunk.chunk
+                _map_chunk(transport.decode_chunk, precord_chunk, self.preserve_order)
 
     def transform(self, our, precords):
         # [ producer thread ] => [ worker threads/processes ] => [ consumer(this thread) ]
-        workers, processes, in_q, out_q, ctl_in_q, ctl_out_q = self._run_workers(our)
-        producer = self._run_producer(precords, workers, in_q, ctl_in_q)
-        try:
-            yield from self._run_consumer(workers, out_q, ctl_in_q, ctl_out_q)
-        finally:
-            producer.ask_quit()
+        if self.pool is not None:
+            return self.pool.run(self, our, precords)
+        return self._transform_spawning(our, precords)
 
+    def _transform_spawning(self, our, precords):
+        # A generator, so that nothing is spawned until the first record is asked for
+        transport = self._make_transport()
+        workers, processes, in_q, out_q, cancel, ctl_out_q = self._run_workers(our, transport)
+        scaler = None
+        if self.autoscale:
+            scaler = self._run_scaler(our, workers, processes, in_q, out_q, cancel, ctl_out_q, transport)
+
+        def finish(clean):
+            if scaler is not None:
+                scaler.stop()
             # let's not make zombie processes.
             for proc in processes:
                 proc.join()
 
             # close all queues if possible
-            close_queues(in_q, out_q, ctl_in_q, ctl_out_q)
+            close_queues(in_q, out_q, ctl_out_q)
+            if transport is not None:
+                transport.close()
 
-            producer.join()
+        yield from self._fork_join(our, precords, workers, in_q, out_q, cancel, ctl_out_q, transport, finish, scaler)
+
+    def _fork_join(self, our, precords, workers, in_q, out_q, cancel, ctl_out_q, transport, finish, scaler=None):
+        # finish(clean) is called once the producer and workers are done.
+        # A clean run leaves nothing behind in the queues, even a cancelled one.
+        window = None
+        if self.preserve_order:
+            window = Semaphore(self._real_queue_size + (self.max_workers if self.autoscale else len(workers)))
+        # The consumer feeds back what workers report to the producer
+        sizer = self._make_sizer()
+        producer = self._run_producer(our, precords, workers, in_q, cancel, window, transport, sizer, scaler)
+        completed = False
+        try:
+            chunks = self._run_consumer(our, workers, out_q, ctl_out_q, transport, sizer)
+            if window is not None:
+                chunks = _reorder(chunks, window)
+            for precord_chunk in chunks:
+                yield from precord_chunk
+            completed = True
+        finally:
+            # Stopped early by downstream or by an error: cancel the producer and workers,
+            # and take what they put until they are done
+            clean = False
+            try:
+                if not completed:
+                    cancel.set()
+                    if window is not None:
+                        window.release()
+                    self._drain_output(our, workers, out_q, ctl_out_q, transport)
+                producer.join()
+                clean = True
+            finally:
+                finish(clean)
 
         if producer.raised_exception is not None:
             raise producer.raised_exception
@@ -329,19 +876,54 @@ class base_fork_join(pipe):
 class threaded(base_fork_join):
     queue_class = ThreadingQueue
     process_class = Thread
+    event_class = Event
+    uses_processes = False
 
     def get_worker_name(self, index: int):
         return "WorkerThread[{}]".format(index)
 
 
 class parallel(base_fork_join):
+    uses_processes = True
+
     def __init__(self, *args, **kwargs):
         start_method = kwargs.pop('start_method', None) or 'spawn'
+        # Arrays of at least shm_min_bytes are passed through slots of shared memory
+        # instead of being pickled, as long as a slot is free.
+        self.shared_memory = kwargs.pop('shared_memory', False)
+        self.shm_slot_size = kwargs.pop('shm_slot_size', 8 << 20)
+        self.shm_num_slots = kwargs.pop('shm_num_slots', None)
+        self.shm_min_bytes = kwargs.pop('shm_min_bytes', 64 << 10)
+        # Chunks are pickled with protocol 5, their arrays and large bytes sent out-of-band.
+        # Protocol 5 is there on Python 3.8+.
+        self.out_of_band = kwargs.pop('out_of_band', sys.version_info >= (3, 8))
         super().__init__(*args, **kwargs)
+        if self.shared_memory and self.pool is not None:
+            raise ValueError("shared_memory is not supported with a worker pool")
 
         ctx = get_context(start_method)
         self.queue_class = ctx.Queue
         self.process_class = ctx.Process
+        self.event_class = partial(CancelFlag, ctx)
+        if self.out_of_band and not self.shared_memory and os.name == 'posix':
+            self.data_queue_class = partial(OutOfBandQueue, ctx=ctx)
+
+    def _make_transport(self):
+        if not self.shared_memory:
+            return None
+        # multiprocessing.shared_memory is only there on Python 3.8+
+        from ..pshared import SlabPool
+        # Enough slots for full queues in both directions. Pages are only committed when written.
+        # Adaptive chunks of arrays worth sharing tend to stay small; beyond the slots, arrays are pickled.
+        chunk_size = self.min_chunk_size if self.adaptive_chunk_size else self.chunk_size
+        num_workers = self.max_workers if self.autoscale else self.num_workers
+        num_slots = self.shm_num_slots or 2 * (self.queue_size + num_workers) * chunk_size
+        return SlabPool(
+            num_slots,
+            self.shm_slot_size,
+            self.shm_min_bytes,
+            self.queue_class,
+        )
 
     def get_worker_name(self, index: int):
         return "WorkerProcess[{}]".format(index)
@@ -364,7 +946,209 @@ class on_bg_process(parallel):
     def get_worker_name(self, index: int):
         return "BackgroundWorkerProcess"
 
+class StageCoordinator(Thread):
+    # Collects what the workers of staged() report, and sends the sentinels of a stage
+    # once every worker of the stage before it is done
+    def __init__(self, owner: "staged", our, stage_workers, stage_qs, ctl_out_q, cancel):
+        super().__init__(daemon=True)
+        self.owner = owner
+        self.our = our
+        self.stage_workers = stage_workers
+        self.stage_qs = stage_qs
+        self.ctl_out_q = ctl_out_q
+        self.cancel = cancel
+        self.raised_exception = None
+
+    def run(self):
+        owner, stage_workers, stage_qs = self.owner, self.stage_workers, self.stage_qs
+        instrumentation = instrumentation_of(self.our)
+        num_stages = len(stage_workers)
+        remaining = [len(workers) for workers in stage_workers]
+        num_done_stages = 0
+        while num_done_stages < num_stages:
+            success, exc, (stage_index, index), exported = self.ctl_out_q.get()
+            stage_workers[stage_index][index].is_done = True
+            remaining[stage_index] -= 1
+            if exported is not None and instrumentation is not None:
+                stage = owner.stages[stage_index]
+                instrumentation.merge_exported(exported, (id(stage), 'worker'), stage_name(stage) + " / ")
+            if not success and self.raised_exception is None:
+                self.raised_exception = exc
+                self.cancel.set()
+            # A worker failing early is done before the stage before it is
+            while num_done_stages < num_stages and remaining[num_done_stages] == 0:
+                num_done_stages += 1
+                if num_done_stages < num_stages:
+                    num_sentinels = len(stage_workers[num_done_stages])
+                else:
+                    # For the consumer
+                    num_sentinels = 1
+                for _ in range(num_sentinels):
+                    stage_qs[num_done_stages].put(None)
+
+
+class staged(pipe):
+    '''
+    Runs each stage with workers of its own, connected by bounded queues,
+    so that each stage is sized to its own cost:
+
+        glob(...) >> staged(
+            threaded(map(open_image), num_workers=8),
+            parallel(map(augment), num_workers=16),
+            threaded(bucket_saver, num_workers=2),
+        )
+
+    Stages are given as threaded() or parallel(), whose chain, number of workers, chunk size and queue size
+    are taken. Workers hand their outputs over to the next stage directly, without going through this thread.
+    '''
+    def __init__(self, *stages: base_fork_join, preserve_order=False):
+        if not stages:
+            raise ValueError("staged() needs at least a stage")
+        for stage in stages:
+            if not isinstance(stage, base_fork_join):
+                raise TypeError("{!r} not threaded or parallel".format(stage))
+            if stage.adaptive_chunk_size or stage.autoscale:
+                raise ValueError("adaptive chunk sizes and worker counts are not supported in staged()")
+            if stage.pool is not None or getattr(stage, 'shared_memory', False):
+                raise ValueError("worker pools and shared memory are not supported in staged()")
+            if preserve_order:
+                _check_ordered_target(stage.target_chain)
+        self.stages = stages
+        self.preserve_order = preserve_order
+
+    def keeps_state(self):
+        return any(stage.keeps_state() for stage in self.stages)
+
+    def __repr__(self):
+        return "staged({})".format(", ".join(stage_name(stage) for stage in self.stages))
+
+    def _queue_between(self, writer, reader, maxsize):
+        # Processes on either side need a multiprocessing queue
+        for stage in (reader, writer):
+            if isinstance(stage, parallel):
+                return (stage.data_queue_class or stage.queue_class)(maxsize)
+        return ThreadingQueue(maxsize)
+
+    def _queue_stats(self, our, name):
+        instrumentation = instrumentation_of(our)
+        if instrumentation is None:
+            return None
+        return instrumentation.queue((id(self), name), stage_name(self) + " / " + name)
+
+    def transform(self, our, precords):
+        stages = self.stages
+        num_stages = len(stages)
+        process_stages = [stage for stage in stages if isinstance(stage, parallel)]
+        if process_stages:
+            ctl_out_q, cancel = process_stages[0].queue_class(0), process_stages[0].event_class()
+        else:
+            ctl_out_q, cancel = ThreadingQueue(0), Event()
+        # stage_qs[k] feeds stages[k], and the last one this thread
+        stage_qs = [
+            self._queue_between(
+                stages[k - 1] if k > 0 else None,
+                stages[k] if k < num_stages else None,
+                stages[min(k, num_stages - 1)].queue_size,
+            )
+            for k in range(num_stages + 1)
+        ]
+
+        stage_workers, processes = [], []
+        for stage_index, stage in enumerate(stages):
+            # Outputs are chunked the way the next stage takes them
+            next_stage = stages[stage_index + 1] if stage_index + 1 < num_stages else stage
+            workers = []
+            for index in range(stage.num_workers):
+                workers.append(
+                    Worker(
+                        index=(stage_index, index),
+                        chunk_size=next_stage.chunk_size,
+                        ignore_error=stage.ignore_error,
+                        error_logger=stage.error_logger,
+                        target_chain=stage.target_chain,
+                        name="Stage[{}].{}".format(stage_index, stage.get_worker_name(index)),
+                        our=our,
+                        in_q=stage_qs[stage_index],
+                        out_q=stage_qs[stage_index + 1],
+                        cancel=cancel,
+                        ctl_out_q=ctl_out_q,
+                        preserve_order=self.preserve_order,
+                        send_sentinel=False,
+                        close_out_q=isinstance(stage, parallel),
+                    )
+                )
+            stage_workers.append(workers)
+        for stage, workers in zip(stages, stage_workers):
+            for worker in workers:
+                process = stage.process_class(target=worker.run, daemon=True)
+                process.start()
+                processes.append(process)
+
+        coordinator = StageCoordinator(self, our, stage_workers, stage_qs, ctl_out_q, cancel)
+        coordinator.start()
+
+        window = None
+        if self.preserve_order:
+            window = Semaphore(sum(stage.queue_size + stage.num_workers for stage in stages) + stages[-1].queue_size)
+        chunk_stats = None
+        instrumentation = instrumentation_of(our)
+        if instrumentation is not None:
+            chunk_stats = instrumentation.chunk((id(self), 'chunks'), stage_name(self) + " / chunks")
+        producer = ProducerThread(
+            stages[0].chunk_size,
+            stage_qs[0],
+            cancel,
+            precords,
+            stage_workers[0],
+            self._queue_stats(our, 'in_q'),
+            tracer_of(our),
+            window,
+            None,
+            chunk_stats,
+        )
+        producer.start()
+
+        out_q = stage_qs[-1]
+        completed = False
+        try:
+            chunks = self._consume(our, out_q)
+            if window is not None:
+                chunks = _reorder(chunks, window)
+            for precord_chunk in chunks:
+                yield from precord_chunk
+            completed = True
+        finally:
+            if not completed:
+                cancel.set()
+                if window is not None:
+                    window.release()
+                # Stages wind down in order. The coordinator sends the last sentinel once all are done.
+                while out_q.get() is not None:
+                    pass
+            producer.join()
+            coordinator.join()
+            for process in processes:
+                process.join()
+            close_queues(ctl_out_q, *stage_qs)
+
+        for exc in (producer.raised_exception, coordinator.raised_exception):
+            if exc is not None:
+                raise exc
+
+    def _consume(self, our, out_q):
+        out_q_stats = self._queue_stats(our, 'out_q')
+        while True:
+            begin = time.perf_counter()
+            precord_chunk = out_q.get()
+            if out_q_stats is not None:
+                out_q_stats.record_get(out_q, time.perf_counter() - begin)
+            if precord_chunk is None:
+                break
+            yield precord_chunk
+
+
 __all__ = (
     'threaded', 'parallel',
     'on_bg_thread', 'on_bg_process',
+    'staged',
 )
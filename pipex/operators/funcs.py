@@ -1,12 +1,72 @@
 import random
+import numpy as np
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
 from ..pbase import pipex_hash
-from ..pdatastructures import PRecord
-from ..poperators import pipe, pipe_map, sink
+from ..pdatastructures import PRecord, PRecordBatch
+from ..poperators import pipe, pipe_map, pipe_batch, sink
 
-from typing import Iterator
+from typing import Callable, Iterable, Iterator, Optional
 from itertools import islice
 
+def _islice_closing(precords, *args):
+    # Closes upstream once the slice is over, so that its workers and files are released
+    # at once rather than when the whole pipeline is torn down
+    it = iter(precords)
+    try:
+        yield from islice(it, *args)
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+
+
+def _thread_map(fn: Callable, items: Iterable, num_workers: int, ordered: bool, in_flight: int, name: str) -> Iterator:
+    # Like ThreadPoolExecutor.map, but with at most `in_flight` items submitted ahead of the consumer
+    # and results yielded as they complete unless `ordered`
+    executor = ThreadPoolExecutor(num_workers, thread_name_prefix=name)
+    it = iter(items)
+    if ordered:
+        pending = deque()
+    else:
+        pending = set()
+        completed = Queue()
+    try:
+        if ordered:
+            for item in it:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        else:
+            for item in it:
+                future = executor.submit(fn, item)
+                pending.add(future)
+                future.add_done_callback(completed.put)
+                if len(pending) >= in_flight:
+                    future = completed.get()
+                    pending.discard(future)
+                    yield future.result()
+            while pending:
+                future = completed.get()
+                pending.discard(future)
+                yield future.result()
+    finally:
+        # Reached on errors and early termination too. Futures not started yet are dropped.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+
+
+_DROPPED = object()
+
 class done(sink):
     def save(self, precord):
         pass
@@ -40,6 +100,9 @@ class preload(pipe):
     def __init__(self, size=None):
         self.size = size
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
         if self.size is None:
             yield from list(precords)
@@ -67,6 +130,9 @@ class batch(pipe):
     def __init__(self, batch_size: int):
         self.batch_size = batch_size
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
         while True:
             mini_batch = list(islice(precords, self.batch_size))
@@ -83,10 +149,18 @@ class unbatch(pipe):
 
 
 class base_curriable(pipe_map):
-    def __init__(self, fn, *args, **kwargs):
+    # With `workers`, fn runs on a thread pool of that size, for functions
+    # that wait on I/O or release the GIL. At most `in_flight` records (2 * workers by default)
+    # are taken from upstream ahead of the results. `ordered=False` yields them as they complete.
+    def __init__(self, fn, *args, workers: Optional[int] = None, ordered: bool = True, in_flight: Optional[int] = None, **kwargs):
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        if workers is not None and workers < 1:
+            raise ValueError("workers should be positive, got {!r}".format(workers))
+        self.workers = workers
+        self.ordered = ordered
+        self.in_flight = max(in_flight or 2 * (workers or 1), 1)
 
         try:
            self.arg_position = list(args).index(...)
@@ -96,7 +170,14 @@ class base_curriable(pipe_map):
         self._curried_fn = self._curried()
 
     def chain_hash(self):
-        return self.fn.__module__ + "." + self.fn.__name__ + pipex_hash("args", self.args, self.kwargs)
+        h = self.fn.__module__ + "." + self.fn.__name__ + pipex_hash("args", self.args, self.kwargs)
+        if self.workers is not None and not self.ordered:
+            # Records come out in another order. workers and in_flight change nothing downstream can see.
+            h += pipex_hash("unordered")
+        return h
+
+    def __repr__(self):
+        return "{}({})".format(super().__repr__(), getattr(self.fn, '__name__', repr(self.fn)))
 
     def _curried(self):
         if self.arg_position == 0:
@@ -112,6 +193,31 @@ class base_curriable(pipe_map):
         my_args.insert(self.arg_position, x)
         return self.fn(*my_args, **self.kwargs)
 
+    def fusible_steps(self):
+        if self.workers is not None or getattr(self.transform, '__func__', None) is not base_curriable.__dict__['transform']:
+            return None
+        return self._map_steps()
+
+    def _thread_map(self, fn: Callable, items: Iterable) -> Iterator:
+        return _thread_map(fn, items, self.workers, self.ordered, self.in_flight, repr(self))
+
+    def _transform_one(self, precord: PRecord):
+        # What transform does to one record, run by the thread pool. Returns _DROPPED for filtered out records.
+        value = precord.value
+        if not self.filter(value):
+            return _DROPPED
+        return precord.with_value(self.map(value))
+
+    def _transform_in_threads(self, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        for precord in self._thread_map(self._transform_one, precords):
+            if precord is not _DROPPED:
+                yield precord
+
+    def transform(self, our, precords):
+        if self.workers is not None:
+            return self._transform_in_threads(precords)
+        return super().transform(our, precords)
+
 class tap(base_curriable):
     def map(self, value):
         self._curried_fn(value)
@@ -122,13 +228,25 @@ class map(base_curriable):
         return self._curried_fn(value)
 
 class map_precord(base_curriable):
+    def _transform_one(self, precord):
+        return self._curried_fn(precord)
+
     def transform(self, our, precords):
+        if self.workers is not None:
+            yield from self._transform_in_threads(precords)
+            return
         for precord in precords:
             yield self._curried_fn(precord)
 
 
 class filter_precord(base_curriable):
+    def _transform_one(self, precord):
+        return precord if self._curried_fn(precord) else _DROPPED
+
     def transform(self, our, precords):
+        if self.workers is not None:
+            yield from self._transform_in_threads(precords)
+            return
         for precord in precords:
             if self._curried_fn(precord):
                 yield precord
@@ -139,13 +257,65 @@ class channel_map(base_curriable):
         super().__init__(fn, *args, **kwargs)
         self.channel_name = channel_name
 
+    def _transform_one(self, precord):
+        return precord.merge(**{self.channel_name: self._curried_fn(precord.value)})
+
     def transform(self, our, precords):
+        if self.workers is not None:
+            yield from self._transform_in_threads(precords)
+            return
         for precord in precords:
             value = precord.value
             new_value = self._curried_fn(value)
             yield precord.merge(**{self.channel_name: new_value})
 
 
+class map_batch(pipe_batch, base_curriable):
+    # Calls fn once per PRecordBatch of `batch_size` records with the stacked values
+    # of the active channel (or the only channel in `channels`), or with a dict of
+    # stacked arrays keyed by channel name if several channels are given.
+    # fn returns an array with one row per record, or a dict of them keyed by channel name.
+    def __init__(self, fn, batch_size: int, *args, channels=None, **kwargs):
+        super().__init__(fn, *args, **kwargs)
+        if isinstance(channels, str):
+            channels = (channels, )
+        self.batch_size = batch_size
+        self.channels = tuple(channels) if channels is not None else None
+
+    def chain_hash(self):
+        # fn may depend on which records share a batch (normalization, padding)
+        return super().chain_hash() + pipex_hash("map_batch", self.channels, self.batch_size)
+
+    def _stack(self, batch: PRecordBatch):
+        channels = self.channels
+        if channels is None:
+            return batch.stacked_value()
+        elif len(channels) == 1:
+            return batch.stacked(channels[0])
+        else:
+            return {
+                channel_name: batch.stacked(channel_name)
+                for channel_name in channels
+            }
+
+    def transform_batches(self, our, batches):
+        if self.workers is not None:
+            # Whole batches go to the thread pool
+            return self._thread_map(partial(self.transform_batch, our), batches)
+        return super().transform_batches(our, batches)
+
+    def transform_batch(self, our, batch: PRecordBatch) -> PRecordBatch:
+        result = self._curried_fn(self._stack(batch))
+        if isinstance(result, dict):
+            for channel_name, rows in result.items():
+                batch = batch.with_column(channel_name, rows)
+            return batch
+        elif self.channels is None:
+            return batch.with_value(result)
+        else:
+            return batch.with_column(self.channels[0], result)
+
+
 class filter(base_curriable):
     def filter(self, value):
         return self._curried_fn(value)
@@ -154,8 +324,11 @@ class slice(pipe):
     def __init__(self, *args):
         self.args = args
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
-        return islice(precords, *self.args)
+        return _islice_closing(precords, *self.args)
 
 
 class grep(pipe_map):
@@ -170,14 +343,20 @@ class take(pipe):
     def __init__(self, n):
         self.n = n
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
-        return islice(precords, self.n)
+        return _islice_closing(precords, self.n)
 
 
 class drop(pipe):
     def __init__(self, n):
         self.n = n
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
         n = self.n
         for i, precord in enumerate(precords):
@@ -189,6 +368,9 @@ class shuffle(pipe):
     def __init__(self, window_size=None):
         self.window_size = window_size
 
+    def keeps_state(self):
+        return True
+
     def transform(self, our, precords):
         if self.window_size is None:
             window = list(precords)
@@ -212,9 +394,12 @@ class select_channels(pipe):
         for precord in precords:
             yield precord.select_channels(channel_set)
 
+    def leading_channel_projection(self):
+        return self._channel_set
+
 __all__ = (
     'done', 'constant', 'tap', 'channel', 'dup', 'preload',
     'batch', 'unbatch', 'base_curriable',
-    'map', 'map_precord', 'channel_map', 'filter', 'filter_precord',
+    'map', 'map_precord', 'channel_map', 'map_batch', 'filter', 'filter_precord',
     'slice', 'grep', 'take', 'drop', 'shuffle', 'select_channels',
 )
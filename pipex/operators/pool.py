@@ -0,0 +1,293 @@
+import pickle
+import logging
+import threading
+
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha1
+from multiprocessing import cpu_count, get_context
+from queue import Queue as ThreadingQueue, Empty, Full
+from threading import Thread, Event, Lock
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from .concurrency import CancelFlag, Worker, close_queues
+
+
+_worker_local = threading.local()
+
+
+def get_worker_state() -> Dict[str, Any]:
+    '''
+    A dict private to the current pool worker, kept across runs.
+    Initializers put what is expensive to load (models, lookup tables) here.
+    '''
+    try:
+        return _worker_local.state
+    except AttributeError:
+        state = _worker_local.state = {}
+        return state
+
+
+def _pool_worker_main(index, initializer, initargs, job_q, ack_q, in_q, out_q, cancel, ctl_out_q, max_cached_chains):
+    logger = logging.getLogger("PoolWorker[{}]".format(index))
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+    except Exception as exc:
+        logger.exception("Initializer failed")
+        ack_q.put((index, exc))
+        return
+    ack_q.put((index, None))
+
+    chains = OrderedDict()
+    while True:
+        job = job_q.get()
+        if job is None:
+            break
+        elif job == 'ping':
+            ack_q.put((index, None))
+            continue
+        chain_key, chain, our, options = job
+        if chain_key is not None:
+            # Processes receive the chain pickled, and unpickle each distinct one only once
+            try:
+                target_chain = chains[chain_key]
+                chains.move_to_end(chain_key)
+            except KeyError:
+                target_chain = chains[chain_key] = pickle.loads(chain)
+                if len(chains) > max_cached_chains:
+                    chains.popitem(last=False)
+        else:
+            target_chain = chain
+        worker = Worker(
+            index=index,
+            our=our,
+            target_chain=target_chain,
+            in_q=in_q,
+            out_q=out_q,
+            cancel=cancel,
+            ctl_out_q=ctl_out_q,
+            **options
+        )
+        try:
+            worker.run()
+        except Exception:
+            # Already reported to the parent through ctl_out_q
+            pass
+        ack_q.put((index, None))
+
+
+class WorkerPool:
+    '''
+    Long-lived workers for threaded/parallel stages, reused across runs through their `pool` argument.
+
+    Workers start on warm_up() or the first run, run `initializer(*initargs)` once, and keep
+    the chains they received unpickled. The pool runs one stage at a time; a run waits
+    for the previous one to finish. Two stages of the same pipeline, or a stage running on
+    the pool's own worker threads, would wait for each other forever, so they raise a RuntimeError instead.
+    A run whose teardown is interrupted restarts worker processes, since their queues may be left with stale chunks.
+    '''
+    def __init__(self,
+                 num_workers: Optional[int] = None,
+                 use_processes: bool = True,
+                 start_method: str = 'spawn',
+                 initializer: Optional[Callable] = None,
+                 initargs: Sequence = (),
+                 name: Optional[str] = None,
+                 queue_size: int = 20,
+                 max_cached_chains: int = 8):
+        self.num_workers = num_workers or cpu_count()
+        self.use_processes = use_processes
+        self.start_method = start_method
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.name = name or "WorkerPool"
+        self.queue_size = queue_size
+        self.max_cached_chains = max_cached_chains
+
+        if use_processes:
+            ctx = get_context(start_method)
+            self.queue_class, self.process_class, self.event_class = ctx.Queue, ctx.Process, partial(CancelFlag, ctx)
+        else:
+            self.queue_class, self.process_class, self.event_class = ThreadingQueue, Thread, Event
+        self._lock = Lock()
+        self._started = False
+        self._running_our = None  # the execution context of the stage running on the pool
+
+    def __repr__(self):
+        return "<WorkerPool name={!r} num_workers={!r} use_processes={!r}>".format(
+            self.name, self.num_workers, self.use_processes,
+        )
+
+    def __enter__(self):
+        self.warm_up()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def get_worker_name(self, index: int) -> str:
+        return "{}[{}]".format(self.name, index)
+
+    def _start(self):
+        queue_class = self.queue_class
+        self.in_q, self.out_q = queue_class(self.queue_size), queue_class(self.queue_size)
+        self.cancel, self.ctl_out_q = self.event_class(), queue_class(0)
+        self.ack_q = queue_class(0)
+        self.job_qs = [queue_class(0) for _ in range(self.num_workers)]
+        self.processes = []
+        for index, job_q in enumerate(self.job_qs):
+            process = self.process_class(
+                target=_pool_worker_main,
+                args=(
+                    index, self.initializer, self.initargs, job_q, self.ack_q,
+                    self.in_q, self.out_q, self.cancel, self.ctl_out_q,
+                    self.max_cached_chains,
+                ),
+                name=self.get_worker_name(index),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self._started = True
+        self._wait_acks()
+
+    def _wait_acks(self):
+        errors = []
+        for _ in range(self.num_workers):
+            index, exc = self.ack_q.get()
+            if exc is not None:
+                errors.append(exc)
+        if errors:
+            self._stop(terminate=True)
+            raise errors[0]
+
+    def warm_up(self):
+        # Starts the workers and waits until each of them has run its initializer
+        with self._lock:
+            if not self._started:
+                self._start()
+            else:
+                for job_q in self.job_qs:
+                    job_q.put('ping')
+                self._wait_acks()
+
+    def shutdown(self):
+        with self._lock:
+            if self._started:
+                self._stop(terminate=False)
+
+    def _stop(self, terminate: bool):
+        if terminate and self.use_processes:
+            for process in self.processes:
+                process.terminate()
+        else:
+            for job_q in self.job_qs:
+                job_q.put(None)
+        for process in self.processes:
+            process.join()
+        close_queues(self.in_q, self.out_q, self.ctl_out_q, self.ack_q, *self.job_qs)
+        self._started = False
+
+    def _chain_payload(self, target_chain):
+        if not self.use_processes:
+            return None, target_chain
+        payload = pickle.dumps(target_chain)
+        return sha1(payload).hexdigest(), payload
+
+    def _recover(self):
+        # The teardown of the last run was interrupted
+        if self.use_processes:
+            # A worker may have been stopped amid a queue operation; start afresh
+            self._stop(terminate=True)
+            self._start()
+            return
+        # Threads go back to their job queues once cancelled. Keep them fed with sentinels
+        # and their outputs drained meanwhile.
+        self.cancel.set()
+        num_acks = 0
+        while num_acks < self.num_workers:
+            for q in (self.out_q, self.ctl_out_q):
+                try:
+                    while True:
+                        q.get_nowait()
+                except Empty:
+                    pass
+            try:
+                self.in_q.put_nowait(None)
+            except Full:
+                pass
+            try:
+                self.ack_q.get(timeout=0.05)
+                num_acks += 1
+            except Empty:
+                pass
+        for q in (self.in_q, self.out_q, self.ctl_out_q):
+            try:
+                while True:
+                    q.get_nowait()
+            except Empty:
+                pass
+
+    def _check_reentry(self, our):
+        if self._running_our is our and our is not None:
+            raise RuntimeError(
+                "{!r} is already running another stage of this pipeline. Give each stage a pool of its own."
+                .format(self)
+            )
+        if not self.use_processes and self._started and threading.current_thread() in self.processes:
+            raise RuntimeError("{!r} cannot run a stage on its own workers".format(self))
+
+    def run(self, fork_join, our, precords):
+        self._check_reentry(our)
+        with self._lock:
+            self._running_our = our
+            try:
+                yield from self._run(fork_join, our, precords)
+            finally:
+                self._running_our = None
+
+    def _run(self, fork_join, our, precords):
+        if not self._started:
+            self._start()
+        chain_key, chain = self._chain_payload(fork_join.target_chain)
+        # Workers are all idle between runs
+        self.cancel.clear()
+        workers = []
+        for index, job_q in enumerate(self.job_qs):
+            options = dict(
+                chunk_size=fork_join.chunk_size,
+                ignore_error=fork_join.ignore_error,
+                error_logger=fork_join.error_logger,
+                name=self.get_worker_name(index),
+                preserve_order=fork_join.preserve_order,
+                report_timing=fork_join.adaptive_chunk_size,
+            )
+            job_q.put((chain_key, chain, our, options))
+            # Stands for the pooled worker on the consumer side
+            workers.append(
+                Worker(
+                    index=index, our=our, target_chain=fork_join.target_chain,
+                    in_q=None, out_q=None, cancel=None, ctl_out_q=None,
+                    **options
+                )
+            )
+
+        def finish(clean):
+            if clean:
+                # Consume the acks of a finished run
+                for _ in range(self.num_workers):
+                    self.ack_q.get()
+            else:
+                self._recover()
+
+        yield from fork_join._fork_join(
+            our, precords, workers,
+            self.in_q, self.out_q, self.cancel, self.ctl_out_q,
+            None, finish,
+        )
+
+
+__all__ = (
+    'WorkerPool', 'get_worker_state',
+)
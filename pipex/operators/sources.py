@@ -12,10 +12,10 @@ class merge(source):
         its = [pipe_chain.execute(our) for pipe_chain in self.pipe_chains]
         for precords in zip(*its):
             result = precords[0]
-            channel_atoms = result.channel_atoms.copy()
+            channel_atoms = result.channel_atoms
 
             for precord in precords[1:]:
-                channel_atoms.update(precord.channel_atoms)
+                channel_atoms = channel_atoms.with_items(precord.channel_atoms)
             yield PRecord(
                 id=result.id,
                 active_channel=result.active_channel,
@@ -1,18 +1,90 @@
 import inspect
+import numpy as np
 
-from .pdatastructures import PRecord
+from .pdatastructures import PRecord, PRecordBatch
+from .pinstrument import Instrumentation, Tracer, stage_name
 from functools import reduce
-from typing import List, Iterator, Any, cast, Union, Optional
+from typing import List, Iterator, Any, cast, Union, Optional, Tuple, Callable, AbstractSet, Dict
 
 from hashlib import sha1
 
+CHAIN_HASH_MEMO = '_chain_hash_memo'
+
+_HASHERS = {}  # type: Dict[type, Callable[[Any], str]]
+
+
+def register_hasher(cls: type, hasher: Callable[[Any], str]):
+    '''
+    Register how arguments of the given type (and its subclasses) are digested into chain hashes,
+    instead of hashing their str().
+    '''
+    _HASHERS[cls] = hasher
+
+
+def _find_hasher(obj: Any) -> Optional[Callable[[Any], str]]:
+    for cls in type(obj).__mro__:
+        hasher = _HASHERS.get(cls)
+        if hasher is not None:
+            return hasher
+    return None
+
+
+def memoized_chain_hash(chain: "PipeChain") -> str:
+    # Chains are immutable, so the hash is computed once per node
+    memo = getattr(chain, '__dict__', None)
+    if type(memo) is not dict:
+        return chain.chain_hash()
+    try:
+        return memo[CHAIN_HASH_MEMO]
+    except KeyError:
+        value = memo[CHAIN_HASH_MEMO] = chain.chain_hash()
+        return value
+
+
 def _ensure_hash(obj: Any):
     if hasattr(obj, "chain_hash"):
-        return obj.chain_hash()
+        return memoized_chain_hash(obj)
     elif inspect.isfunction(obj):
         return obj.__module__ + '.' + obj.__name__
-    else:
-        return str(obj)
+    hasher = _find_hasher(obj)
+    if hasher is not None:
+        return hasher(obj)
+    return str(obj)
+
+
+def _digest(type: str, segments: Iterator[str]) -> str:
+    h = sha1(type.encode())
+    for segment in segments:
+        h.update(b"\0")
+        h.update(segment.encode())
+    return h.hexdigest()
+
+
+def _hash_ndarray(array: np.ndarray) -> str:
+    if array.dtype.hasobject:
+        return _digest("ndarray[object]" + str(array.shape), (_ensure_hash(item) for item in array.flat))
+    h = sha1("ndarray{}{}".format(array.dtype.str, array.shape).encode())
+    h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+
+def _hash_buffer(buffer) -> str:
+    h = sha1(b"bytes")
+    h.update(buffer)
+    return h.hexdigest()
+
+
+register_hasher(np.ndarray, _hash_ndarray)
+register_hasher(bytes, _hash_buffer)
+register_hasher(bytearray, _hash_buffer)
+register_hasher(memoryview, _hash_buffer)
+register_hasher(tuple, lambda items: _digest("tuple", (_ensure_hash(item) for item in items)))
+register_hasher(list, lambda items: _digest("list", (_ensure_hash(item) for item in items)))
+register_hasher(dict, lambda mapping: _digest("dict", sorted(
+    _ensure_hash(key) + ":" + _ensure_hash(value) for key, value in mapping.items()
+)))
+register_hasher(set, lambda items: _digest("set", sorted(_ensure_hash(item) for item in items)))
+register_hasher(frozenset, lambda items: _digest("set", sorted(_ensure_hash(item) for item in items)))
 
 def pipex_hash(type: str, *args: "PipeChain") -> str:
     text = "".join([type, *[_ensure_hash(arg) for arg in args]])
@@ -20,10 +92,38 @@ def pipex_hash(type: str, *args: "PipeChain") -> str:
 
 
 class We:
+    def __init__(self, *, instrumentation: Optional[Instrumentation] = None):
+        self.instrumentation = instrumentation
+
     @classmethod
     def default_value(cls) -> "We":
         return cls()
 
+    @classmethod
+    def instrumented(cls,
+                     track_bytes: bool = False,
+                     auto_report: bool = True,
+                     trace_path: Optional[str] = None) -> "We":
+        return cls(instrumentation=Instrumentation(track_bytes, auto_report, trace_path=trace_path))
+
+    def child(self) -> "We":
+        # context for a worker running part of the chain on its own
+        instrumentation = self.instrumentation
+        return We(
+            instrumentation=instrumentation.child() if instrumentation is not None else None,
+        )
+
+
+def instrumentation_of(our: Optional[We]) -> Optional[Instrumentation]:
+    return getattr(our, 'instrumentation', None)
+
+
+def tracer_of(our: Optional[We]) -> Optional[Tracer]:
+    instrumentation = getattr(our, 'instrumentation', None)
+    if instrumentation is None:
+        return None
+    return instrumentation.tracer
+
 
 class SourceDataVersion:
     def __init__(self, *, data_hash: Optional[str] = None):
@@ -85,9 +185,14 @@ class PipeChain:
     def rewriting_required(self, our) -> bool:
         return False
 
-    def do(self):
-        for _ in self.execute(We.default_value()):
+    def do(self, our: Optional[We] = None) -> We:
+        our = our or We.default_value()
+        for _ in self.execute(our):
             pass
+        instrumentation = our.instrumentation
+        if instrumentation is not None:
+            instrumentation.finish()
+        return our
 
     def flatten_chains(self, results: List[Union["PipeChain", str]]):
         results.append(self)
@@ -223,6 +328,23 @@ class Source(PipeChain):
     def fetch_source_data_version(self, our: We) -> SourceDataVersion:
         return SourceDataVersion()
 
+    def project_channels(self, channels: AbstractSet[str]) -> Optional["Source"]:
+        # A source generating only `channels` of each record, if this source
+        # can skip reading the others. None otherwise.
+        return None
+
+    def record_fingerprint(self, precord: PRecord) -> str:
+        # Changes whenever the record generated under the same id changes.
+        # Sources that can tell it without reading the values should override this.
+        channel_atoms = precord.channel_atoms
+        return _digest(
+            "PRecord",
+            [precord.id, str(precord.active_channel)] + [
+                name + "=" + _ensure_hash(channel_atoms[name].value)
+                for name in sorted(channel_atoms)
+            ],
+        )
+
 
 class Transformer(PipeChain):
     def transform(self, our: We, precords: Iterator[PRecord]) -> Iterator[PRecord]:
@@ -231,6 +353,29 @@ class Transformer(PipeChain):
     def execute(self, our: We) -> Iterator[PRecord]:
         return iter(())
 
+    def fusible_steps(self) -> Optional[Tuple[Optional[Callable], Optional[Callable]]]:
+        # (filter, map) pair of a stage that only rewrites the active value.
+        # None for either side means "keep everything"/"identity".
+        # Stages returning None here cannot be fused.
+        return None
+
+    def leading_channel_projection(self) -> Optional[AbstractSet[str]]:
+        # Channels this transformer selects before looking at records, if any.
+        # Used to push the projection down to sources.
+        return None
+
+    def preferred_batch_size(self) -> Optional[int]:
+        # Stages opting in to columnar processing return their batch size
+        # and implement transform_batches.
+        return None
+
+    def transform_batches(self, our: We, batches: Iterator[PRecordBatch]) -> Iterator[PRecordBatch]:
+        raise NotImplementedError
+
+    def keeps_state(self) -> bool:
+        # Whether outputs depend on the records seen before (counting, batching, buffering).
+        # Such stages give other results if restarted partway, e.g. once per chunk.
+        return False
 
     def wrap_transformer(self, other: "Transformer") -> "Transformer":
         self_is_seq, other_is_seq = isinstance(self, TransformerSequence), isinstance(other, TransformerSequence)
@@ -253,17 +398,152 @@ class Transformer(PipeChain):
             return TransformerSequence([self, other])
 
 
+class FusedMapTransformer(Transformer):
+    # Runs consecutive value-wise stages as a single loop, building
+    # one output PRecord per record instead of one per stage.
+    def __init__(self, transformers: List[Transformer], steps):
+        self.transformers = transformers
+        self.steps = steps
+
+    def transform(self, our: We, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        steps = self.steps
+        for precord in precords:
+            value = precord.value
+            for filter_fn, map_fn in steps:
+                if filter_fn is not None and not filter_fn(value):
+                    break
+                if map_fn is not None:
+                    value = map_fn(value)
+            else:
+                yield precord.with_value(value)
+
+    def chain_hash(self):
+        return pipex_hash("TransformerSequence", *self.transformers)
+
+    def __repr__(self):
+        return " | ".join(repr(transformer) for transformer in self.transformers)
+
+
+class BatchedTransformer(Transformer):
+    # Runs consecutive batch stages of the same batch size on PRecordBatches,
+    # converting from/to per-record streams only at both ends.
+    def __init__(self, transformers: List[Transformer]):
+        self.transformers = transformers
+
+    def transform(self, our: We, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        batch_size = self.transformers[0].preferred_batch_size()
+        batches = reduce(
+            lambda bs, transformer: transformer.transform_batches(our, bs),
+            self.transformers,
+            PRecordBatch.batches(precords, batch_size),
+        )
+        for batch in batches:
+            yield from batch.to_precords()
+
+    def preferred_batch_size(self) -> Optional[int]:
+        return self.transformers[0].preferred_batch_size()
+
+    def transform_batches(self, our: We, batches: Iterator[PRecordBatch]) -> Iterator[PRecordBatch]:
+        return reduce(
+            lambda bs, transformer: transformer.transform_batches(our, bs),
+            self.transformers,
+            batches,
+        )
+
+    def keeps_state(self) -> bool:
+        return any(transformer.keeps_state() for transformer in self.transformers)
+
+    def chain_hash(self):
+        return pipex_hash("TransformerSequence", *self.transformers)
+
+    def __repr__(self):
+        return " | ".join(repr(transformer) for transformer in self.transformers)
+
+
+def _fuse_transformers(transformers: List[Transformer]) -> List[Transformer]:
+    stages = []  # type: List[Transformer]
+    run = []  # type: List[Tuple[Transformer, Any]]
+
+    def flush_run():
+        if len(run) > 1:
+            stages.append(FusedMapTransformer(
+                [tr for tr, _ in run],
+                [steps for _, steps in run],
+            ))
+        elif run:
+            stages.append(run[0][0])
+        run.clear()
+
+    for transformer in transformers:
+        steps = transformer.fusible_steps()
+        if steps is not None:
+            run.append((transformer, steps))
+        else:
+            flush_run()
+            stages.append(transformer)
+    flush_run()
+    return _batch_transformers(stages)
+
+
+def _batch_transformers(transformers: List[Transformer]) -> List[Transformer]:
+    # Only stages of the same batch size share their batches
+    stages = []  # type: List[Transformer]
+    run = []  # type: List[Transformer]
+    for transformer in transformers + [None]:
+        batch_size = transformer.preferred_batch_size() if transformer is not None else None
+        if batch_size is not None and (not run or run[0].preferred_batch_size() == batch_size):
+            run.append(transformer)
+            continue
+        if len(run) > 1:
+            stages.append(BatchedTransformer(run))
+        else:
+            stages.extend(run)
+        run = []
+        if batch_size is not None:
+            run.append(transformer)
+        elif transformer is not None:
+            stages.append(transformer)
+    return stages
+
+
 class TransformerSequence(Transformer):
     def __init__(self, transformers: List[Transformer] = None):
         self.transformers = transformers or []
+        self._stages = None  # type: Optional[List[Transformer]]
+
+    @property
+    def stages(self) -> List[Transformer]:
+        # transformers as they are actually run, with fusible runs compiled
+        stages = self._stages
+        if stages is None:
+            stages = self._stages = _fuse_transformers(self.transformers)
+        return stages
 
     def transform(self, our: We, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        instrumentation = instrumentation_of(our)
+        if instrumentation is not None:
+            # Measure every transformer on its own rather than the fused stages
+            for index, transformer in enumerate(self.transformers):
+                precords = instrumentation.instrument(
+                    (id(self), index),
+                    stage_name(transformer),
+                    transformer.transform(our, precords),
+                )
+            return precords
         return reduce(
             lambda prs, transformer: transformer.transform(our, prs),
-            self.transformers,
+            self.stages,
             precords
         )
 
+    def leading_channel_projection(self) -> Optional[AbstractSet[str]]:
+        if not self.transformers:
+            return None
+        return self.transformers[0].leading_channel_projection()
+
+    def keeps_state(self) -> bool:
+        return any(transformer.keeps_state() for transformer in self.transformers)
+
     def flatten_chains(self, results: List[Union["PipeChain", str]]):
         for i, tr in enumerate(self.transformers):
             if i > 0:
@@ -378,11 +658,42 @@ class TransformedSource(Source):
     def with_sink(self, sink: Sink) -> "Pipeline":
         return Pipeline(self, sink)
 
+    def _projected_source(self) -> Source:
+        # Let sources skip channels the transformer drops right away
+        channels = self.transformer.leading_channel_projection()
+        if channels is not None:
+            projected = self.source.project_channels(channels)
+            if projected is not None:
+                return projected
+        return self.source
+
+    def _transform(self, our: We, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        transformer = self.transformer
+        instrumentation = instrumentation_of(our)
+        if instrumentation is None:
+            return transformer.transform(our, precords)
+
+        source = self.source
+        if not isinstance(source, (TransformedSource, TransformedSink, Pipeline)):
+            # composite sources measure their own stages
+            precords = instrumentation.instrument((id(self), 'source'), stage_name(source), precords)
+        if isinstance(transformer, (TransformerSequence, IdentityTransformer)):
+            return transformer.transform(our, precords)
+        return instrumentation.instrument(
+            (id(self), 'transformer'),
+            stage_name(transformer),
+            transformer.transform(our, precords),
+        )
+
     def generate_precords(self, our: We) -> Iterator[PRecord]:
-        return self.transformer.transform(our, self.source.generate_precords(our))
+        return self._transform(our, self._projected_source().generate_precords(our))
 
     def execute(self, our: We) -> Iterator[PRecord]:
-        return self.transformer.transform(our, self.source.execute(our))
+        return self._transform(our, self._projected_source().execute(our))
+
+    def execute_through(self, our: We, through: Callable[[Iterator[PRecord]], Iterator[PRecord]]) -> Iterator[PRecord]:
+        # execute(), with the records of the source passed through `through` before they are transformed
+        return self._transform(our, through(self._projected_source().execute(our)))
 
     def __repr__(self):
         return "{!r} >> ({!r})".format(self.source, self.transformer)
@@ -428,6 +739,13 @@ class Pipeline(Source):
         else:
             return super().fetch_source_data_version(our)
 
+    def record_fingerprint(self, precord: PRecord) -> str:
+        # Records come out of the sink, which may tell them apart without reading the values
+        if isinstance(self.sink, Source):
+            return self.sink.record_fingerprint(precord)
+        else:
+            return super().record_fingerprint(precord)
+
     def flatten_chains(self, results: List[Union["PipeChain", str]]):
         self.transformed_source.flatten_chains(results)
         results.append(">>")
@@ -436,7 +754,7 @@ class Pipeline(Source):
     def rewriting_required(self, our: We):
         sink_data_version = self.sink.fetch_sink_data_version(our)
         source_data_hash = self.source.fetch_source_data_version(our).data_hash
-        transformer_chain_hash = self.transformer.chain_hash()
+        transformer_chain_hash = memoized_chain_hash(self.transformer)
 
         direct_source_changed = (
             source_data_hash is None or
@@ -466,7 +784,15 @@ class Pipeline(Source):
         return self.transformed_source.generate_precords(our)
 
     def execute(self, our: We):
-        return self.sink.process(our, self.transformed_source)
+        precords = self.sink.process(our, self.transformed_source)
+        instrumentation = instrumentation_of(our)
+        if instrumentation is not None:
+            precords = instrumentation.instrument(
+                (id(self), 'sink'),
+                stage_name(self.sink) + " (sink)",
+                precords,
+            )
+        return precords
 
     @classmethod
     def direct_pipeline(cls, source: Source, sink: Sink):
@@ -1,9 +1,12 @@
 import time
+import pickle
 import numpy as np
 
 from PIL import Image
 from base64 import b64encode
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Iterator, Iterable, Union, Callable, Mapping as MappingType
+from itertools import islice
+from collections.abc import Mapping
 from html import escape
 
 id_func = id
@@ -91,11 +94,142 @@ def _infer_format_from_type(channel_name: str, value: Any) -> str:
 
 
 
+_UNLOADED = object()
+
+def _restore_atom(value, format):
+    return PAtom(value=value, format=format)
+
 class PAtom:
-    __slots__ = ('value', 'format', )
-    def __init__(self, *, value: Any, format: str):
-        self.value = value
+    # value can be deferred to a loader callback which is called only once, on first access
+    __slots__ = ('_value', 'format', '_loader')
+    def __init__(self, *, value: Any = None, format: str, loader: Optional[Callable[[], Any]] = None):
+        self._value = value if loader is None else _UNLOADED
         self.format = format
+        self._loader = loader
+
+    @property
+    def value(self):
+        value = self._value
+        if value is _UNLOADED:
+            value = self._value = self._loader()
+            self._loader = None
+        return value
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._value is not _UNLOADED
+
+    @classmethod
+    def lazy(cls, loader: Callable[[], Any], format: str) -> "PAtom":
+        return cls(format=format, loader=loader)
+
+    def __reduce__(self):
+        # loaders are usually bound to open storages. Ship the value itself instead.
+        return (_restore_atom, (self.value, self.format))
+
+class ChannelMap(Mapping):
+    # Immutable channel name -> PAtom mapping.
+    # New versions share `_base` and only copy the (small) dict of updates made on top of it,
+    # so deriving a record with a few changed channels costs O(changed) instead of O(channels).
+    # Updates are folded into a new base once there are more than MAX_UPDATES of them.
+    MAX_UPDATES = 8
+
+    __slots__ = ('_base', '_updates', '_num_added')
+    def __init__(self,
+                 base: Optional[Dict[str, PAtom]] = None,
+                 updates: Optional[Dict[str, PAtom]] = None,
+                 num_added: Optional[int] = None):
+        if base is None:
+            base = {}
+        if updates is None:
+            updates = {}
+        if num_added is None:
+            num_added = sum(1 for name in updates if name not in base)
+        self._base = base
+        self._updates = updates
+        self._num_added = num_added
+
+    def __getitem__(self, name: str) -> PAtom:
+        atom = self._updates.get(name)
+        if atom is None:
+            return self._base[name]
+        return atom
+
+    def get(self, name: str, default=None):
+        atom = self._updates.get(name)
+        if atom is None:
+            return self._base.get(name, default)
+        return atom
+
+    def __contains__(self, name):
+        return name in self._updates or name in self._base
+
+    def __len__(self):
+        return len(self._base) + self._num_added
+
+    def __iter__(self):
+        base = self._base
+        yield from base
+        for name in self._updates:
+            if name not in base:
+                yield name
+
+    def with_items(self, items: MappingType[str, PAtom]) -> "ChannelMap":
+        base, updates = self._base, self._updates
+        num_added = self._num_added
+        for name in items:
+            if name not in base and name not in updates:
+                num_added += 1
+        updates = updates.copy()
+        updates.update(items)
+        if len(updates) > self.MAX_UPDATES:
+            base = base.copy()
+            base.update(updates)
+            return ChannelMap(base, None, 0)
+        return ChannelMap(base, updates, num_added)
+
+    def with_item(self, name: str, atom: PAtom) -> "ChannelMap":
+        return self.with_items({name: atom})
+
+    def select(self, names) -> "ChannelMap":
+        return ChannelMap({
+            k: v
+            for k, v in self.items()
+            if k in names
+        }, None, 0)
+
+    def copy(self) -> Dict[str, PAtom]:
+        return dict(self.items())
+
+    def __reduce__(self):
+        return (ChannelMap, (self.copy(), ))
+
+    def __repr__(self):
+        return "ChannelMap({!r})".format(self.copy())
+
+
+# bytes values at least this large are pickled out-of-band with protocol 5
+OUT_OF_BAND_MIN_BYTES = 64 << 10
+
+class _OutOfBandBytes:
+    __slots__ = ('value', )
+    def __init__(self, value: bytes):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return (bytes, (pickle.PickleBuffer(self.value), ))
+
+def _restore_precord(id, timestamp, active_channel, flat_atoms):
+    # flat_atoms is (name, value, format) triples laid out flat
+    base = {}
+    for index in range(0, len(flat_atoms), 3):
+        base[flat_atoms[index]] = PAtom(value=flat_atoms[index + 1], format=flat_atoms[index + 2])
+    return PRecord(
+        id=id,
+        timestamp=timestamp,
+        active_channel=active_channel,
+        channel_atoms=ChannelMap(base, None, 0),
+    )
 
 class PRecord:
     __slots__ = ('id', 'timestamp', 'active_channel', 'channel_atoms', '_value')
@@ -103,11 +237,13 @@ class PRecord:
                  id: str,
                  timestamp: float = None,
                  active_channel: str = 'default',
-                 channel_atoms: Dict[str, PAtom] = None):
+                 channel_atoms: MappingType[str, PAtom] = None):
         self.id = id
         self.timestamp = timestamp or time.time()
         self.active_channel = active_channel
-        self.channel_atoms = channel_atoms or {}
+        if not isinstance(channel_atoms, ChannelMap):
+            channel_atoms = ChannelMap(channel_atoms)
+        self.channel_atoms = channel_atoms
 
     @property
     def atom(self):
@@ -159,21 +295,18 @@ class PRecord:
         )
 
     def select_channels(self, channels) -> "PRecord":
-        channel_atoms = {
-            k: v
-            for k, v in self.channel_atoms.items()
-            if k in channels
-        }
         return PRecord(
             id=self.id,
             timestamp=self.timestamp,
             active_channel=self.active_channel,
-            channel_atoms=channel_atoms,
+            channel_atoms=self.channel_atoms.select(channels),
         )
 
     def with_channel_item(self, channel_name: str, value: Any) -> "PRecord":
-        channel_atoms = self.channel_atoms.copy()
-        channel_atoms[channel_name] = PAtom(value=value, format=_infer_format_from_type(channel_name, value))
+        channel_atoms = self.channel_atoms.with_item(
+            channel_name,
+            PAtom(value=value, format=_infer_format_from_type(channel_name, value)),
+        )
 
         return PRecord(
             id=self.id,
@@ -184,9 +317,10 @@ class PRecord:
 
 
     def merge(self, **kwargs) -> "PRecord":
-        channel_atoms = self.channel_atoms.copy()
-        for key, value in kwargs.items():
-            channel_atoms[key] = PAtom(value=value, format=_infer_format_from_type(key, value))
+        channel_atoms = self.channel_atoms.with_items({
+            key: PAtom(value=value, format=_infer_format_from_type(key, value))
+            for key, value in kwargs.items()
+        })
         return PRecord(
             id=self.id,
             timestamp=time.time(),
@@ -205,10 +339,9 @@ class PRecord:
 
     def with_value(self, value: Any):
         active_channel = self.active_channel
-        channel_atoms = self.channel_atoms.copy()
-        channel_atoms[active_channel] = PAtom(
-            value=value,
-            format=_infer_format_from_type(active_channel, value)
+        channel_atoms = self.channel_atoms.with_item(
+            active_channel,
+            PAtom(value=value, format=_infer_format_from_type(active_channel, value)),
         )
 
         return PRecord(
@@ -232,6 +365,16 @@ class PRecord:
             }
         )
 
+    def __reduce_ex__(self, protocol):
+        # One tuple for all channels, rather than a PAtom and a ChannelMap each with their own reduce
+        flat_atoms = []
+        for name, atom in self.channel_atoms.items():
+            value = atom.value
+            if protocol >= 5 and type(value) is bytes and len(value) >= OUT_OF_BAND_MIN_BYTES:
+                value = _OutOfBandBytes(value)
+            flat_atoms.extend((name, value, atom.format))
+        return (_restore_precord, (self.id, self.timestamp, self.active_channel, tuple(flat_atoms)))
+
     def __repr__(self):
         return ("<PRecord id={!r} timestamp={!r} active_channel={!r} channels={!r}>"
                 .format(
@@ -244,3 +387,245 @@ class PRecord:
 
     def _repr_html_(self):
         return _repr_html_(self)
+
+
+
+_MISSING = object()
+
+def _collapse_formats(formats: List[Optional[str]]) -> Union[str, List[Optional[str]]]:
+    # formats are aligned with rows, None for rows missing the channel
+    present = [format for format in formats if format is not None]
+    if all(format == present[0] for format in present[1:]):
+        return present[0] if present else 'data'
+    return formats
+
+class PColumn:
+    # kind is one of
+    #   'array': values is an ndarray whose rows are the channel values of each record
+    #   'scalar': values is a 1-d ndarray of python scalars
+    #   'list': values is a list (_MISSING for records without the channel)
+    #   'atoms': values is a list of PAtoms some of which are not loaded yet
+    __slots__ = ('values', 'format', 'kind')
+    def __init__(self, *, values, format: Union[str, List[str]], kind: str):
+        self.values = values
+        self.format = format
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.values)
+
+    def rows(self):
+        if self.kind == 'scalar':
+            return self.values.tolist()
+        return self.values
+
+    def resolved(self):
+        if self.kind == 'atoms':
+            return [
+                atom.value if atom is not _MISSING else _MISSING
+                for atom in self.values
+            ]
+        return self.values
+
+    def formats(self, length: int) -> List[Optional[str]]:
+        format = self.format
+        if isinstance(format, str):
+            return [format] * length
+        return format
+
+    def stacked(self) -> np.ndarray:
+        if self.kind in ('list', 'atoms'):
+            return np.stack(self.resolved())
+        return self.values
+
+    @classmethod
+    def from_values(cls, channel_name: str, values: List[Any], formats: Optional[List[str]] = None) -> "PColumn":
+        kind = 'list'
+        first = values[0] if values else None
+        if isinstance(first, np.ndarray):
+            shape, dtype = first.shape, first.dtype
+            if all(isinstance(v, np.ndarray) and v.shape == shape and v.dtype == dtype for v in values):
+                values, kind = np.stack(values), 'array'
+        elif type(first) in (int, float, bool):
+            scalar_type = type(first)
+            if all(type(v) is scalar_type for v in values):
+                values, kind = np.array(values), 'scalar'
+
+        if formats is None:
+            if kind == 'array':
+                formats = [_infer_format_from_type(channel_name, first)]
+            elif kind == 'scalar':
+                formats = ['data']
+            else:
+                formats = [
+                    _infer_format_from_type(channel_name, v) if v is not _MISSING else None
+                    for v in values
+                ]
+        return cls(values=values, format=_collapse_formats(formats), kind=kind)
+
+
+class PRecordBatch:
+    # Columnar (struct-of-arrays) counterpart of a list of PRecords
+    __slots__ = ('ids', 'timestamps', 'active_channel', 'active_channels', 'columns')
+    def __init__(self, *,
+                 ids: List[str],
+                 timestamps: np.ndarray = None,
+                 active_channel: Optional[str] = 'default',
+                 active_channels: Optional[List[str]] = None,
+                 columns: Dict[str, PColumn] = None):
+        self.ids = ids
+        if timestamps is None:
+            timestamps = np.full(len(ids), time.time())
+        self.timestamps = timestamps
+        # active_channels is only set if the records disagree on their active channel
+        self.active_channel = active_channel
+        self.active_channels = active_channels
+        self.columns = columns or {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def channels(self):
+        return self.columns.keys()
+
+    def column(self, name):
+        return self.columns[name].resolved()
+
+    def stacked(self, name) -> np.ndarray:
+        return self.columns[name].stacked()
+
+    def _ensure_active_channel(self) -> str:
+        if self.active_channel is None:
+            raise ValueError("Records in the batch have different active channels")
+        return self.active_channel
+
+    @property
+    def value(self):
+        return self.column(self._ensure_active_channel())
+
+    def stacked_value(self) -> np.ndarray:
+        return self.stacked(self._ensure_active_channel())
+
+    def _replace(self, **kwargs) -> "PRecordBatch":
+        d = {
+            'ids': self.ids,
+            'timestamps': self.timestamps,
+            'active_channel': self.active_channel,
+            'active_channels': self.active_channels,
+            'columns': self.columns,
+        }
+        d.update(kwargs)
+        return PRecordBatch(**d)
+
+    def with_column(self, channel_name: str, values, format: Optional[str] = None) -> "PRecordBatch":
+        if len(values) != len(self):
+            raise ValueError(
+                "Column {!r} has {} rows, expected {}".format(channel_name, len(values), len(self))
+            )
+        if isinstance(values, np.ndarray) and values.dtype != object:
+            if values.ndim > 1:
+                column = PColumn(
+                    values=values,
+                    format=format or _infer_format_from_type(channel_name, values[0]),
+                    kind='array',
+                )
+            else:
+                column = PColumn(values=values, format=format or 'data', kind='scalar')
+        else:
+            column = PColumn.from_values(channel_name, list(values))
+            if format is not None:
+                column.format = format
+        columns = self.columns.copy()
+        columns[channel_name] = column
+        return self._replace(columns=columns)
+
+    def with_value(self, values, format: Optional[str] = None) -> "PRecordBatch":
+        return self.with_column(self._ensure_active_channel(), values, format)
+
+    def select_channels(self, channels) -> "PRecordBatch":
+        return self._replace(columns={
+            k: v
+            for k, v in self.columns.items()
+            if k in channels
+        })
+
+    def __iter__(self) -> Iterator[PRecord]:
+        return self.to_precords()
+
+    def to_precords(self) -> Iterator[PRecord]:
+        columns = [
+            (name, column.kind, column.formats(len(self)), column.rows())
+            for name, column in self.columns.items()
+        ]
+        timestamps = self.timestamps.tolist()
+        active_channels = self.active_channels
+        for index, id in enumerate(self.ids):
+            channel_atoms = {}
+            for name, kind, formats, rows in columns:
+                value = rows[index]
+                if value is _MISSING:
+                    continue
+                if kind == 'atoms':
+                    channel_atoms[name] = value
+                else:
+                    channel_atoms[name] = PAtom(value=value, format=formats[index])
+            yield PRecord(
+                id=id,
+                timestamp=timestamps[index],
+                active_channel=(
+                    active_channels[index]
+                    if active_channels is not None
+                    else self.active_channel
+                ),
+                channel_atoms=channel_atoms,
+            )
+
+    @classmethod
+    def from_precords(cls, precords: List[PRecord]) -> "PRecordBatch":
+        channel_names = {}  # type: Dict[str, None]
+        for precord in precords:
+            for name in precord.channels:
+                channel_names[name] = None
+
+        columns = {}
+        for name in channel_names:
+            atoms = [precord.get_atom(name) or _MISSING for precord in precords]
+            formats = [atom.format if atom is not _MISSING else None for atom in atoms]
+            if any(atom is not _MISSING and not atom.is_loaded for atom in atoms):
+                # Don't load channels stages might not even look at
+                columns[name] = PColumn(values=atoms, format=_collapse_formats(formats), kind='atoms')
+            else:
+                values = [atom.value if atom is not _MISSING else _MISSING for atom in atoms]
+                columns[name] = PColumn.from_values(name, values, formats)
+
+        active_channels = [precord.active_channel for precord in precords]
+        active_channel = active_channels[0] if active_channels else 'default'
+        if all(channel == active_channel for channel in active_channels):
+            active_channels = None
+        else:
+            active_channel = None
+        return cls(
+            ids=[precord.id for precord in precords],
+            timestamps=np.array([precord.timestamp for precord in precords], dtype=np.float64),
+            active_channel=active_channel,
+            active_channels=active_channels,
+            columns=columns,
+        )
+
+    @classmethod
+    def batches(cls, precords: Iterable[PRecord], batch_size: int) -> Iterator["PRecordBatch"]:
+        it = iter(precords)
+        while True:
+            chunk = list(islice(it, batch_size))
+            if not chunk:
+                break
+            yield cls.from_precords(chunk)
+
+    def __repr__(self):
+        return ("<PRecordBatch len={!r} active_channel={!r} channels={!r}>"
+                .format(
+                    len(self),
+                    self.active_channel,
+                    list(self.channels),
+                ))
@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .pdatastructures import PRecord
+
+
+def _value_nbytes(value) -> Optional[int]:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    elif isinstance(value, str):
+        return len(value)
+    return None
+
+
+def queue_occupancy(q) -> Optional[int]:
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # multiprocessing queues on macOS
+        return None
+
+
+def stage_name(chain) -> str:
+    name = repr(chain)
+    if name.startswith("<") and " object at 0x" in name:
+        return chain.__class__.__name__
+    return name
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.records = 0
+        # time spent in next() of this stage, upstream included
+        self.wall_time = 0.0
+        # time this stage spent waiting on upstream stages
+        self.upstream_wait = 0.0
+        self.channel_bytes = {}  # type: Dict[str, int]
+
+    @property
+    def self_time(self) -> float:
+        return max(self.wall_time - self.upstream_wait, 0.0)
+
+    def add_bytes(self, precord: PRecord):
+        channel_bytes = self.channel_bytes
+        for name, atom in precord.channel_atoms.items():
+            if not atom.is_loaded:
+                continue
+            nbytes = _value_nbytes(atom.value)
+            if nbytes is not None:
+                channel_bytes[name] = channel_bytes.get(name, 0) + nbytes
+
+    def merge(self, other: "StageStats"):
+        self.records += other.records
+        self.wall_time += other.wall_time
+        self.upstream_wait += other.upstream_wait
+        for name, nbytes in other.channel_bytes.items():
+            self.channel_bytes[name] = self.channel_bytes.get(name, 0) + nbytes
+
+    def __repr__(self):
+        return (
+            "<StageStats name={!r} records={!r} wall_time={:.6f} upstream_wait={:.6f}>"
+            .format(self.name, self.records, self.wall_time, self.upstream_wait)
+        )
+
+
+class QueueStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.puts = 0
+        self.gets = 0
+        # time blocked in put()/get()
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.occupancy_sum = 0
+        self.occupancy_max = 0
+        self.samples = 0
+
+    @property
+    def mean_occupancy(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return self.occupancy_sum / self.samples
+
+    def _sample(self, q):
+        occupancy = queue_occupancy(q)
+        if occupancy is not None:
+            self.occupancy_sum += occupancy
+            self.occupancy_max = max(self.occupancy_max, occupancy)
+            self.samples += 1
+
+    def record_put(self, q, wait: float):
+        self.puts += 1
+        self.put_wait += wait
+        self._sample(q)
+
+    def record_get(self, q, wait: float):
+        self.gets += 1
+        self.get_wait += wait
+        self._sample(q)
+
+    def merge(self, other: "QueueStats"):
+        self.puts += other.puts
+        self.gets += other.gets
+        self.put_wait += other.put_wait
+        self.get_wait += other.get_wait
+        self.occupancy_sum += other.occupancy_sum
+        self.occupancy_max = max(self.occupancy_max, other.occupancy_max)
+        self.samples += other.samples
+
+    def __repr__(self):
+        return (
+            "<QueueStats name={!r} puts={!r} gets={!r} put_wait={:.6f} get_wait={:.6f}>"
+            .format(self.name, self.puts, self.gets, self.put_wait, self.get_wait)
+        )
+
+
+class ChunkStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.chunks = 0
+        self.records = 0
+        self.min_size = None  # type: Optional[int]
+        self.max_size = None  # type: Optional[int]
+        self.last_size = None  # type: Optional[int]
+
+    @property
+    def mean_size(self) -> Optional[float]:
+        if not self.chunks:
+            return None
+        return self.records / self.chunks
+
+    def record(self, size: int):
+        self.chunks += 1
+        self.records += size
+        self.min_size = size if self.min_size is None else min(self.min_size, size)
+        self.max_size = size if self.max_size is None else max(self.max_size, size)
+        self.last_size = size
+
+    def __repr__(self):
+        return (
+            "<ChunkStats name={!r} chunks={!r} records={!r} min_size={!r} max_size={!r} last_size={!r}>"
+            .format(self.name, self.chunks, self.records, self.min_size, self.max_size, self.last_size)
+        )
+
+
+class Tracer:
+    '''
+    Span events in the Trace Event Format, viewable in chrome://tracing or Perfetto.
+
+    Timestamps are taken from a monotonic clock anchored to the wall clock,
+    so that events from worker processes line up with those of the parent.
+    '''
+    def __init__(self):
+        self.events = []  # type: List[Dict[str, Any]]
+        self._offset = time.time() - time.perf_counter()
+        self._named_threads = set()
+
+    def __reduce__(self):
+        return (Tracer, ())
+
+    def to_us(self, perf_time: float) -> float:
+        return (perf_time + self._offset) * 1e6
+
+    def complete(self, name: str, cat: str, begin: float, elapsed: float, args: Optional[dict] = None):
+        # begin is a time.perf_counter() value
+        thread = threading.current_thread()
+        pid, tid = os.getpid(), thread.ident
+        if (pid, tid) not in self._named_threads:
+            self._named_threads.add((pid, tid))
+            self.events.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": thread.name},
+            })
+            self.events.append({
+                "name": "process_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": multiprocessing.current_process().name},
+            })
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": self.to_us(begin),
+            "dur": elapsed * 1e6,
+            "pid": pid,
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, cat: str, **args):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, cat, begin, time.perf_counter() - begin, args)
+
+    def traced(self, fn: Callable, name: str, cat: str) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.complete(name, cat, begin, time.perf_counter() - begin)
+        return wrapper
+
+    def extend(self, events: List[Dict[str, Any]]):
+        self.events.extend(events)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f)
+
+
+class Instrumentation:
+    '''
+    Per-stage and per-queue statistics of a run, carried by We.
+
+    Stages are timed with a thread-local stack of the stages being pulled,
+    so that the time a stage waits on its upstream is subtracted from its own time.
+    '''
+    def __init__(self,
+                 track_bytes: bool = False,
+                 auto_report: bool = True,
+                 trace: bool = False,
+                 trace_path: Optional[str] = None):
+        self.track_bytes = track_bytes
+        self.auto_report = auto_report
+        self.trace_path = trace_path
+        self.tracer = Tracer() if trace or trace_path is not None else None
+        self.stages = OrderedDict()  # type: Dict[Any, StageStats]
+        self.queues = OrderedDict()  # type: Dict[Any, QueueStats]
+        self.chunks = OrderedDict()  # type: Dict[Any, ChunkStats]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __reduce__(self):
+        # Sent to worker processes as an empty instrumentation with the same settings
+        return (Instrumentation, (self.track_bytes, self.auto_report, self.tracer is not None))
+
+    def child(self) -> "Instrumentation":
+        return Instrumentation(self.track_bytes, self.auto_report, self.tracer is not None)
+
+    def stage(self, key, name: str) -> StageStats:
+        with self._lock:
+            try:
+                return self.stages[key]
+            except KeyError:
+                stats = self.stages[key] = StageStats(name)
+                return stats
+
+    def queue(self, key, name: Optional[str] = None) -> QueueStats:
+        with self._lock:
+            try:
+                return self.queues[key]
+            except KeyError:
+                stats = self.queues[key] = QueueStats(name or str(key))
+                return stats
+
+    def chunk(self, key, name: Optional[str] = None) -> ChunkStats:
+        with self._lock:
+            try:
+                return self.chunks[key]
+            except KeyError:
+                stats = self.chunks[key] = ChunkStats(name or str(key))
+                return stats
+
+    def _stack(self) -> List[StageStats]:
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def instrument(self, key, name: str, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        it = iter(precords)
+        clock = time.perf_counter
+        track_bytes = self.track_bytes
+        tracer = self.tracer
+        # Registered once the first pull returns, so that stages are listed upstream first
+        stats, registered = StageStats(name), False
+        try:
+            while True:
+                stack = self._stack()
+                stack.append(stats)
+                begin = clock()
+                try:
+                    precord = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = clock() - begin
+                    stack.pop()
+                    stats.wall_time += elapsed
+                    if stack:
+                        stack[-1].upstream_wait += elapsed
+                    if tracer is not None:
+                        tracer.complete(name, "stage", begin, elapsed)
+                if not registered:
+                    stats = self._register_stage(key, stats)
+                    registered = True
+                stats.records += 1
+                if track_bytes:
+                    stats.add_bytes(precord)
+                yield precord
+        finally:
+            if not registered:
+                self._register_stage(key, stats)
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    def _register_stage(self, key, stats: StageStats) -> StageStats:
+        with self._lock:
+            registered = self.stages.get(key)
+            if registered is None:
+                self.stages[key] = stats
+                return stats
+        registered.merge(stats)
+        return registered
+
+    def export(self) -> Tuple[List[StageStats], List[QueueStats], List[Dict[str, Any]]]:
+        # Picklable snapshot shipped from workers to their parent
+        events = self.tracer.events if self.tracer is not None else []
+        with self._lock:
+            return list(self.stages.values()), list(self.queues.values()), list(events)
+
+    def merge_exported(self, exported, key, prefix: str):
+        stages, queues, events = exported
+        for index, stats in enumerate(stages):
+            self.stage((key, index), prefix + stats.name).merge(stats)
+        for stats in queues:
+            self.queue((key, stats.name), prefix + stats.name).merge(stats)
+        if self.tracer is not None:
+            self.tracer.extend(events)
+
+    def finish(self):
+        if self.tracer is not None and self.trace_path is not None:
+            self.tracer.dump(self.trace_path)
+        if self.auto_report:
+            self.report()
+
+    def summary(self) -> str:
+        lines = []
+        lines.append(
+            "{:>3} {:<48} {:>10} {:>10} {:>10} {:>10} {:>12}"
+            .format("#", "stage", "records", "wall(s)", "self(s)", "wait(s)", "records/s")
+        )
+        for index, stats in enumerate(list(self.stages.values())):
+            self_time = stats.self_time
+            rate = stats.records / self_time if self_time > 0 else float('inf')
+            lines.append(
+                "{:>3} {:<48} {:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f}"
+                .format(index, stats.name[:48], stats.records,
+                        stats.wall_time, self_time, stats.upstream_wait, rate)
+            )
+            for channel, nbytes in sorted(stats.channel_bytes.items()):
+                lines.append("{:>3} {:<48} {:>10} bytes".format("", "  ." + channel, nbytes))
+        if self.queues:
+            lines.append("")
+            lines.append(
+                "{:<52} {:>8} {:>8} {:>11} {:>11} {:>9} {:>8}"
+                .format("queue", "puts", "gets", "put wait(s)", "get wait(s)", "mean occ", "max occ")
+            )
+            for stats in list(self.queues.values()):
+                mean_occupancy = stats.mean_occupancy
+                lines.append(
+                    "{:<52} {:>8} {:>8} {:>11.3f} {:>11.3f} {:>9} {:>8}"
+                    .format(stats.name[:52], stats.puts, stats.gets,
+                            stats.put_wait, stats.get_wait,
+                            "-" if mean_occupancy is None else "{:.1f}".format(mean_occupancy),
+                            stats.occupancy_max)
+                )
+        if self.chunks:
+            lines.append("")
+            lines.append(
+                "{:<52} {:>8} {:>10} {:>8} {:>8} {:>8} {:>8}"
+                .format("chunks", "chunks", "records", "mean", "min", "max", "last")
+            )
+            for stats in list(self.chunks.values()):
+                mean_size = stats.mean_size
+                lines.append(
+                    "{:<52} {:>8} {:>10} {:>8} {:>8} {:>8} {:>8}"
+                    .format(stats.name[:52], stats.chunks, stats.records,
+                            "-" if mean_size is None else "{:.1f}".format(mean_size),
+                            "-" if stats.min_size is None else stats.min_size,
+                            "-" if stats.max_size is None else stats.max_size,
+                            "-" if stats.last_size is None else stats.last_size)
+                )
+        return "\n".join(lines)
+
+    def report(self, file=None):
+        print(self.summary(), file=file or sys.stderr)
@@ -1,7 +1,7 @@
 import inspect
 
-from .pdatastructures import PRecord
-from .pbase import Source, Transformer, Sink, pipex_hash
+from .pdatastructures import PRecord, PRecordBatch
+from .pbase import Source, Transformer, Sink, pipex_hash, CHAIN_HASH_MEMO
 from typing import Iterator, Any
 
 
@@ -14,6 +14,7 @@ def chain_hash(self):
         *[
             segment
             for pair in sorted(self.__dict__.items(), key=lambda item: item[0])
+            if pair[0] != CHAIN_HASH_MEMO
             for segment in pair
         ]
     )
@@ -81,6 +82,21 @@ class pipe_map(pipe):
     def map(self, value: Any) -> Any:
         return value
 
+    def fusible_steps(self):
+        # Subclasses overriding transform do more than rewriting values
+        if getattr(self.transform, '__func__', None) is not pipe_map.__dict__['transform']:
+            return None
+        return self._map_steps()
+
+    def _map_steps(self):
+        defaults = pipe_map.__dict__
+        filter_fn, map_fn = self.filter, self.map
+        if getattr(filter_fn, '__func__', None) is defaults['filter']:
+            filter_fn = None
+        if getattr(map_fn, '__func__', None) is defaults['map']:
+            map_fn = None
+        return filter_fn, map_fn
+
     def transform(self, our, precords: Iterator[PRecord]) -> Iterator[PRecord]:
         fn = self.map
         for precord in precords:
@@ -90,6 +106,29 @@ class pipe_map(pipe):
             yield precord.with_value(new_value)
 
 
+class pipe_batch(pipe):
+    batch_size = 64
+
+    def preferred_batch_size(self):
+        return self.batch_size
+
+    def keeps_state(self):
+        # Which records share a batch depends on those before
+        return True
+
+    def transform_batch(self, our, batch: PRecordBatch) -> PRecordBatch:
+        raise NotImplementedError
+
+    def transform_batches(self, our, batches: Iterator[PRecordBatch]) -> Iterator[PRecordBatch]:
+        for batch in batches:
+            yield self.transform_batch(our, batch)
+
+    def transform(self, our, precords: Iterator[PRecord]) -> Iterator[PRecord]:
+        batches = PRecordBatch.batches(precords, self.preferred_batch_size())
+        for batch in self.transform_batches(our, batches):
+            yield from batch.to_precords()
+
+
 class sink(Sink, metaclass=SinkMeta):
     def save(self, precord: PRecord):
         raise NotImplementedError
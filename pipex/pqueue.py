@@ -0,0 +1,175 @@
+import io
+import os
+import time
+import struct
+import pickle
+
+from multiprocessing.context import assert_spawning
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.synchronize import SEM_VALUE_MAX
+from queue import Empty, Full
+from typing import Any, List, Tuple
+
+from .pdatastructures import OUT_OF_BAND_MIN_BYTES
+
+
+_COUNT = struct.Struct('!I')
+_SIZE = struct.Struct('!Q')
+
+
+def dumps_out_of_band(obj) -> Tuple[bytes, List[memoryview]]:
+    # Pickle protocol 5, with large contiguous buffers (ndarrays, bytearrays, PickleBuffers) kept apart
+    buffers = []
+    def buffer_callback(buffer: pickle.PickleBuffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # Not contiguous. Serialized in-band.
+            return True
+        if raw.nbytes < OUT_OF_BAND_MIN_BYTES:
+            # Cheaper to copy than to write on its own
+            return True
+        buffers.append(raw)
+        return False
+
+    f = io.BytesIO()
+    # ForkingPickler takes positional arguments only: file, protocol, fix_imports, buffer_callback
+    ForkingPickler(f, 5, True, buffer_callback).dump(obj)
+    return f.getvalue(), buffers
+
+
+def loads_out_of_band(body: bytes, buffers: List[bytearray]) -> Any:
+    return pickle.loads(body, buffers=buffers)
+
+
+def _write_all(fd: int, view: memoryview):
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _read_into(f: io.FileIO, view: memoryview):
+    while view:
+        read = f.readinto(view)
+        if not read:
+            raise EOFError
+        view = view[read:]
+
+
+class OutOfBandQueue:
+    '''
+    A multiprocessing queue for chunks of large arrays, pickled with protocol 5.
+
+    The pickle itself only describes the object. Buffers are written to the pipe right from the memory of
+    the arrays, and read into bytearrays that the unpickled arrays are built on, instead of being copied
+    into and out of one pickle byte string.
+
+    Unlike multiprocessing.Queue, there is no feeder thread. put() writes in the calling thread,
+    and may wait for a reader once the pipe is full. POSIX only.
+    '''
+    def __init__(self, maxsize: int = 0, *, ctx):
+        if maxsize <= 0:
+            maxsize = SEM_VALUE_MAX
+        self._maxsize = maxsize
+        self._reader, self._writer = ctx.Pipe(duplex=False)
+        self._rlock = ctx.Lock()
+        self._wlock = ctx.Lock()
+        self._sem = ctx.BoundedSemaphore(maxsize)
+        self._reset()
+
+    def __getstate__(self):
+        assert_spawning(self)
+        return (self._maxsize, self._reader, self._writer, self._rlock, self._wlock, self._sem)
+
+    def __setstate__(self, state):
+        self._maxsize, self._reader, self._writer, self._rlock, self._wlock, self._sem = state
+        self._reset()
+
+    def _reset(self):
+        self._closed = False
+        self._reader_file = None
+
+    def put(self, obj, block: bool = True, timeout=None):
+        if self._closed:
+            raise ValueError("Queue {!r} is closed".format(self))
+        body, buffers = dumps_out_of_band(obj)
+        header = _COUNT.pack(len(buffers)) + b"".join(_SIZE.pack(buffer.nbytes) for buffer in buffers)
+        if not self._sem.acquire(block, timeout):
+            raise Full
+        with self._wlock:
+            self._writer.send_bytes(header + body)
+            fd = self._writer.fileno()
+            for buffer in buffers:
+                _write_all(fd, buffer)
+
+    def put_nowait(self, obj):
+        return self.put(obj, False)
+
+    def _recv(self) -> Tuple[bytes, List[bytearray]]:
+        message = self._reader.recv_bytes()
+        num_buffers, = _COUNT.unpack_from(message)
+        offset = _COUNT.size
+        buffers = []
+        if num_buffers:
+            f = self._reader_file
+            if f is None:
+                f = self._reader_file = io.FileIO(self._reader.fileno(), 'rb', closefd=False)
+            for _ in range(num_buffers):
+                size, = _SIZE.unpack_from(message, offset)
+                offset += _SIZE.size
+                buffer = bytearray(size)
+                _read_into(f, memoryview(buffer))
+                buffers.append(buffer)
+        return message[offset:], buffers
+
+    def get(self, block: bool = True, timeout=None):
+        if self._closed:
+            raise ValueError("Queue {!r} is closed".format(self))
+        if block and timeout is None:
+            with self._rlock:
+                body, buffers = self._recv()
+            self._sem.release()
+        else:
+            if block:
+                deadline = time.monotonic() + timeout
+            if not self._rlock.acquire(block, timeout):
+                raise Empty
+            try:
+                if block:
+                    timeout = deadline - time.monotonic()
+                    if not self._reader.poll(timeout):
+                        raise Empty
+                elif not self._reader.poll():
+                    raise Empty
+                body, buffers = self._recv()
+                self._sem.release()
+            finally:
+                self._rlock.release()
+        # Unpickled out of the lock
+        return loads_out_of_band(body, buffers)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self) -> int:
+        # Raises NotImplementedError on macOS, as multiprocessing.Queue does
+        return self._maxsize - self._sem._semlock._get_value()
+
+    def empty(self) -> bool:
+        return not self._reader.poll()
+
+    def full(self) -> bool:
+        return self._sem._semlock._is_zero()
+
+    def close(self):
+        # Closes the ends of the pipe held by this process only
+        self._closed = True
+        self._reader.close()
+        self._writer.close()
+
+    def join_thread(self):
+        # Nothing is buffered; put() returns once written
+        pass
+
+    def cancel_join_thread(self):
+        pass
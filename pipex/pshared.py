@@ -0,0 +1,170 @@
+import weakref
+import logging
+import numpy as np
+
+from multiprocessing import shared_memory
+from queue import Empty
+from typing import List, Optional
+
+from .pdatastructures import PRecord, PAtom
+
+
+logger = logging.getLogger(__name__)
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+    def __del__(self):
+        # The mapping may outlive this object through arrays viewing it. It is unmapped along with them.
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+class SharedArrayRef:
+    # What crosses the queue in place of an array copied into a slab slot
+    __slots__ = ('slot', 'dtype', 'shape')
+    def __init__(self, slot: int, dtype: str, shape: tuple):
+        self.slot = slot
+        self.dtype = dtype
+        self.shape = shape
+
+    def __reduce__(self):
+        return (SharedArrayRef, (self.slot, self.dtype, self.shape))
+
+    def __repr__(self):
+        return "<SharedArrayRef slot={!r} dtype={!r} shape={!r}>".format(self.slot, self.dtype, self.shape)
+
+
+class SlabPool:
+    '''
+    Fixed-size slots in one shared memory segment, recycled through a queue of free slot numbers.
+
+    The parent creates the pool and unlinks it on close(); worker processes attach to it when unpickled.
+    A slot is given back once every array viewing it has been garbage collected,
+    on whichever side of the queue that happens.
+    '''
+    def __init__(self, num_slots: int, slot_size: int, min_bytes: int, queue_class):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.min_bytes = min_bytes
+        self.free_slots = queue_class(num_slots)
+        self._shm = _SharedMemory(create=True, size=num_slots * slot_size)
+        self._name = self._shm.name
+        self._owner = True
+        self.closed = False
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def __reduce__(self):
+        return (_attach_slab_pool, (self._name, self.num_slots, self.slot_size, self.min_bytes, self.free_slots))
+
+    @property
+    def shm(self) -> _SharedMemory:
+        shm = self._shm
+        if shm is None:
+            shm = self._shm = _SharedMemory(name=self._name)
+        return shm
+
+    def _release(self, slot: int):
+        if self.closed:
+            return
+        try:
+            self.free_slots.put(slot)
+        except (ValueError, OSError, AssertionError):
+            # the queue is already closed at teardown
+            pass
+
+    def _slot_buffer(self, slot: int) -> memoryview:
+        # Arrays keep this slice as their base, which keeps the segment mapped for as long as they live
+        begin = slot * self.slot_size
+        return self.shm.buf[begin:begin + self.slot_size]
+
+    def _view(self, ref: SharedArrayRef) -> np.ndarray:
+        dtype = np.dtype(ref.dtype)
+        count = int(np.prod(ref.shape, dtype=np.int64))
+        # Reshapes, slices and other views derived downstream keep this array alive as their base,
+        # so the slot is only given back once all of them are gone
+        base = np.frombuffer(self._slot_buffer(ref.slot), dtype=dtype, count=count)
+        weakref.finalize(base, self._release, ref.slot)
+        return base.reshape(ref.shape)
+
+    def _share(self, value: np.ndarray) -> Optional[SharedArrayRef]:
+        if value.dtype.hasobject or not (self.min_bytes <= value.nbytes <= self.slot_size):
+            return None
+        try:
+            slot = self.free_slots.get_nowait()
+        except Empty:
+            # All slots are in use. Pickle it instead of waiting.
+            return None
+        target = np.frombuffer(self._slot_buffer(slot), dtype=value.dtype, count=value.size).reshape(value.shape)
+        target[...] = value
+        del target
+        return SharedArrayRef(slot, value.dtype.str, value.shape)
+
+    def encode_chunk(self, precord_chunk: List[PRecord]) -> List[PRecord]:
+        encoded = []
+        for precord in precord_chunk:
+            shared = {}
+            for name, atom in precord.channel_atoms.items():
+                value = atom.value
+                if isinstance(value, np.ndarray):
+                    ref = self._share(value)
+                    if ref is not None:
+                        shared[name] = PAtom(value=ref, format=atom.format)
+            if shared:
+                precord = PRecord(
+                    id=precord.id,
+                    timestamp=precord.timestamp,
+                    active_channel=precord.active_channel,
+                    channel_atoms=precord.channel_atoms.with_items(shared),
+                )
+            encoded.append(precord)
+        return encoded
+
+    def decode_chunk(self, precord_chunk: List[PRecord]) -> List[PRecord]:
+        decoded = []
+        for precord in precord_chunk:
+            viewed = {
+                name: PAtom(value=self._view(atom.value), format=atom.format)
+                for name, atom in precord.channel_atoms.items()
+                if isinstance(atom.value, SharedArrayRef)
+            }
+            if viewed:
+                precord = PRecord(
+                    id=precord.id,
+                    timestamp=precord.timestamp,
+                    active_channel=precord.active_channel,
+                    channel_atoms=precord.channel_atoms.with_items(viewed),
+                )
+            decoded.append(precord)
+        return decoded
+
+    def close(self):
+        self.closed = True
+        if self._owner:
+            self.free_slots.close()
+            self.free_slots.cancel_join_thread()
+        shm = self._shm
+        if shm is None:
+            return
+        try:
+            shm.close()
+        except BufferError:
+            # Arrays handed downstream still view the segment. The mapping lives on with them.
+            logger.debug("Shared memory %s is still viewed by arrays", self._name)
+        if self._owner:
+            shm.unlink()
+
+
+def _attach_slab_pool(name, num_slots, slot_size, min_bytes, free_slots) -> SlabPool:
+    pool = SlabPool.__new__(SlabPool)
+    pool.num_slots = num_slots
+    pool.slot_size = slot_size
+    pool.min_bytes = min_bytes
+    pool.free_slots = free_slots
+    pool._shm = None
+    pool._name = name
+    pool._owner = False
+    pool.closed = False
+    return pool
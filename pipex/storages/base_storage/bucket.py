@@ -1,48 +1,91 @@
 import time
 import logging
 
-from typing import Iterator, Tuple, Optional, Iterable
+from typing import Iterator, Tuple, Optional, Iterable, AbstractSet, Dict
 from contextlib import contextmanager
+from functools import partial
 from uuid import uuid4
 
 from ..bucket_metadata import BucketMetadata
-from ...pbase import Source, Sink, SourceDataVersion, SinkDataVersion, TransformedSource, Pipeline
+from .writer import WriteBehind
+from ...pbase import Source, Sink, SourceDataVersion, SinkDataVersion, TransformedSource, Pipeline, tracer_of, memoized_chain_hash
 from ...pdatastructures import PRecord
 from ...poperators import source
 
 
 class BucketWithIds(source):
-    def __init__(self, bucket: "Bucket", ids: Iterable[str]):
+    def __init__(self, bucket: "Bucket", ids: Iterable[str], channels: Optional[AbstractSet[str]] = None):
         self.bucket = bucket
         self.ids = ids
+        self.channels = channels
 
     def generate_precords(self, our)-> Iterator[PRecord]:
-        bucket = self.bucket
+        bucket, channels = self.bucket, self.channels
+        load_precord = bucket._load_precord_fn(our)
         with bucket.read_context():
             for id in self.ids:
-                precord = bucket.load_precord(our, id)
+                precord = load_precord(our, id, channels)
                 if precord is None:
                     continue
                 yield precord
 
+    def project_channels(self, channels: AbstractSet[str]) -> Source:
+        if self.channels is not None:
+            channels = self.channels & channels
+        return BucketWithIds(self.bucket, self.ids, channels)
+
+    def record_fingerprint(self, precord: PRecord) -> str:
+        return self.bucket.record_fingerprint(precord)
+
+
+class BucketWithChannels(source):
+    def __init__(self, bucket: "Bucket", channels: AbstractSet[str]):
+        self.bucket = bucket
+        self.channels = channels
+
+    def generate_precords(self, our) -> Iterator[PRecord]:
+        return self.bucket.generate_precords(our, self.channels)
+
+    def fetch_source_data_version(self, our) -> SourceDataVersion:
+        return self.bucket.fetch_source_data_version(our)
+
+    def project_channels(self, channels: AbstractSet[str]) -> Source:
+        return BucketWithChannels(self.bucket, self.channels & channels)
+
+    def record_fingerprint(self, precord: PRecord) -> str:
+        return self.bucket.record_fingerprint(precord)
+
 
 class Bucket(Source, Sink):
     def __init__(self, storage, *,
                  scope: Tuple[str],
                  use_batch: bool,
                  batch_size: Optional[int],
-                 flush_interval: float):
+                 flush_interval: float,
+                 incremental: bool = False,
+                 writers: int = 0,
+                 write_queue_size: Optional[int] = None):
         self.storage = storage
         self.scope = scope
         self.use_batch = use_batch
         self.batch_size = batch_size
         self.flush_interval = flush_interval
+        self.incremental = incremental
+        # With writers, records are saved behind by that many threads, with up to write_queue_size of them pending
+        self.writers = writers
+        self.write_queue_size = write_queue_size or 2 * writers
         self.logger = logging.getLogger("{}({!r}, {!r})".format(self.__class__.__name__, self.storage, self.scope))
         self._last_flush_time = None
 
     def with_ids(self, ids: Iterable[str]) -> Source:
         return BucketWithIds(self, ids)
 
+    def with_channels(self, channels: Iterable[str]) -> Source:
+        return BucketWithChannels(self, frozenset(channels))
+
+    def project_channels(self, channels: AbstractSet[str]) -> Source:
+        return BucketWithChannels(self, frozenset(channels))
+
     def load_metadata(self, our) -> BucketMetadata:
         raise NotImplementedError
 
@@ -52,24 +95,58 @@ class Bucket(Source, Sink):
     def load_ids(self, our) -> Iterator[str]:
         raise NotImplementedError
 
-    def load_precord(self, our, id: str):
+    def count(self, our=None) -> int:
+        with self.read_context():
+            return sum(1 for _ in self.load_ids(our))
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        # Empty buckets are still buckets
+        return True
+
+    def load_precord(self, our, id: str, channels: Optional[AbstractSet[str]] = None):
+        # channels: if given, only these channels are read
         raise NotImplementedError
 
-    def save_precord(self, our, precord: PRecord):
+    def save_precord(self, our, precord: PRecord, provenance: Optional[Tuple[str, str]] = None):
+        # provenance: (source record fingerprint, chain hash) the record was computed from
         raise NotImplementedError
 
+    def delete_precord(self, our, id: str):
+        raise NotImplementedError
+
+    def load_provenance(self, our, id: str) -> Optional[Tuple[str, str]]:
+        raise NotImplementedError
+
+    def load_provenances(self, our) -> Dict[str, Optional[Tuple[str, str]]]:
+        # Provenance of every stored record. Buckets keeping an index of them read it at once.
+        return {id: self.load_provenance(our, id) for id in list(self.load_ids(our))}
+
+    def record_fingerprint(self, precord: PRecord) -> str:
+        # Every rewrite of a record renews its timestamp
+        return "{}@{!r}".format(precord.id, precord.timestamp)
+
     def read_context(self):
         raise NotImplementedError
 
     def read_write_context(self):
         raise NotImplementedError
 
-    def generate_precords(self, our) -> Iterator[PRecord]:
+    def generate_precords(self, our, channels: Optional[AbstractSet[str]] = None) -> Iterator[PRecord]:
+        load_precord = self._load_precord_fn(our)
         with self.read_context():
             for id in self.load_ids(our):
-                precord = self.load_precord(our, id)
+                precord = load_precord(our, id, channels)
                 yield precord
 
+    def _load_precord_fn(self, our):
+        tracer = tracer_of(our)
+        if tracer is None:
+            return self.load_precord
+        return tracer.traced(self.load_precord, "{} load_precord".format(self.__class__.__name__), "storage")
+
     def fetch_source_data_version(self, our) -> SourceDataVersion:
         return self.load_metadata(our).fetch_source_data_version()
 
@@ -79,6 +156,9 @@ class Bucket(Source, Sink):
     def process(self, our, tr_source: TransformedSource) -> Iterator[PRecord]:
         pipeline = tr_source.with_sink(self)
         if pipeline.rewriting_required(our):
+            if self.incremental:
+                self.logger.info("Start incremental writing: {!r}".format(pipeline))
+                return self.process_incremental(our, pipeline)
             self.logger.info("Start (re)writing: {!r}".format(pipeline))
             return self.process_rewrite(our, pipeline, tr_source)
         else:
@@ -92,19 +172,22 @@ class Bucket(Source, Sink):
         with self.read_write_context():
             metadata = self.load_metadata(our)
             source_data_hash = pipeline.source.fetch_source_data_version(our).data_hash
-            source_chain_hash = pipeline.transformer.chain_hash()
+            source_chain_hash = memoized_chain_hash(pipeline.transformer)
+            writer = self._open_writer(our)
             try:
                 if self.use_batch:
                     if self.batch_size is None:
                         # full batch
                         for precord in tr_source.execute(our):
-                            self._save_precord_with_flush(our, precord, metadata)
+                            self._save_precord_with_flush(our, precord, metadata, writer=writer)
+                        if writer is not None:
+                            writer.drain()
                         yield from self.generate_precords(our)
                     else:
                         # mini batch
                         mini_batch = []
                         for index, precord in enumerate(tr_source.execute(our)):
-                            self._save_precord_with_flush(our, precord, metadata)
+                            self._save_precord_with_flush(our, precord, metadata, writer=writer)
                             mini_batch.append(precord)
                             if (index + 1) % self.batch_size:
                                 yield from mini_batch
@@ -115,24 +198,119 @@ class Bucket(Source, Sink):
                 else:
                     # stream
                     for precord in tr_source.execute(our):
-                        self._save_precord_with_flush(our, precord, metadata)
+                        self._save_precord_with_flush(our, precord, metadata, writer=writer)
                         yield precord
             except:
+                if writer is not None:
+                    # Let pending writes finish without hiding the error
+                    writer.close(raise_error=False)
                 raise
             else:
+                if writer is not None:
+                    writer.close()
                 last_source_data_hash = pipeline.source.fetch_source_data_version(our).data_hash
                 metadata.source_data_hash = last_source_data_hash
                 metadata.source_chain_hash = source_chain_hash
                 metadata.data_hash = str(uuid4())
                 self.flush_metadata(our, metadata)
 
-    def _save_precord_with_flush(self, our, precord: PRecord, metadata: BucketMetadata):
-        self.save_precord(our, precord)
+    def process_incremental(self, our, pipeline: Pipeline) -> Iterator[PRecord]:
+        '''
+        Recomputes only records whose source record or chain changed since they were written,
+        and deletes those whose source record is gone.
+        Assumes that the transformer keeps record ids and yields at most one record per id.
+        '''
+        tr_source = pipeline.transformed_source
+        source, transformer = pipeline.source, pipeline.transformer
+        with self.read_write_context():
+            metadata = self.load_metadata(our)
+            source_chain_hash = memoized_chain_hash(transformer)
+
+            stored = self.load_provenances(our)
+            seen, changed = set(), set()
+            pending = {}  # type: Dict[str, str]
+
+            def changed_precords(precords):
+                for precord in precords:
+                    id = precord.id
+                    fingerprint = source.record_fingerprint(precord)
+                    seen.add(id)
+                    if stored.get(id) == (fingerprint, source_chain_hash):
+                        continue
+                    changed.add(id)
+                    pending[id] = fingerprint
+                    yield precord
+
+            num_written = 0
+            writer = self._open_writer(our)
+            try:
+                # Executed like any other source, so that upstream sinks run and record their data
+                for precord in tr_source.execute_through(our, changed_precords):
+                    fingerprint = pending.pop(precord.id, None)
+                    provenance = (fingerprint, source_chain_hash) if fingerprint is not None else None
+                    self._save_precord_with_flush(our, precord, metadata, provenance, writer)
+                    num_written += 1
+            except:
+                if writer is not None:
+                    writer.close(raise_error=False)
+                raise
+            else:
+                if writer is not None:
+                    writer.close()
+
+            # Source records that are gone, or changed but filtered out this time
+            stale_ids = (stored.keys() - seen) | (stored.keys() & pending.keys())
+            for id in stale_ids:
+                self.delete_precord(our, id)
+            self.logger.info(
+                "{} written, {} deleted, {} up to date".format(
+                    num_written, len(stale_ids), len(seen) - len(changed),
+                )
+            )
+
+            metadata.source_data_hash = source.fetch_source_data_version(our).data_hash
+            metadata.source_chain_hash = source_chain_hash
+            if num_written or stale_ids or metadata.data_hash is None:
+                metadata.data_hash = str(uuid4())
+            self.flush_metadata(our, metadata)
+        yield from self.generate_precords(our)
+
+    def _open_writer(self, our) -> Optional[WriteBehind]:
+        if not self.writers:
+            return None
+        return WriteBehind(
+            partial(self._save_precord_traced, our),
+            self.writers,
+            self.write_queue_size,
+            name="{}Writer".format(self.__class__.__name__),
+        )
+
+    def _save_precord_traced(self, our, precord: PRecord, provenance: Optional[Tuple[str, str]] = None):
+        tracer = tracer_of(our)
+        if tracer is None:
+            self.save_precord(our, precord, provenance)
+        else:
+            with tracer.span("{} save_precord".format(self.__class__.__name__), "storage", id=precord.id):
+                self.save_precord(our, precord, provenance)
+
+    def _save_precord_with_flush(self,
+                                 our,
+                                 precord: PRecord,
+                                 metadata: BucketMetadata,
+                                 provenance: Optional[Tuple[str, str]] = None,
+                                 writer: Optional[WriteBehind] = None):
+        if writer is None:
+            self._save_precord_traced(our, precord, provenance)
+        else:
+            writer.submit(precord.id, precord, provenance)
         metadata.latest_record_timestamp = max(
             metadata.latest_record_timestamp,
             precord.timestamp,
         )
         now = time.time()
         if self._last_flush_time is None or now - self._last_flush_time > self.flush_interval:
+            if writer is not None:
+                # The metadata may only account for records already written
+                writer.drain()
             self.flush_metadata(our, metadata)
             self._last_flush_time = now
@@ -1,5 +1,5 @@
 from .bucket import Bucket
-from typing import Optional
+from typing import Optional, Tuple, Type
 
 class Storage:
     bucket_class = Bucket
@@ -8,14 +8,26 @@ class Storage:
                use_batch: bool = True,
                batch_size: Optional[int] = None,
                flush_interval: float = 1.0,
+               incremental: bool = False,
+               writers: int = 0,
+               write_queue_size: Optional[int] = None,
+               **options,
               ) -> Bucket:
-        return self.bucket_class(
+        scope = tuple(name.lstrip("/").rstrip("/").split("/"))
+        return self.bucket_class_for(scope)(
             storage=self,
-            scope=tuple(name.lstrip("/").rstrip("/").split("/")),
+            scope=scope,
             use_batch=use_batch,
             batch_size=batch_size,
             flush_interval=flush_interval,
+            incremental=incremental,
+            writers=writers,
+            write_queue_size=write_queue_size,
+            **options
         )
 
+    def bucket_class_for(self, scope: Tuple[str]) -> Type[Bucket]:
+        return self.bucket_class
+
     def __getitem__(self, name) -> Bucket:
         return self.bucket(name)
@@ -0,0 +1,74 @@
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+
+class WriteBehind:
+    '''
+    Runs `save(*args)` on `num_writers` threads, so that encoding and I/O overlap with upstream.
+
+    At most `max_pending` writes are queued or running; submit() waits for a free slot beyond that.
+    Writes of the same id are kept in order. The first error of a writer is raised
+    by the next submit() or drain().
+    '''
+    def __init__(self, save: Callable, num_writers: int, max_pending: int, name: str = "BucketWriter"):
+        self.save = save
+        self._executor = ThreadPoolExecutor(num_writers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}  # type: Dict[str, Future]
+        self._num_pending = 0
+        self._error = None  # type: Optional[BaseException]
+
+    def _raise_error(self):
+        error = self._error
+        if error is not None:
+            self._error = None
+            raise error
+
+    def submit(self, id: str, *args):
+        self._raise_error()
+        self._slots.acquire()
+        with self._lock:
+            previous = self._pending.get(id)
+        if previous is not None:
+            # The same record again. Written after the previous write.
+            previous.exception()
+        with self._lock:
+            self._num_pending += 1
+        future = self._executor.submit(self.save, *args)
+        with self._lock:
+            self._pending[id] = future
+        future.add_done_callback(lambda future: self._done(id, future))
+
+    def _done(self, id: str, future: Future):
+        error = future.exception()
+        with self._lock:
+            if self._pending.get(id) is future:
+                del self._pending[id]
+            if error is not None and self._error is None:
+                self._error = error
+            self._num_pending -= 1
+            if not self._num_pending:
+                self._idle.notify_all()
+        self._slots.release()
+
+    def drain(self):
+        # Waits until every write submitted so far is done
+        with self._lock:
+            while self._num_pending:
+                self._idle.wait()
+        self._raise_error()
+
+    def close(self, raise_error: bool = True):
+        try:
+            if raise_error:
+                self.drain()
+            else:
+                with self._lock:
+                    while self._num_pending:
+                        self._idle.wait()
+        finally:
+            self._executor.shutdown(wait=True)
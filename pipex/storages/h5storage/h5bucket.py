@@ -6,8 +6,9 @@ from ..bucket_version import BucketVersion
 
 from ..base_storage import Bucket
 from ...pdatastructures import PRecord, PAtom
-from typing import Iterator
+from typing import Iterator, Optional, AbstractSet, Tuple
 from contextlib import contextmanager
+from functools import partial
 
 
 class H5Bucket(Bucket):
@@ -27,7 +28,7 @@ class H5Bucket(Bucket):
     def load_ids(self, our) -> Iterator[str]:
         return self._h5file.keys()
 
-    def load_precord(self, our, id: str):
+    def load_precord(self, our, id: str, channels: Optional[AbstractSet[str]] = None):
         try:
             group = self._h5file[id]
         except KeyError:
@@ -36,12 +37,13 @@ class H5Bucket(Bucket):
         timestamp = group.attrs.get('timestamp')
         channel_atoms = {}
         for channel_name, dataset in group.items():
+            if channels is not None and channel_name not in channels:
+                continue
             format = dataset.attrs.get('format', 'unknown')
-            data = np.array(dataset)
-            if data.shape == ():
-                data = data.tolist()
-            patom = PAtom(value=data, format=format)
-            channel_atoms[channel_name] = patom
+            channel_atoms[channel_name] = PAtom.lazy(
+                partial(self._load_dataset, id, channel_name),
+                format,
+            )
         return PRecord(
             id=id,
             timestamp=timestamp,
@@ -49,13 +51,42 @@ class H5Bucket(Bucket):
             channel_atoms=channel_atoms,
         )
 
-    def save_precord(self, our, precord: PRecord):
+    def _load_dataset(self, id: str, channel_name: str):
+        h5file = self._h5file
+        if h5file is not None:
+            data = np.array(h5file[id][channel_name])
+        else:
+            # The atom outlived the read context. Reopened read-only, which leaves the file untouched.
+            with self.storage.with_h5file(self.scope, mode="r") as h5file:
+                data = np.array(h5file[id][channel_name])
+        if data.shape == ():
+            data = data.tolist()
+        return data
+
+    def load_provenance(self, our, id: str) -> Optional[Tuple[str, str]]:
+        try:
+            provenance = self._h5file[id].attrs.get('provenance')
+        except KeyError:
+            return None
+        return tuple(json.loads(provenance)) if provenance is not None else None
+
+    def delete_precord(self, our, id: str):
+        try:
+            del self._h5file[id]
+        except KeyError:
+            pass
+
+    def save_precord(self, our, precord: PRecord, provenance: Optional[Tuple[str, str]] = None):
         try:
             group = self._h5file[precord.id]
         except KeyError:
             group = self._h5file.create_group(precord.id)
         group.attrs['active_channel'] = precord.active_channel
         group.attrs['timestamp'] = precord.timestamp
+        if provenance is not None:
+            group.attrs['provenance'] = json.dumps(list(provenance))
+        elif 'provenance' in group.attrs:
+            del group.attrs['provenance']
         for channel_name, patom in precord.channel_atoms.items():
             try:
                 del group[channel_name]
@@ -28,8 +28,9 @@ class H5Storage(Storage):
         return self.bucket(name)
 
     @contextmanager
-    def with_h5file(self, scope: Tuple[str]):
+    def with_h5file(self, scope: Tuple[str], mode: str = "a"):
         import h5py
-        os.makedirs(join(self.base_dir, *scope[:-1]), exist_ok=True)
-        with h5py.File(os.path.join(self.base_dir, *scope) + ".h5", swmr=self.swmr) as fp:
+        if mode != "r":
+            os.makedirs(join(self.base_dir, *scope[:-1]), exist_ok=True)
+        with h5py.File(os.path.join(self.base_dir, *scope) + ".h5", mode, swmr=self.swmr) as fp:
             yield fp
@@ -1,2 +1,4 @@
 from .pstorage import PStorage
 from .pbucket import PBucket
+from .segment_bucket import SegmentBucket
+from .codecs import Codec, register_codec, make_codec
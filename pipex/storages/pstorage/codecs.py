@@ -0,0 +1,231 @@
+import io
+import os
+import lzma
+import zlib
+import struct
+import numpy as np
+
+from PIL import Image
+from typing import Any, Callable, Dict, Optional, Union
+
+
+class Codec:
+    '''
+    Encodes channel values of a bucket to bytes and back.
+
+    Only `name` is recorded along with each record, so decoding must not depend on
+    the parameters the value was encoded with.
+    '''
+    name = None  # type: str
+    ext = '.dat'
+
+    def encode(self, value) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+    def load(self, file_name: str) -> Any:
+        # Read into a bytearray, so that arrays decoded in place are writable
+        with open(file_name, "rb") as f:
+            data = bytearray(os.fstat(f.fileno()).st_size)
+            f.readinto(data)
+        return self.decode(data)
+
+    def __repr__(self):
+        return "<{} name={!r}>".format(self.__class__.__name__, self.name)
+
+
+class BytesCodec(Codec):
+    name = 'bytes'
+    ext = '.dat'
+
+    def encode(self, value) -> bytes:
+        return bytes(value)
+
+    def decode(self, data: bytes):
+        return bytes(data)
+
+
+class TextCodec(Codec):
+    name = 'text'
+    ext = '.txt'
+
+    def encode(self, value) -> bytes:
+        return value.encode()
+
+    def decode(self, data: bytes):
+        return bytes(data).decode()
+
+
+class PNGCodec(Codec):
+    # compress_level: 0 (none, fastest) to 9. PIL defaults to 6.
+    name = 'png'
+    ext = '.png'
+
+    def __init__(self, compress_level: int = 6):
+        self.compress_level = compress_level
+
+    def encode(self, value) -> bytes:
+        f = io.BytesIO()
+        Image.fromarray(value).save(f, format='PNG', compress_level=self.compress_level)
+        return f.getvalue()
+
+    def decode(self, data: bytes):
+        with Image.open(io.BytesIO(data)) as img:
+            return np.array(img)
+
+
+class NpzCodec(Codec):
+    name = 'npz'
+    ext = '.npz'
+
+    def encode(self, value) -> bytes:
+        f = io.BytesIO()
+        np.savez_compressed(f, value)
+        return f.getvalue()
+
+    def decode(self, data: bytes):
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            return npz['arr_0']
+
+
+class NpyCodec(Codec):
+    # Loaded memory-mapped from files
+    name = 'npy'
+    ext = '.npy'
+
+    def encode(self, value) -> bytes:
+        f = io.BytesIO()
+        np.save(f, value, allow_pickle=False)
+        return f.getvalue()
+
+    def decode(self, data: bytes):
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def load(self, file_name: str):
+        return np.load(file_name, mmap_mode='r', allow_pickle=False)
+
+
+_RAW_HEADER = struct.Struct('!BB')  # length of the dtype string, number of dimensions
+_RAW_DIM = struct.Struct('!Q')
+
+
+class RawCodec(Codec):
+    # The bytes of an array after a header with its dtype and shape. No compression.
+    name = 'raw'
+    ext = '.raw'
+
+    def encode(self, value) -> bytes:
+        value = np.ascontiguousarray(value)
+        dtype = value.dtype.str.encode()
+        return b"".join(
+            [_RAW_HEADER.pack(len(dtype), value.ndim), dtype] +
+            [_RAW_DIM.pack(dim) for dim in value.shape] +
+            [value.tobytes()]
+        )
+
+    def decode(self, data: bytes):
+        dtype_length, ndim = _RAW_HEADER.unpack_from(data)
+        offset = _RAW_HEADER.size
+        dtype = np.dtype(bytes(data[offset:offset + dtype_length]).decode())
+        offset += dtype_length
+        shape = tuple(_RAW_DIM.unpack_from(data, offset + index * _RAW_DIM.size)[0] for index in range(ndim))
+        offset += ndim * _RAW_DIM.size
+        return np.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+
+class ZlibCodec(RawCodec):
+    # Raw arrays compressed with zlib. level: 1 (fastest) to 9.
+    name = 'zlib'
+    ext = '.zlib'
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def encode(self, value) -> bytes:
+        return zlib.compress(super().encode(value), self.level)
+
+    def decode(self, data: bytes):
+        return super().decode(bytearray(zlib.decompress(data)))
+
+
+class LzmaCodec(RawCodec):
+    # Raw arrays compressed with lzma (xz). preset: 0 (fastest) to 9.
+    name = 'lzma'
+    ext = '.xz'
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def encode(self, value) -> bytes:
+        return lzma.compress(super().encode(value), preset=self.preset)
+
+    def decode(self, data: bytes):
+        return super().decode(bytearray(lzma.decompress(data)))
+
+
+_codec_factories = {}  # type: Dict[str, Callable[..., Codec]]
+
+
+def register_codec(name: str, factory: Callable[..., Codec]):
+    # factory is called with the parameters given along with the name, e.g. a Codec subclass
+    _codec_factories[name] = factory
+
+
+def make_codec(spec: Union[str, Dict[str, Any], Codec]) -> Codec:
+    # spec: a codec, its name, or a dict of its name and parameters like {'name': 'zlib', 'level': 1}
+    if isinstance(spec, Codec):
+        return spec
+    if isinstance(spec, str):
+        name, params = spec, {}
+    else:
+        params = dict(spec)
+        name = params.pop('name')
+    try:
+        factory = _codec_factories[name]
+    except KeyError:
+        raise ValueError("Unknown codec {!r}".format(name))
+    return factory(**params)
+
+
+for codec_class in (BytesCodec, TextCodec, PNGCodec, NpzCodec, NpyCodec, RawCodec, ZlibCodec, LzmaCodec):
+    register_codec(codec_class.name, codec_class)
+
+
+DEFAULT_CODECS = {
+    'image': 'png',
+    'numpy.ndarray': 'npz',
+    'text': 'text',
+}
+
+
+def default_codec_name(format: str) -> str:
+    return DEFAULT_CODECS.get(format, 'bytes')
+
+
+class CodecChoice:
+    '''
+    Codecs of a bucket, given by channel name or format in `codecs`.
+    Channel names take precedence; unlisted formats keep their defaults.
+    '''
+    def __init__(self, codecs: Optional[Dict[str, Any]] = None):
+        self.codecs = {key: make_codec(spec) for key, spec in (codecs or {}).items()}
+        self._decoders = {}  # type: Dict[str, Codec]
+
+    def for_channel(self, channel_name: str, format: str) -> Codec:
+        codecs = self.codecs
+        codec = codecs.get(channel_name) or codecs.get(format)
+        if codec is None:
+            codec = codecs[format] = make_codec(default_codec_name(format))
+        return codec
+
+    def by_name(self, name: Optional[str], format: str) -> Codec:
+        # Decodes values recorded with `name`, or with the default of their format if not recorded
+        if name is None:
+            name = default_codec_name(format)
+        try:
+            return self._decoders[name]
+        except KeyError:
+            codec = self._decoders[name] = make_codec(name)
+            return codec
@@ -0,0 +1,315 @@
+import os
+import json
+import socket
+import logging
+import threading
+import weakref
+
+from contextlib import contextmanager
+from os.path import join
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# (source record fingerprint, chain hash) a record was computed from
+Provenance = Optional[Tuple[str, str]]
+
+
+def _writer_alive(token: str) -> bool:
+    # token: "host:pid:nonce". Writers on other hosts cannot be told apart from live ones.
+    host, pid, _ = token.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _log_line(op: str, id: str, provenance: Provenance = None) -> str:
+    if provenance is None:
+        return json.dumps([op, id])
+    return json.dumps([op, id, list(provenance)])
+
+
+def _apply_line(ids: Dict[str, Provenance], line: str):
+    op, id, *provenance = json.loads(line)
+    if op == "+":
+        ids[id] = tuple(provenance[0]) if provenance else None
+    else:
+        ids.pop(id, None)
+
+
+class IdManifest:
+    '''
+    Ids of the records in a bucket directory, so that listing them takes no directory scan.
+
+    ids.log holds one JSON line per id added ("+") or removed ("-"), sorted when rewritten and appended to after.
+    Added ids carry the provenance they were saved with, if any, so that incremental runs need not read
+    every record. Ids only known from a scan have none.
+    ids.json is the header: the number of ids, the latest record timestamp, the size of ids.log it accounts for,
+    how many times ids.log was rewritten, and the writers whose changes are not in ids.log yet.
+    A writer lists itself before its first change after a sync() and leaves once sync() made them durable.
+
+    Several processes may write at once. ids.json and ids.log are only changed under a lock on ids.lock,
+    and sync() merges what other writers synced meanwhile instead of overwriting it.
+    While other writers are listed, the ids are scanned with `scan`. So are they if ids.log is not
+    the size ids.json accounts for, or a listed writer died; the recovered ids are then written back
+    once no writer is left. Without file locks (on Windows), the ids are always scanned.
+    '''
+    HEADER_NAME = "ids.json"
+    LOG_NAME = "ids.log"
+    LOCK_NAME = "ids.lock"
+
+    def __init__(self, directory: str, scan: Callable[[], Iterable[str]]):
+        self.directory = directory
+        self.scan = scan
+        self.latest_timestamp = 0
+        self.token = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid4().hex[:8])
+        self._lock = threading.RLock()
+        self._ids = {}  # type: Dict[str, Provenance]  # ordered
+        self._pending = []  # type: List[str]
+        self._num_lines = 0
+        self._log_size = None  # type: Optional[int]
+        self._generation = None  # type: Optional[int]
+        self._dirty = False
+        self._header_stat = None  # type: Optional[Tuple[int, int, int]]
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._ids
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._ids)
+
+    def provenances(self) -> Dict[str, Provenance]:
+        # None for ids saved without one, or only known from a scan
+        with self._lock:
+            return dict(self._ids)
+
+    @property
+    def _header_path(self) -> str:
+        return join(self.directory, self.HEADER_NAME)
+
+    @property
+    def _log_path(self) -> str:
+        return join(self.directory, self.LOG_NAME)
+
+    @contextmanager
+    def _file_lock(self):
+        with open(join(self.directory, self.LOCK_NAME), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _stat_header(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self._header_path)
+        except FileNotFoundError:
+            return None
+        # Rewritten through a new file each time, so the inode tells changes apart within the mtime resolution
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_header(self) -> Optional[dict]:
+        self._header_stat = self._stat_header()
+        if self._header_stat is None:
+            return None
+        with open(self._header_path) as f:
+            return json.load(f)
+
+    def _log_matches(self, header: Optional[dict]) -> bool:
+        # Whether ids.log is exactly what the header accounts for
+        if header is None or header.get('log_size') is None or 'writers' not in header:
+            return False
+        try:
+            return os.path.getsize(self._log_path) == header['log_size']
+        except FileNotFoundError:
+            return False
+
+    def _read_log(self, ids: Dict[str, Provenance], offset: int = 0) -> int:
+        # Applies the lines of ids.log past offset to ids. Returns the number of lines.
+        num_lines = 0
+        with open(self._log_path) as f:
+            f.seek(offset)
+            for line in f:
+                _apply_line(ids, line)
+                num_lines += 1
+        return num_lines
+
+    def _load(self):
+        if fcntl is None:
+            self._ids = dict.fromkeys(self.scan())
+            return
+        with self._file_lock():
+            header = self._read_header()
+            writers = header.get('writers', []) if header is not None else []
+            ids = {}
+            if self._log_matches(header) and not writers:
+                self._num_lines = self._read_log(ids)
+                self._log_size, self._generation = header['log_size'], header['generation']
+                self.latest_timestamp = header['latest_timestamp']
+            else:
+                ids = dict.fromkeys(self.scan())
+                if header is not None:
+                    self.latest_timestamp = header.get('latest_timestamp', 0)
+                if any(_writer_alive(token) for token in writers):
+                    # Written back by the writers once they sync
+                    self._log_size = self._generation = None
+                else:
+                    if header is not None or os.path.exists(self._log_path):
+                        logger.warning("The id manifest of %s is not clean. Scanned the records.", self.directory)
+                    # Persisted, so that the next open does not scan again
+                    self._rewrite_log(ids, header)
+                    self._write_header(ids, writers=[])
+        self._ids = ids
+
+    def refresh(self):
+        # Reloads what writers in other processes synced since
+        with self._lock:
+            if self._dirty or self._pending:
+                return
+            if fcntl is None or self._stat_header() != self._header_stat:
+                self._load()
+
+    def _dump_header(self, header: dict, durable: bool):
+        # Under the file lock. Tmp names are unique, so that a crashed writer leaves no file in the way.
+        tmp_path = "{}.{}.tmp".format(self._header_path, uuid4().hex)
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self._header_path)
+        self._header_stat = self._stat_header()
+
+    def _write_header(self, ids: Dict[str, Provenance], writers: List[str]):
+        self._dump_header({
+            'count': len(ids),
+            'latest_timestamp': self.latest_timestamp,
+            'log_size': self._log_size,
+            'generation': self._generation,
+            'writers': writers,
+        }, durable=True)
+
+    def _rewrite_log(self, ids: Dict[str, Provenance], previous: Optional[dict]):
+        lines = [_log_line("+", id, ids[id]) for id in sorted(ids)]
+        tmp_path = "{}.{}.tmp".format(self._log_path, uuid4().hex)
+        with open(tmp_path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._log_path)
+        self._num_lines = len(lines)
+        self._log_size = os.path.getsize(self._log_path)
+        generation = previous.get('generation') if previous is not None else None
+        self._generation = (generation or 0) + 1
+
+    def _changing(self):
+        # Lists this writer in the header, so that other processes do not trust ids.log until it synced
+        if self._dirty or fcntl is None:
+            self._dirty = True
+            return
+        with self._file_lock():
+            header = self._read_header()
+            if header is None:
+                header = {'count': 0, 'latest_timestamp': 0, 'log_size': None, 'generation': None, 'writers': []}
+            header['writers'] = list(header.get('writers', [])) + [self.token]
+            self._dump_header(header, durable=False)
+        self._dirty = True
+
+    def add(self, id: str, timestamp: float, provenance: Provenance = None):
+        with self._lock:
+            if timestamp is not None and timestamp > self.latest_timestamp:
+                self._changing()
+                self.latest_timestamp = timestamp
+            if id in self._ids and self._ids[id] == provenance and self._log_size is not None:
+                return
+            # Ids scanned while other writers were listed may not be logged by anyone yet, our own included
+            self._changing()
+            self._ids[id] = provenance
+            self._pending.append(_log_line("+", id, provenance))
+
+    def remove(self, id: str):
+        with self._lock:
+            if id not in self._ids:
+                return
+            self._changing()
+            del self._ids[id]
+            self._pending.append(_log_line("-", id))
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            if fcntl is None:
+                self._pending.clear()
+                self._dirty = False
+                return
+            with self._file_lock():
+                header = self._read_header()
+                writers = [token for token in (header or {}).get('writers', []) if token != self.token]
+                live_writers = [token for token in writers if _writer_alive(token)]
+                if self._log_matches(header) and len(live_writers) == len(writers):
+                    ids = self._ids
+                    if (self._log_size is not None and header['generation'] == self._generation
+                            and header['log_size'] >= self._log_size):
+                        # Lines other writers appended since, then ours again, which come after them
+                        num_lines = self._num_lines + self._read_log(ids, self._log_size)
+                    else:
+                        ids = {}
+                        num_lines = self._read_log(ids)
+                    for line in self._pending:
+                        _apply_line(ids, line)
+                    self.latest_timestamp = max(self.latest_timestamp, header['latest_timestamp'])
+                    self._num_lines, self._log_size, self._generation = num_lines, header['log_size'], header['generation']
+                    if self._num_lines + len(self._pending) > 2 * len(ids) + 1024:
+                        self._rewrite_log(ids, header)
+                    elif self._pending:
+                        with open(self._log_path, "a") as f:
+                            f.write("".join(line + "\n" for line in self._pending))
+                            f.flush()
+                            os.fsync(f.fileno())
+                        self._num_lines += len(self._pending)
+                        self._log_size = os.path.getsize(self._log_path)
+                else:
+                    # A writer died or ids.log is torn. The records on disk are what counts.
+                    logger.warning("The id manifest of %s is not clean. Scanning the records.", self.directory)
+                    ids = dict.fromkeys(self.scan())
+                    if header is not None:
+                        self.latest_timestamp = max(self.latest_timestamp, header.get('latest_timestamp', 0))
+                    self._rewrite_log(ids, header)
+                    writers = live_writers
+                self._write_header(ids, writers)
+            self._ids = ids
+            self._pending.clear()
+            self._dirty = False
+
+
+_open_manifests = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+_open_manifests_lock = threading.Lock()
+
+
+def open_id_manifest(directory: str, scan: Callable[[], Iterable[str]]) -> IdManifest:
+    # Buckets on the same directory share their manifest, so that they see each other's writes
+    key = os.path.realpath(directory)
+    with _open_manifests_lock:
+        manifest = _open_manifests.get(key)
+        if manifest is None:
+            manifest = _open_manifests[key] = IdManifest(directory, scan)
+        return manifest
@@ -9,7 +9,7 @@ from os.path import splitext
 from dateutil.parser import parse as parse_datetime
 from datetime import datetime
 from os.path import isfile, isdir, join
-from typing import Tuple, Iterator, Optional, Any, Dict, List
+from typing import Tuple, Iterator, Optional, Any, Dict, List, AbstractSet
 from hashlib import sha1
 from PIL import Image
 from uuid import uuid4
@@ -19,27 +19,53 @@ from ...pbase import Source, Sink, SourceDataVersion, SinkDataVersion, Transform
 from ..bucket_metadata import BucketMetadata
 from ..bucket_version import BucketVersion
 from ..base_storage import Bucket
+from .id_manifest import IdManifest, open_id_manifest
+from .codecs import CodecChoice
 
 
 from contextlib import contextmanager
+from functools import partial
+
+
+ARRAY_ENCODINGS = ('npz', 'npy')
+
 
 class PBucket(Bucket):
+    # codecs: channel name or format -> codec name, {'name': ..., **params} or Codec (see codecs.py),
+    # e.g. {'image': {'name': 'png', 'compress_level': 1}, 'features': 'npy'}.
+    # array_encodings: channel name -> 'npz' (compressed, the default) or 'npy' (raw, read memory-mapped).
+    # The codec is recorded per record, so that changing it only affects records written afterwards.
     META_VERSION = BucketVersion.parse('0.0.1')
 
     def __init__(self, storage,
                  scope: Tuple[str],
                  use_batch: bool,
                  batch_size: Optional[int],
-                 flush_interval: float):
+                 flush_interval: float,
+                 incremental: bool = False,
+                 writers: int = 0,
+                 write_queue_size: Optional[int] = None,
+                 array_encodings: Optional[Dict[str, str]] = None,
+                 codecs: Optional[Dict[str, Any]] = None):
         super().__init__(
             storage=storage,
             scope=scope,
             use_batch=use_batch,
             batch_size=batch_size,
             flush_interval=flush_interval,
+            incremental=incremental,
+            writers=writers,
+            write_queue_size=write_queue_size,
         )
         self._last_flush_time = None
         self._dir_check_cache = {}
+        self._manifest = None  # type: Optional[IdManifest]
+        self.array_encodings = dict(array_encodings or {})
+        for channel_name, encoding in self.array_encodings.items():
+            if encoding not in ARRAY_ENCODINGS:
+                raise ValueError("Unknown encoding {!r} of channel {!r}".format(encoding, channel_name))
+        self.codecs = dict(codecs or {})
+        self.codec_choice = CodecChoice({**self.array_encodings, **self.codecs})
 
     @contextmanager
     def read_context(self):
@@ -49,15 +75,33 @@ class PBucket(Bucket):
     def read_write_context(self):
         yield
 
-    def load_ids(self, our) -> Iterator[str]:
-        self._ensure_pbucket_dir(our)
-        directory_name, data_directory_name = self.directory_name, self.data_directory_name
-        for file_name in os.listdir(data_directory_name):
+    @property
+    def manifest(self) -> IdManifest:
+        manifest = self._manifest
+        if manifest is None:
+            manifest = self._manifest = open_id_manifest(self.directory_name, self._scan_ids)
+        return manifest
+
+    def _scan_ids(self) -> Iterator[str]:
+        # Only to recover the manifest, or while other processes are writing
+        for file_name in os.listdir(self.data_directory_name):
             id_str, file_ext = splitext(file_name)
             if file_ext != '.json':
                 continue
             yield id_str
 
+    def load_ids(self, our) -> Iterator[str]:
+        self._ensure_pbucket_dir(our)
+        manifest = self.manifest
+        manifest.refresh()
+        return iter(manifest.ids())
+
+    def count(self, our=None) -> int:
+        self._ensure_pbucket_dir(our)
+        manifest = self.manifest
+        manifest.refresh()
+        return len(manifest)
+
     def load_metadata(self, our) -> BucketMetadata:
         self._ensure_pbucket_dir(our)
         meta_name = self.meta_name
@@ -66,6 +110,9 @@ class PBucket(Bucket):
             return BucketMetadata.from_json(data)
 
     def flush_metadata(self, our, metadata: BucketMetadata):
+        if self._manifest is not None:
+            # The metadata accounts for the records listed in it
+            self._manifest.sync()
         meta_name = self.meta_name
         meta_tmp_name = self.meta_tmp_name
 
@@ -80,7 +127,7 @@ class PBucket(Bucket):
             f.write(json.dumps(metadata.to_json()))
         os.rename(meta_tmp_name, meta_name)
 
-    def load_precord(self, our, id: str):
+    def load_precord(self, our, id: str, channels: Optional[AbstractSet[str]] = None):
         data_directory_name = self.data_directory_name
         file_name = join(data_directory_name, id + ".json")
         try:
@@ -94,35 +141,20 @@ class PBucket(Bucket):
         channel_formats = d['channel_formats']
         timestamp = d['timestamp']
         data = d['data']
+        encodings = d.get('encodings', {})
         channel_atoms = {}
         for channel_name, format in zip(channel_names, channel_formats):
-            value = None
+            if channels is not None and channel_name not in channels:
+                continue
             if format == 'data':
-                value = data.get(channel_name)
+                channel_atoms[channel_name] = PAtom(value=data.get(channel_name), format=format)
             else:
                 channel_dir_name = self.ensure_sub_dir(channel_name)
-                if format == 'image':
-                    ext = '.png'
-                elif format == 'numpy.ndarray':
-                    ext = '.npz'
-                elif format == 'text':
-                    ext = '.txt'
-                else:
-                    ext = '.dat'
-                value_file_name = join(channel_dir_name, id + ext)
-
-                if format == 'image':
-                    with Image.open(value_file_name) as img:
-                        value = np.array(img)
-                elif format == 'numpy.ndarray':
-                    value = np.load(value_file_name)
-                elif format == 'text':
-                    with open(value_file_name, "r") as f:
-                        value = f.read()
-                else:
-                    with open(value_file_name, "rb") as f:
-                        value = f.read()
-            channel_atoms[channel_name] = PAtom(value=value, format=format)
+                codec = self.codec_choice.by_name(encodings.get(channel_name), format)
+                channel_atoms[channel_name] = PAtom.lazy(
+                    partial(codec.load, join(channel_dir_name, id + codec.ext)),
+                    format,
+                )
         return PRecord(
             id=id,
             channel_atoms=channel_atoms,
@@ -131,11 +163,51 @@ class PBucket(Bucket):
         )
 
 
-    def save_precord(self, our, precord: PRecord):
+    def load_provenance(self, our, id: str) -> Optional[Tuple[str, str]]:
+        file_name = join(self.data_directory_name, id + ".json")
+        try:
+            with open(file_name) as f:
+                provenance = json.load(f).get('provenance')
+        except FileNotFoundError:
+            return None
+        return tuple(provenance) if provenance is not None else None
+
+    def load_provenances(self, our) -> Dict[str, Optional[Tuple[str, str]]]:
+        self._ensure_pbucket_dir(our)
+        manifest = self.manifest
+        manifest.refresh()
+        provenances = manifest.provenances()
+        for id, provenance in provenances.items():
+            if provenance is None:
+                # Saved without one, or only known from a scan of the records
+                provenances[id] = self.load_provenance(our, id)
+        return provenances
+
+    def delete_precord(self, our, id: str):
+        file_name = join(self.data_directory_name, id + ".json")
+        try:
+            with open(file_name) as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return
+        encodings = d.get('encodings', {})
+        for channel_name, format in zip(d['channel_names'], d['channel_formats']):
+            if format == 'data':
+                continue
+            try:
+                codec = self.codec_choice.by_name(encodings.get(channel_name), format)
+                os.remove(join(self.get_sub_dir(channel_name), id + codec.ext))
+            except FileNotFoundError:
+                pass
+        os.remove(file_name)
+        self.manifest.remove(id)
+
+    def save_precord(self, our, precord: PRecord, provenance: Optional[Tuple[str, str]] = None):
         directory_name, data_directory_name = self.directory_name, self.data_directory_name
         data_file_name = join(data_directory_name, precord.id + ".json")
         channel_names = list(precord.channels)
         data = {}
+        encodings = {}
         d = {
             "id": precord.id,
             "active_channel": precord.active_channel,
@@ -143,7 +215,10 @@ class PBucket(Bucket):
             "channel_formats": [precord.get_atom(name).format for name in channel_names],
             "timestamp": precord.timestamp,
             "data": data,
+            "encodings": encodings,
         }
+        if provenance is not None:
+            d["provenance"] = list(provenance)
 
         id = precord.id
         for channel_name in precord.channels:
@@ -152,32 +227,21 @@ class PBucket(Bucket):
             if format == 'data':
                 data[channel_name] = value
                 continue
-            elif format == 'image':
-                ext = '.png'
-            elif format == 'numpy.ndarray':
-                ext = '.npz'
-            elif format == 'text':
-                ext = '.txt'
-            else:
-                ext = '.dat'
 
+            codec = self.codec_choice.for_channel(channel_name, format)
+            encodings[channel_name] = codec.name
             channel_dir_name = self.ensure_sub_dir(channel_name)
-            value_file_name = join(channel_dir_name, id + ext)
-
-            if format == 'image':
-                Image.fromarray(value).save(value_file_name)
-            elif format == 'numpy.ndarray':
-                np.savez_compressed(value_file_name)
-            elif format == 'text':
-                with open(value_file_name, "w") as f:
-                    f.write(value)
-            else:
-                with open(value_file_name, "wb") as f:
-                    f.write(value)
+            value_file_name = join(channel_dir_name, id + codec.ext)
+            # Replaced rather than overwritten, as readers may have the old file mapped
+            tmp_file_name = value_file_name + ".tmp"
+            with open(tmp_file_name, "wb") as f:
+                f.write(codec.encode(value))
+            os.replace(tmp_file_name, value_file_name)
 
         file_name = join(self.data_directory_name, id + ".json")
         with open(file_name, "w") as f:
             json.dump(d, f)
+        self.manifest.add(id, precord.timestamp, provenance)
 
 
     @property
@@ -5,15 +5,39 @@ import time
 import logging
 
 from os.path import isfile, isdir, join
-from typing import Optional
+from typing import Optional, Tuple
 
 from .pbucket import PBucket
+from .segment_bucket import SegmentBucket, migrate_to_segments
 from ..base_storage import Storage
 
 class PStorage(Storage):
+    # layout: 'files' writes a file per record and channel, 'segments' appends records to segment files.
+    # Existing buckets are opened in the layout they were written in.
     bucket_class = PBucket
-    def __init__(self, base_dir='.'):
+    def __init__(self, base_dir='.', layout: str = 'files', segment_size: int = 256 << 20, compact_ratio: float = 0.5):
+        if layout not in ('files', 'segments'):
+            raise ValueError("Unknown layout {!r}".format(layout))
         self.base_dir = base_dir
+        self.layout = layout
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        if layout == 'segments':
+            self.bucket_class = SegmentBucket
+
+    def bucket_class_for(self, scope: Tuple[str]):
+        directory_name = join(self.base_dir, *scope)
+        if isdir(join(directory_name, 'pbkt.segments')):
+            return SegmentBucket
+        elif isdir(join(directory_name, 'pbkt_data')):
+            return PBucket
+        return self.bucket_class
+
+    def migrate_to_segments(self, name: str, remove_old: bool = False) -> SegmentBucket:
+        bucket = self.bucket(name)
+        if isinstance(bucket, SegmentBucket):
+            return bucket
+        return migrate_to_segments(bucket, remove_old=remove_old)
 
     def find(self, prefix):
         prefix = prefix.lstrip("/").rstrip("/")
@@ -0,0 +1,268 @@
+import io
+import os
+import json
+import shutil
+import struct
+import numpy as np
+
+from os.path import isdir, join
+from typing import Tuple, Iterator, Optional, AbstractSet, Dict, Any
+from functools import partial
+
+from ...pdatastructures import PAtom, PRecord
+from ...pbase import We
+from .pbucket import PBucket
+from .codecs import CodecChoice
+from .segment_log import SegmentLog, Location, open_segment_log
+
+
+_HEADER_LENGTH = struct.Struct('!I')
+_HEADER_READ_SIZE = 4096
+
+
+def _read_npy_header(head: bytes) -> Optional[Tuple[tuple, bool, np.dtype, int]]:
+    # shape, fortran_order, dtype and the size of the header, or None if it is longer than head
+    f = io.BytesIO(head)
+    try:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    except ValueError:
+        if len(head) < _HEADER_READ_SIZE:
+            raise
+        return None
+    return shape, fortran_order, dtype, f.tell()
+
+
+def encode_precord(precord: PRecord,
+                   provenance: Optional[Tuple[str, str]] = None,
+                   codec_choice: Optional[CodecChoice] = None) -> bytes:
+    # A JSON header as PBucket writes it, followed by the encoded non-data channels
+    codec_choice = codec_choice or CodecChoice()
+    channel_names = list(precord.channels)
+    data = {}
+    blob_sizes = {}
+    encodings = {}
+    blobs = []
+    d = {
+        "id": precord.id,
+        "active_channel": precord.active_channel,
+        "channel_names": channel_names,
+        "channel_formats": [precord.get_atom(name).format for name in channel_names],
+        "timestamp": precord.timestamp,
+        "data": data,
+        "blob_sizes": blob_sizes,
+        "encodings": encodings,
+    }
+    if provenance is not None:
+        d["provenance"] = list(provenance)
+    for channel_name in channel_names:
+        patom = precord.get_atom(channel_name)
+        if patom.format == 'data':
+            data[channel_name] = patom.value
+            continue
+        codec = codec_choice.for_channel(channel_name, patom.format)
+        encodings[channel_name] = codec.name
+        blob = codec.encode(patom.value)
+        blob_sizes[channel_name] = len(blob)
+        blobs.append(blob)
+    header = json.dumps(d).encode()
+    return b"".join([_HEADER_LENGTH.pack(len(header)), header] + blobs)
+
+
+class SegmentBucket(PBucket):
+    '''
+    PBucket laid out as an append-only SegmentLog in pbkt.segments/ instead of a file per record and channel.
+    Sizes of segments are taken from the storage.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._log = None  # type: Optional[SegmentLog]
+
+    @property
+    def data_directory_name(self):
+        return join(self.directory_name, 'pbkt.segments')
+
+    @property
+    def log(self) -> SegmentLog:
+        log = self._log
+        if log is None:
+            log = self._log = open_segment_log(
+                self.data_directory_name,
+                segment_size=self.storage.segment_size,
+                compact_ratio=self.storage.compact_ratio,
+            )
+        return log
+
+    def load_ids(self, our) -> Iterator[str]:
+        self._ensure_pbucket_dir(our)
+        log = self.log
+        log.refresh()
+        return iter(log.ids())
+
+    def count(self, our=None) -> int:
+        self._ensure_pbucket_dir(our)
+        log = self.log
+        log.refresh()
+        return len(log)
+
+    def _read_header(self, location: Location) -> Tuple[Dict[str, Any], int]:
+        # The header and the offset of the first blob
+        segment, offset, length = location
+        head = self.log.read_at(segment, offset, min(length, _HEADER_READ_SIZE))
+        header_length, = _HEADER_LENGTH.unpack_from(head)
+        end = _HEADER_LENGTH.size + header_length
+        if end > len(head):
+            head = self.log.read_at(segment, offset, end)
+        return json.loads(head[_HEADER_LENGTH.size:end]), offset + end
+
+    def _load_header(self, id: str) -> Optional[Tuple[int, Dict[str, Any], int]]:
+        log = self.log
+        while True:
+            location = log.locate(id)
+            if location is None:
+                return None
+            try:
+                return (location[0], ) + self._read_header(location)
+            except KeyError:
+                # Compacted meanwhile
+                continue
+
+    def _map_array(self, segment: int, offset: int, size: int) -> np.ndarray:
+        # Views the array right in the segment file
+        log = self.log
+        head = log.read_at(segment, offset, min(size, _HEADER_READ_SIZE))
+        parsed = _read_npy_header(head)
+        if parsed is None:
+            parsed = _read_npy_header(log.read_at(segment, offset, size))
+        shape, fortran_order, dtype, header_size = parsed
+        if size == header_size:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(
+            log.segment_path(segment), dtype=dtype, mode='r', offset=offset + header_size,
+            shape=shape, order='F' if fortran_order else 'C',
+        )
+
+    def _load_blob(self, id: str, channel_name: str, segment: int, offset: int, size: int, format: str, encoding: str):
+        try:
+            if encoding == 'npy':
+                return self._map_array(segment, offset, size)
+            data = self.log.read_at(segment, offset, size)
+        except KeyError:
+            # Compacted after the record was loaded. Read the copy.
+            loaded = self._load_header(id)
+            if loaded is None:
+                raise KeyError("{} was deleted from {!r}".format(id, self))
+            segment, header, offset = loaded
+            for name, blob_size in header['blob_sizes'].items():
+                if name == channel_name:
+                    return self._load_blob(id, channel_name, segment, offset, blob_size, format, encoding)
+                offset += blob_size
+            raise KeyError(channel_name)
+        return self.codec_choice.by_name(encoding, format).decode(data)
+
+    def load_precord(self, our, id: str, channels: Optional[AbstractSet[str]] = None):
+        loaded = self._load_header(id)
+        if loaded is None:
+            return None
+        segment, d, offset = loaded
+        data, blob_sizes = d['data'], d['blob_sizes']
+        encodings = d.get('encodings', {})
+        channel_atoms = {}
+        for channel_name, format in zip(d['channel_names'], d['channel_formats']):
+            if format == 'data':
+                if channels is None or channel_name in channels:
+                    channel_atoms[channel_name] = PAtom(value=data.get(channel_name), format=format)
+                continue
+            size = blob_sizes[channel_name]
+            if channels is None or channel_name in channels:
+                # Arrays of records written without encodings are raw
+                encoding = encodings.get(channel_name) or self.codec_choice.by_name(
+                    'npy' if format == 'numpy.ndarray' else None, format,
+                ).name
+                channel_atoms[channel_name] = PAtom.lazy(
+                    partial(self._load_blob, id, channel_name, segment, offset, size, format, encoding),
+                    format,
+                )
+            offset += size
+        return PRecord(
+            id=d['id'],
+            channel_atoms=channel_atoms,
+            timestamp=d['timestamp'],
+            active_channel=d['active_channel'],
+        )
+
+    def load_provenance(self, our, id: str) -> Optional[Tuple[str, str]]:
+        loaded = self._load_header(id)
+        if loaded is None:
+            return None
+        provenance = loaded[1].get('provenance')
+        return tuple(provenance) if provenance is not None else None
+
+    def load_provenances(self, our) -> Dict[str, Optional[Tuple[str, str]]]:
+        # No manifest here. Headers are read from the open segments, not from a file per record.
+        return {id: self.load_provenance(our, id) for id in list(self.load_ids(our))}
+
+    def delete_precord(self, our, id: str):
+        self.log.delete(id)
+
+    def save_precord(self, our, precord: PRecord, provenance: Optional[Tuple[str, str]] = None):
+        self.log.put(precord.id, encode_precord(precord, provenance, self.codec_choice))
+
+    def flush_metadata(self, our, metadata):
+        # Records are made durable before the metadata that accounts for them
+        self.log.sync()
+        super().flush_metadata(our, metadata)
+        self.log.maybe_compact()
+
+    def compact(self):
+        # Compacts segments with enough garbage at once rather than in the background
+        log = self.log
+        log.wait_compaction()
+        log.compact()
+
+
+def migrate_to_segments(bucket: PBucket, remove_old: bool = False) -> SegmentBucket:
+    '''
+    Copies the records of a bucket in the file-per-record layout to a segment log next to them.
+    Metadata is kept, so pipelines reading the bucket see the same data version.
+    The segment log only takes over once complete. Old files are removed if `remove_old` is set.
+    '''
+    our = We()
+    storage, scope = bucket.storage, bucket.scope
+    segment_bucket = SegmentBucket(
+        storage=storage,
+        scope=scope,
+        use_batch=bucket.use_batch,
+        batch_size=bucket.batch_size,
+        flush_interval=bucket.flush_interval,
+        incremental=bucket.incremental,
+        writers=bucket.writers,
+        write_queue_size=bucket.write_queue_size,
+        array_encodings=bucket.array_encodings,
+        codecs=bucket.codecs,
+    )
+    target_dir = segment_bucket.data_directory_name
+    if isdir(target_dir):
+        raise FileExistsError("{} is already migrated".format(bucket.directory_name))
+    tmp_dir = target_dir + ".migrating"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    log = SegmentLog(tmp_dir, segment_size=storage.segment_size, compact_ratio=storage.compact_ratio)
+    with bucket.read_context():
+        for id in bucket.load_ids(our):
+            precord = bucket.load_precord(our, id)
+            if precord is None:
+                continue
+            log.put(id, encode_precord(precord, bucket.load_provenance(our, id), segment_bucket.codec_choice))
+    log.close()
+    os.rename(tmp_dir, target_dir)
+
+    if remove_old:
+        directory_name = bucket.directory_name
+        for name in os.listdir(directory_name):
+            path = join(directory_name, name)
+            if name.startswith('pbkt_') and isdir(path):
+                shutil.rmtree(path)
+    return segment_bucket
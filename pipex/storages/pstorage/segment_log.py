@@ -0,0 +1,420 @@
+import os
+import json
+import zlib
+import struct
+import logging
+import threading
+import weakref
+
+from os.path import join, isfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# flag, id length, payload length, crc32 of id and payload
+_ENTRY = struct.Struct('!BHQI')
+_PUT = 0
+_DELETE = 1
+
+Location = Tuple[int, int, int]  # segment number, payload offset, payload length
+
+
+def _segment_name(segment: int) -> str:
+    return "seg_{:08d}.log".format(segment)
+
+
+def _parse_segment_name(name: str) -> Optional[int]:
+    if name.startswith("seg_") and name.endswith(".log"):
+        try:
+            return int(name[4:-4])
+        except ValueError:
+            return None
+    return None
+
+
+class SegmentLog:
+    '''
+    Records appended to large segment files under `directory`, with an offset index by id.
+
+    A segment is sealed once it reaches `segment_size` bytes and the next one is started.
+    Rewrites and deletions append a new entry, or a tombstone, and leave garbage behind in older segments.
+    Sealed segments with at least `compact_ratio` of garbage are compacted by copying
+    their live entries to the active segment, in a background thread.
+
+    The index is kept in memory and logged to index.log, one JSON line per change,
+    written by sync() after the segments it points into are durable. On open,
+    index.log is replayed and segments are scanned only past the last indexed entry.
+    Without index.log, every segment is scanned.
+
+    One writer per directory. Other processes may read what was synced.
+    '''
+    INDEX_NAME = "index.log"
+
+    def __init__(self, directory: str, segment_size: int = 256 << 20, compact_ratio: float = 0.5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._index = {}  # type: Dict[str, Location]
+        self._sizes = {}  # type: Dict[int, int]
+        self._live_bytes = {}  # type: Dict[int, int]
+        self._fds = {}  # type: Dict[int, int]
+        self._writer = None
+        self._writer_segment = None
+        self._dirty = False
+        self._pending_index = []  # type: List[str]
+        self._num_index_lines = 0
+        self._index_stale = False
+        self._tail = (0, 0)
+        self._compactor = None  # type: Optional[threading.Thread]
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._index
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._index)
+
+    def locate(self, id: str) -> Optional[Location]:
+        return self._index.get(id)
+
+    # Loading
+
+    def segment_path(self, segment: int) -> str:
+        return join(self.directory, _segment_name(segment))
+
+    @property
+    def _index_path(self) -> str:
+        return join(self.directory, self.INDEX_NAME)
+
+    def _load(self):
+        for name in sorted(os.listdir(self.directory)):
+            segment = _parse_segment_name(name)
+            if segment is not None:
+                self._sizes[segment] = os.path.getsize(self.segment_path(segment))
+                self._live_bytes[segment] = 0
+        tail = self._replay_index() if isfile(self._index_path) else None
+        if tail is None:
+            if self._sizes:
+                logger.info("Rebuilding the index of %s from %d segments", self.directory, len(self._sizes))
+            self._index.clear()
+            for segment in self._live_bytes:
+                self._live_bytes[segment] = 0
+            # Rewritten on the next sync
+            self._index_stale = True
+            tail = (min(self._sizes), 0) if self._sizes else (0, 0)
+        self._tail = tail
+        self._scan_tail()
+
+    def _replay_index(self) -> Optional[Tuple[int, int]]:
+        sizes = self._sizes
+        last_segment = max(sizes, default=-1)
+        tail = None
+        num_lines = 0
+        with open(self._index_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # torn by a crash
+                    break
+                num_lines += 1
+                op, id, segment, offset, length = json.loads(line)
+                if segment not in sizes and segment < last_segment:
+                    # Compacted away. Later lines point to the copies.
+                    continue
+                if segment not in sizes or offset + length > sizes[segment]:
+                    # Lines are written after the segments they point into are durable
+                    logger.warning("%s points past its segments", self._index_path)
+                    return None
+                if op == "P":
+                    self._replace(id, (segment, offset, length))
+                elif op == "D":
+                    self._replace(id, None)
+                tail = (segment, offset + length)
+        self._num_index_lines = num_lines
+        if tail is None and sizes:
+            return None
+        return tail or (0, 0)
+
+    def _scan_tail(self):
+        # Indexes the entries written past the tail
+        tail_segment, tail_offset = self._tail
+        for segment in sorted(s for s in self._sizes if s >= tail_segment):
+            start = tail_offset if segment == tail_segment else 0
+            for flag, id, offset, length in self._read_entries(segment, start):
+                self._replace(id, (segment, offset, length) if flag == _PUT else None)
+                self._pending_index.append(_index_line("P" if flag == _PUT else "D", id, segment, offset, length))
+            self._tail = (segment, self._sizes[segment])
+
+    def _read_entries(self, segment: int, offset: int) -> Iterator[Tuple[int, str, int, int]]:
+        size = self._sizes[segment]
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset)
+            while offset < size:
+                header = f.read(_ENTRY.size)
+                if len(header) < _ENTRY.size:
+                    break
+                flag, id_length, length, crc = _ENTRY.unpack(header)
+                id_bytes = f.read(id_length)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload, zlib.crc32(id_bytes)) != crc:
+                    break
+                payload_offset = offset + _ENTRY.size + id_length
+                yield flag, id_bytes.decode(), payload_offset, length
+                offset = payload_offset + length
+        if offset < size:
+            logger.warning("Ignoring %d bytes of a torn entry at the end of %s", size - offset, _segment_name(segment))
+            # Appending resumes from the last good entry
+            self._sizes[segment] = offset
+
+    def refresh(self):
+        # Picks up entries synced by a writer in another process since this log was opened
+        with self._lock:
+            if self._writer is not None:
+                return
+            tail_segment = self._tail[0]
+            for name in os.listdir(self.directory):
+                segment = _parse_segment_name(name)
+                if segment is not None and segment >= tail_segment:
+                    self._sizes[segment] = os.path.getsize(self.segment_path(segment))
+                    self._live_bytes.setdefault(segment, 0)
+            self._scan_tail()
+            # Indexed by the writer already
+            self._pending_index.clear()
+
+    # Reading
+
+    def _fd(self, segment: int) -> int:
+        try:
+            return self._fds[segment]
+        except KeyError:
+            if segment not in self._sizes:
+                raise
+            fd = self._fds[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+            return fd
+
+    def read_at(self, segment: int, offset: int, size: int) -> bytes:
+        # Raises KeyError if the segment is gone, i.e. compacted
+        with self._lock:
+            if self._dirty and segment == self._writer_segment:
+                self._writer.flush()
+                self._dirty = False
+            fd = self._fd(segment)
+        data = os.pread(fd, size, offset)
+        if len(data) < size:
+            raise EOFError("Short read from {}".format(self.segment_path(segment)))
+        return data
+
+    def get(self, id: str) -> Optional[bytes]:
+        location = self._index.get(id)
+        if location is None:
+            return None
+        segment, offset, length = location
+        try:
+            return self.read_at(segment, offset, length)
+        except KeyError:
+            # Compacted meanwhile
+            return self.get(id)
+
+    # Writing
+
+    def _replace(self, id: str, location: Optional[Location]):
+        old = self._index.pop(id, None) if location is None else self._index.get(id)
+        if old is not None:
+            self._live_bytes[old[0]] -= _ENTRY.size + len(id) + old[2]
+        if location is not None:
+            self._index[id] = location
+            self._live_bytes[location[0]] += _ENTRY.size + len(id) + location[2]
+
+    def _open_writer(self):
+        if self._writer is not None and self._sizes[self._writer_segment] < self.segment_size:
+            return
+        if self._writer is not None:
+            # Sealed
+            self._writer.close()
+            segment = self._writer_segment + 1
+        elif self._sizes:
+            segment = max(self._sizes)
+            if self._sizes[segment] >= self.segment_size:
+                segment += 1
+        else:
+            segment = 0
+        path = self.segment_path(segment)
+        if segment in self._sizes:
+            with open(path, "r+b") as f:
+                f.truncate(self._sizes[segment])
+        else:
+            self._sizes[segment] = 0
+            self._live_bytes[segment] = 0
+        self._writer = open(path, "ab")
+        self._writer_segment = segment
+
+    def _append(self, flag: int, id: str, payload: bytes) -> Location:
+        id_bytes = id.encode()
+        header = _ENTRY.pack(flag, len(id_bytes), len(payload), zlib.crc32(payload, zlib.crc32(id_bytes)))
+        self._open_writer()
+        segment = self._writer_segment
+        offset = self._sizes[segment] + _ENTRY.size + len(id_bytes)
+        self._writer.write(header)
+        self._writer.write(id_bytes)
+        self._writer.write(payload)
+        self._sizes[segment] = offset + len(payload)
+        self._dirty = True
+        self._tail = (segment, self._sizes[segment])
+        self._pending_index.append(_index_line("P" if flag == _PUT else "D", id, segment, offset, len(payload)))
+        return segment, offset, len(payload)
+
+    def put(self, id: str, payload: bytes):
+        with self._lock:
+            self._replace(id, self._append(_PUT, id, payload))
+
+    def delete(self, id: str):
+        with self._lock:
+            if id not in self._index:
+                return
+            self._append(_DELETE, id, b"")
+            self._replace(id, None)
+
+    def sync(self):
+        # Makes what was written durable: segments first, the index lines pointing into them next
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+                self._dirty = False
+            if not self._pending_index and not self._index_stale:
+                return
+            if self._index_stale or self._num_index_lines + len(self._pending_index) > 2 * len(self._index) + 1024:
+                self._rewrite_index()
+            else:
+                with open(self._index_path, "a") as f:
+                    f.write("\n".join(self._pending_index) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._num_index_lines += len(self._pending_index)
+            self._pending_index.clear()
+
+    def _rewrite_index(self):
+        # index.log mostly holds superseded lines by now
+        lines = [
+            _index_line("P", id, segment, offset, length)
+            for id, (segment, offset, length) in self._index.items()
+        ]
+        if self._sizes:
+            # Marks the tail, which the last entry indexed may not be
+            segment = max(self._sizes)
+            lines.append(_index_line("T", "", segment, self._sizes[segment], 0))
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            if lines:
+                f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+        self._num_index_lines = len(lines)
+        self._index_stale = False
+
+    # Compaction
+
+    def compaction_candidates(self) -> List[int]:
+        with self._lock:
+            return [
+                segment
+                for segment, size in sorted(self._sizes.items())
+                if segment != self._active_segment() and size > 0
+                and self._live_bytes[segment] <= (1 - self.compact_ratio) * size
+            ]
+
+    def _active_segment(self) -> Optional[int]:
+        if self._writer_segment is not None:
+            return self._writer_segment
+        return max(self._sizes) if self._sizes else None
+
+    def compact(self, segments: Optional[List[int]] = None):
+        for segment in (self.compaction_candidates() if segments is None else segments):
+            self._compact_segment(segment)
+
+    def _compact_segment(self, segment: int):
+        with self._lock:
+            oldest = segment == min(self._sizes)
+        for flag, id, offset, length in list(self._read_entries(segment, 0)):
+            with self._lock:
+                if flag == _PUT:
+                    if self._index.get(id) != (segment, offset, length):
+                        continue
+                    payload = os.pread(self._fd(segment), length, offset)
+                    self._replace(id, self._append(_PUT, id, payload))
+                elif not oldest and id not in self._index:
+                    # A full scan might otherwise bring back the record from an older segment
+                    self._append(_DELETE, id, b"")
+        with self._lock:
+            # Its entries have to be durable elsewhere before it goes away
+            self.sync()
+            fd = self._fds.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+            del self._sizes[segment], self._live_bytes[segment]
+            os.remove(self.segment_path(segment))
+            # Drops the lines pointing into it
+            self._index_stale = True
+            self.sync()
+        logger.info("Compacted %s", _segment_name(segment))
+
+    def maybe_compact(self):
+        # Starts compacting in the background, unless it is already running
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            segments = self.compaction_candidates()
+            if not segments:
+                return
+            self._compactor = threading.Thread(
+                target=self._compact_in_background, args=(segments,),
+                name="SegmentLog compactor", daemon=True,
+            )
+            self._compactor.start()
+
+    def _compact_in_background(self, segments: List[int]):
+        try:
+            self.compact(segments)
+        except Exception:
+            logger.exception("Compaction of %s failed", self.directory)
+
+    def wait_compaction(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def close(self):
+        self.wait_compaction()
+        with self._lock:
+            if self._writer is not None:
+                self.sync()
+                self._writer.close()
+                self._writer = self._writer_segment = None
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+
+def _index_line(op: str, id: str, segment: int, offset: int, length: int) -> str:
+    return json.dumps([op, id, segment, offset, length])
+
+
+_open_logs = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+_open_logs_lock = threading.Lock()
+
+
+def open_segment_log(directory: str, **kwargs) -> SegmentLog:
+    # Buckets on the same directory share their log, so that they see each other's writes
+    key = os.path.realpath(directory)
+    with _open_logs_lock:
+        log = _open_logs.get(key)
+        if log is None:
+            log = _open_logs[key] = SegmentLog(directory, **kwargs)
+        return log
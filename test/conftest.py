@@ -7,3 +7,20 @@ import logging
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 # logging.basicConfig(level=logging.DEBUG)
+
+
+@pytest.fixture
+def leftover_threads():
+    # Returns a function listing the threads started since the test began that are
+    # still alive after being joined for up to `timeout` seconds
+    import time
+    import threading
+
+    before = set(threading.enumerate())
+
+    def leftover(timeout=5.0):
+        deadline = time.monotonic() + timeout
+        for thread in set(threading.enumerate()) - before:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return [thread for thread in set(threading.enumerate()) - before if thread.is_alive()]
+    return leftover
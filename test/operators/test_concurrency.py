@@ -6,8 +6,11 @@ import threading
 
 from hashlib import md5
 
-from pipex.operators.funcs import map
-from pipex.operators.concurrency import parallel, threaded
+import itertools
+
+from pipex.operators.funcs import map, filter, take
+from pipex.operators.concurrency import parallel, threaded, staged
+from pipex.pbase import Sink
 
 def test_threaded():
     arr = []
@@ -80,3 +83,294 @@ def test_md5_pool():
     arr = [str(i) for i in range(10000)]
     pool = Pool()
     results = list(pool.map(p, arr))
+
+
+def slow_on_multiples_of_7(x):
+    if x % 7 == 0:
+        time.sleep(0.05)
+    return -x
+
+
+def test_preserve_order():
+    values = list(range(100))
+    negated = [-x for x in values]
+    cases = [
+        (threaded(map(slow_on_multiples_of_7), num_workers=4, preserve_order=True), negated),
+        (parallel(map(slow_on_multiples_of_7), num_workers=4, chunk_size=3, preserve_order=True), negated),
+        (
+            threaded(filter(lambda x: x % 2 == 0) | map(slow_on_multiples_of_7),
+                     num_workers=4, chunk_size=4, queue_size=2, preserve_order=True),
+            [x for x in negated if x % 2 == 0],
+        ),
+    ]
+    for fork_join, expected in cases:
+        arr = []
+        (values >> fork_join >> arr).do()
+        assert [precord.value for precord in arr] == expected
+
+
+def add_one(x):
+    return x + 1
+
+
+def test_parallel_shared_memory():
+    import numpy as np
+
+    frames = [np.full((64, 64, 3), i, dtype=np.uint8) for i in range(30)]
+    small = [np.full(4, i, dtype=np.uint8) for i in range(30)]
+    arr = []
+    pipe = frames + small >> parallel(
+        map(add_one), num_workers=2, preserve_order=True,
+        shared_memory=True, shm_num_slots=4, shm_min_bytes=1024,
+    ) >> arr
+    pipe.do()
+    # slots run out with arrays kept downstream, the rest are pickled
+    assert len(arr) == 60
+    for precord, frame in zip(arr, frames + small):
+        assert np.array_equal(precord.value, frame + 1)
+
+
+def first_row(x):
+    return x[:1]
+
+
+def test_parallel_shared_memory_sliced_downstream():
+    import numpy as np
+
+    frames = [np.full((64, 64, 3), i, dtype=np.uint8) for i in range(40)]
+    arr = []
+    pipe = frames >> parallel(
+        map(add_one), num_workers=2, preserve_order=True,
+        shared_memory=True, shm_num_slots=4, shm_min_bytes=1024,
+    ) >> map(first_row) >> arr
+    pipe.do()
+    # Slices keep their slots from being reused
+    assert len(arr) == 40
+    for precord, frame in zip(arr, frames):
+        assert np.array_equal(precord.value, frame[:1] + 1)
+
+
+def test_early_termination(leftover_threads):
+    proc = get_context("spawn").Process(target=print)
+    proc.start()
+    proc.join()
+    num_before = num_child_processes()
+
+    for fork_join in [
+        threaded(map(negate), num_workers=4),
+        threaded(map(negate), num_workers=4, preserve_order=True),
+        parallel(map(negate), num_workers=2, queue_size=2),
+    ]:
+        arr = []
+        # Workers are cancelled rather than left to notice it within poll_interval
+        (itertools.count() >> fork_join >> take(10) >> arr).do()
+        assert len(arr) == 10
+    assert leftover_threads() == []
+    time.sleep(0.1)
+    assert num_child_processes() == num_before
+
+
+def test_threaded_teardown_is_instant():
+    begin = time.perf_counter()
+    for _ in range(10):
+        (itertools.count() >> threaded(map(negate), num_workers=4) >> take(10) >> []).do()
+    assert time.perf_counter() - begin < 1.0
+
+
+def test_adaptive_chunk_size():
+    from pipex.pbase import We
+
+    for fork_join in [
+        threaded(map(negate), num_workers=2, chunk_size='auto', max_chunk_size=64),
+        parallel(map(negate), num_workers=2, chunk_size='auto', max_chunk_size=64, preserve_order=True),
+    ]:
+        arr = []
+        our = (list(range(3000)) >> fork_join >> arr).do(We.instrumented(auto_report=False))
+        assert sorted(precord.value for precord in arr) == sorted(-x for x in range(3000))
+        stats, = our.instrumentation.chunks.values()
+        assert stats.records == 3000
+        # cheap work grows chunks up to the bound
+        assert stats.min_size == 1 and stats.max_size == 64
+
+    arr = []
+    our = (list(range(20)) >> threaded(
+        map(slow_on_multiples_of_7), num_workers=2, chunk_size='auto', target_chunk_latency=0.01,
+    ) >> arr).do(We.instrumented(auto_report=False))
+    stats, = our.instrumentation.chunks.values()
+    assert stats.max_size < 20
+
+
+class CountingSink(Sink):
+    def __init__(self):
+        self.runs = 0
+        self.saved = []
+
+    def process(self, our, tr_source):
+        self.runs += 1
+        for precord in tr_source.execute(our):
+            self.saved.append(precord.value)
+            yield precord
+
+
+def test_adaptive_chunk_size_runs_sinks_once():
+    from pipex.pbase import We
+
+    sink = CountingSink()
+    arr = []
+    our = (list(range(3000)) >> threaded(
+        map(negate) >> sink, num_workers=2, chunk_size='auto', max_chunk_size=64,
+    ) >> arr).do(We.instrumented(auto_report=False))
+    # Once per worker, not once per chunk
+    assert sink.runs == 2
+    assert sorted(sink.saved) == sorted(precord.value for precord in arr) == sorted(-x for x in range(3000))
+    stats, = our.instrumentation.chunks.values()
+    assert stats.max_size > 1
+
+
+def test_adaptive_chunk_size_runs_stateful_targets_once():
+    from pipex.operators.funcs import batch
+
+    arr = []
+    (list(range(3000)) >> threaded(
+        map(negate) | batch(10), num_workers=2, chunk_size='auto', max_chunk_size=64,
+    ) >> arr).do()
+    sizes = [len(precord.value) for precord in arr]
+    # At most one short batch per worker
+    assert sum(size < 10 for size in sizes) <= 2
+    assert sorted(x.value for precord in arr for x in precord.value) == sorted(-x for x in range(3000))
+
+    arr = []
+    (list(range(3000)) >> threaded(take(5), num_workers=2, chunk_size='auto') >> arr).do()
+    assert len(arr) <= 10
+
+
+def test_preserve_order_rejects_sinks():
+    with pytest.raises(ValueError):
+        threaded(CountingSink(), preserve_order=True)
+    with pytest.raises(ValueError):
+        staged(threaded(map(negate)), threaded(CountingSink()), preserve_order=True)
+
+    with pytest.raises(ValueError):
+        threaded(map(negate), chunk_size='fast')
+
+
+def test_preserve_order_rejects_stateful_targets():
+    from pipex.operators.funcs import batch, map_batch
+    for target_chain in [take(3), map(negate) | batch(2), map_batch(lambda x: x, 4), threaded(take(3))]:
+        with pytest.raises(ValueError):
+            threaded(target_chain, preserve_order=True)
+    with pytest.raises(ValueError):
+        staged(threaded(map(negate)), threaded(batch(2)), preserve_order=True)
+
+    arr = []
+    ([1, 2, 3] >> threaded(map(negate) | filter(bool), preserve_order=True) >> arr).do()
+    assert [precord.value for precord in arr] == [-1, -2, -3]
+
+
+def test_workers_spawn_on_first_record(leftover_threads):
+    for fork_join in [threaded(map(negate), num_workers=4), staged(threaded(map(negate)), threaded(map(negate)))]:
+        it = iter(range(10) >> fork_join)
+        assert leftover_threads() == []
+        assert next(it).value == 0
+        it.close()
+    assert leftover_threads() == []
+
+
+def test_poll_interval_is_deprecated():
+    with pytest.deprecated_call():
+        stage = threaded(map(negate), poll_interval=1.0)
+    arr = []
+    ([1, 2, 3] >> stage >> arr).do()
+    assert sorted(precord.value for precord in arr) == [-3, -2, -1]
+
+
+def slow_after_20(x):
+    if x >= 20:
+        time.sleep(0.05)
+    return -x
+
+
+def test_take_cancels_upstream():
+    state = {'read': 0, 'closed': False}
+    def source():
+        try:
+            for i in itertools.count():
+                state['read'] += 1
+                yield i
+        finally:
+            state['closed'] = True
+
+    it = iter(source() >> threaded(map(negate), num_workers=2, queue_size=2) >> take(10))
+    assert len([next(it) for _ in range(10)]) == 10
+    with pytest.raises(StopIteration):
+        next(it)
+    assert state['closed']
+    assert state['read'] < 50
+
+    # A worker gives up the chunk at hand rather than finishing it.
+    begin = time.perf_counter()
+    (list(range(40)) >> threaded(map(slow_after_20), num_workers=2, chunk_size=20) >> take(3) >> []).do()
+    assert time.perf_counter() - begin < 0.5
+
+
+def with_pid(x):
+    import os
+    return (x, os.getpid())
+
+
+def test_staged(leftover_threads):
+    import os
+
+    arr = []
+    pipe = list(range(300)) >> staged(
+        threaded(map(negate), num_workers=3),
+        parallel(map(with_pid), num_workers=2, chunk_size=4),
+        threaded(filter(lambda value: value[0] % 2 == 0), num_workers=2),
+        preserve_order=True,
+    ) >> arr
+    pipe.do()
+    assert [precord.value[0] for precord in arr] == [-x for x in range(300) if x % 2 == 0]
+    assert os.getpid() not in set(precord.value[1] for precord in arr)
+
+    arr = []
+    (itertools.count() >> staged(parallel(map(negate), num_workers=2), threaded(map(negate))) >> take(5) >> arr).do()
+    assert len(arr) == 5
+
+    with pytest.raises(ZeroDivisionError):
+        ([1, 2, 0, 4] * 10 >> staged(threaded(map(negate)), parallel(map(div), num_workers=2)) >> []).do()
+    assert leftover_threads() == []
+
+
+def test_autoscale():
+    names = set()
+    def slow(x):
+        names.add(threading.current_thread().name)
+        time.sleep(0.01)
+        return -x
+
+    arr = []
+    (list(range(300)) >> threaded(
+        map(slow), num_workers='auto', max_workers=4, scale_interval=0.05, queue_size=4,
+    ) >> arr).do()
+    assert sorted(precord.value for precord in arr) == sorted(-x for x in range(300))
+    # started with a single worker, added more as in_q stayed full
+    assert 1 < len(names) <= 4
+
+    arr = []
+    (list(range(100)) >> parallel(map(negate), num_workers='auto', max_workers=2, scale_interval=0.05) >> arr).do()
+    assert len(arr) == 100
+
+    with pytest.raises(ValueError):
+        threaded(map(negate), num_workers='auto', min_workers=4, max_workers=2)
+
+
+def test_parallel_out_of_band():
+    import numpy as np
+
+    frames = [np.full((128, 128, 3), i, dtype=np.uint8) for i in range(20)]
+    for out_of_band in [True, False]:
+        arr = []
+        (frames >> parallel(map(add_one), num_workers=2, preserve_order=True, out_of_band=out_of_band) >> arr).do()
+        assert len(arr) == 20
+        for precord, frame in zip(arr, frames):
+            assert np.array_equal(precord.value, frame + 1)
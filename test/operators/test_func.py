@@ -69,3 +69,103 @@ def test_select_channels():
     precord = list(arr >> select_channels("a", "c"))[0]
     assert set(precord.channels) == set(["a", "c"])
 
+
+
+def test_map_batch():
+    from pipex.operators import map_batch
+    calls = []
+    def normalize(arr):
+        calls.append(arr.shape)
+        return arr / arr.max(axis=1, keepdims=True)
+
+    arrays = [np.array([i, 2 * i], dtype=np.float64) for i in range(1, 6)]
+    results = list((arrays >> map_batch(normalize, 2)).values())
+    assert calls == [(2, 2), (2, 2), (1, 2)]
+    for result in results:
+        assert np.allclose(result, [0.5, 1.0])
+    assert results[0].base is results[1].base
+
+
+def test_map_batch_channels():
+    from pipex.operators import map_batch
+    arr = [PRecord.from_object(i).merge(a=np.full(3, i), b=np.ones(3)) for i in range(4)]
+
+    precords = list(arr >> map_batch(lambda d: {'c': d['a'] + d['b']}, 3, channels=('a', 'b')))
+    assert [precord.value for precord in precords] == [0, 1, 2, 3]
+    assert [precord['c'].tolist() for precord in precords] == [[i + 1] * 3 for i in range(4)]
+
+    precords = list(arr >> map_batch(lambda a, k: a * k, 4, 10, channels='a'))
+    assert [precord['a'].tolist() for precord in precords] == [[i * 10] * 3 for i in range(4)]
+
+
+def test_map_batch_chain_hash():
+    from pipex.operators import map_batch
+
+    def normalize(arr):
+        return arr / arr.max()
+
+    assert map_batch(normalize, 2).chain_hash() == map_batch(normalize, 2).chain_hash()
+    assert map_batch(normalize, 2).chain_hash() != map_batch(normalize, 3).chain_hash()
+
+
+def test_batch_stages_are_chained():
+    from pipex.operators import map_batch
+    from pipex.pbase import BatchedTransformer
+
+    chain = map_batch(lambda x: x + 1, 2) | map_batch(lambda x: x * 2, 2) | map(lambda x: x.tolist())
+    assert isinstance(chain.stages[0], BatchedTransformer)
+    arrays = [np.array([i]) for i in range(3)]
+    assert list((arrays >> chain).values()) == [[2], [4], [6]]
+
+    # Each stage runs at its own batch size
+    sizes = []
+    def record_size(size):
+        def fn(x):
+            sizes.append((size, len(x)))
+            return x
+        return fn
+    chain = map_batch(record_size(2), 2) | map_batch(record_size(3), 3) | map_batch(record_size(3), 3)
+    assert [type(stage) for stage in chain.stages] == [type(chain.stages[0]), BatchedTransformer]
+    arrays = [np.array([i]) for i in range(6)]
+    assert len(list((arrays >> chain).values())) == 6
+    assert sorted(sizes) == [(2, 2)] * 3 + [(3, 3)] * 4
+
+
+def test_map_workers(leftover_threads):
+    import time
+    from pipex.operators import channel_map
+
+    def slow_double(x):
+        time.sleep(0.05)
+        return 2 * x
+
+    begin = time.perf_counter()
+    assert list((range(40) >> map(slow_double, workers=8)).values()) == [2 * x for x in range(40)]
+    assert time.perf_counter() - begin < 1.0
+
+    values = list((range(40) >> filter(lambda x: x % 3 == 0, workers=4, ordered=False)).values())
+    assert sorted(values) == list(range(0, 40, 3))
+
+    precords = list(range(5) >> channel_map('double', slow_double, workers=2))
+    assert [(precord.value, precord['double']) for precord in precords] == [(x, 2 * x) for x in range(5)]
+
+    # Not fused with its neighbours
+    chain = map(lambda x: x + 1) | map(slow_double, workers=2) | map(lambda x: x - 1)
+    assert len(chain.stages) == 3
+    assert list((range(3) >> chain).values()) == [1, 3, 5]
+
+    # Taken records are the only ones run past the in-flight window
+    calls = []
+    def record(x):
+        calls.append(x)
+        return x
+    assert list((range(1000) >> map(record, workers=2, in_flight=4) >> take(3)).values()) == [0, 1, 2]
+    assert len(calls) <= 7
+
+    # Unordered results change what downstream sees
+    assert map(record, workers=2).chain_hash() == map(record).chain_hash()
+    assert map(record, workers=2, ordered=False).chain_hash() != map(record, workers=2).chain_hash()
+
+    with pytest.raises(ZeroDivisionError):
+        list((range(10) >> map(lambda x: 1 // (x - 5), workers=3)).values())
+    assert leftover_threads() == []
@@ -0,0 +1,114 @@
+import os
+import time
+import pytest
+
+from pipex.operators.funcs import map
+from pipex.operators.concurrency import parallel, threaded
+from pipex.operators.pool import WorkerPool, get_worker_state
+
+
+def load_model(offset):
+    state = get_worker_state()
+    state['offset'] = offset
+    state['loads'] = state.get('loads', 0) + 1
+
+
+def apply_model(x):
+    state = get_worker_state()
+    return (x + state['offset'], os.getpid(), state['loads'])
+
+
+def div(x):
+    return 10 // x
+
+
+def test_pool_reuses_processes():
+    with WorkerPool(num_workers=2, initializer=load_model, initargs=(100,)) as pool:
+        pids = set()
+        for _ in range(3):
+            arr = []
+            (list(range(20)) >> parallel(map(apply_model), pool=pool, preserve_order=True) >> arr).do()
+            assert [precord.value[0] for precord in arr] == list(range(100, 120))
+            # The initializer ran only once per worker
+            assert all(precord.value[2] == 1 for precord in arr)
+            pids.update(precord.value[1] for precord in arr)
+        assert len(pids) <= 2
+        assert os.getpid() not in pids
+    assert not pool.processes[0].is_alive()
+
+
+def test_threaded_pool_recovers(leftover_threads):
+    pool = WorkerPool(num_workers=3, use_processes=False, initializer=load_model, initargs=(1,))
+    try:
+        with pytest.raises(ZeroDivisionError):
+            ([5, 2, 0, 1] * 10 >> threaded(map(div), pool=pool, chunk_size=1) >> []).do()
+
+        arr = []
+        (list(range(30)) >> threaded(map(apply_model), pool=pool) >> arr).do()
+        assert sorted(precord.value[0] for precord in arr) == list(range(1, 31))
+
+        # stopping early
+        arr = []
+        for precord in list(range(1000)) >> threaded(map(apply_model), pool=pool, chunk_size=1):
+            arr.append(precord)
+            if len(arr) == 5:
+                break
+        arr = []
+        (list(range(30)) >> threaded(map(apply_model), pool=pool) >> arr).do()
+        assert len(arr) == 30
+    finally:
+        pool.shutdown()
+    assert leftover_threads() == []
+
+
+def test_pool_rejects_shared_memory():
+    with pytest.raises(ValueError):
+        parallel(map(apply_model), pool=WorkerPool(num_workers=1), shared_memory=True)
+
+
+def test_pool_rejects_conflicting_arguments():
+    pool = WorkerPool(num_workers=2, use_processes=False, queue_size=4)
+    with pytest.raises(ValueError):
+        threaded(map(inc), pool=pool, num_workers=3)
+    with pytest.raises(ValueError):
+        threaded(map(inc), pool=pool, queue_size=8)
+    with pytest.raises(ValueError):
+        parallel(map(inc), pool=pool)
+    with pytest.raises(ValueError):
+        threaded(map(inc), pool=WorkerPool(num_workers=2))
+
+    stage = threaded(map(inc), pool=pool, num_workers=2, queue_size=4)
+    assert (stage.num_workers, stage.queue_size) == (2, 4)
+
+
+def test_pool_starts_on_first_record(leftover_threads):
+    pool = WorkerPool(num_workers=2, use_processes=False)
+    try:
+        it = iter(range(10) >> threaded(map(inc), pool=pool, preserve_order=True))
+        assert leftover_threads() == []
+        assert next(it).value == 1
+        it.close()
+    finally:
+        pool.shutdown()
+    assert leftover_threads() == []
+
+
+def inc(x):
+    return x + 1
+
+
+def dbl(x):
+    return x * 2
+
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_pool_rejects_two_stages_of_one_pipeline(use_processes):
+    fork_join = parallel if use_processes else threaded
+    with WorkerPool(num_workers=2, use_processes=use_processes) as pool:
+        with pytest.raises(RuntimeError):
+            (list(range(10)) >> fork_join(map(inc), pool=pool) >> fork_join(map(dbl), pool=pool) >> []).do()
+
+        # The pool is still usable afterwards
+        arr = []
+        (list(range(10)) >> fork_join(map(inc), pool=pool, preserve_order=True) >> arr).do()
+        assert [precord.value for precord in arr] == list(range(1, 11))
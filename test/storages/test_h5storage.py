@@ -1,3 +1,4 @@
+import h5py
 import pytest
 import numpy as np
 
@@ -57,3 +58,41 @@ def test_h5_for_specific_ids():
     (precords >> bucket).do()
     assert list((bucket.with_ids(["id_2", "id_3"]) >> map(lambda x: x + 1)).values()) == [3, 4]
     assert list(bucket.with_ids(["id_999"])) == []
+
+
+def test_h5bucket_lazy_loading(monkeypatch):
+    storage = H5Storage("/tmp")
+    bucket = storage['pipex_test/test_h5storage_lazy']
+    image = np.array([[0, 255], [255, 0]], dtype=np.uint8)
+
+    ([PRecord.from_object(1, 'default', 'id_1')] >> channel_map('image', lambda _: image) >> bucket).do()
+
+    precords = list(bucket.with_ids(['id_1']))
+    # loaded after the file is closed, read-only
+    assert not precords[0].get_atom('image').is_loaded
+    modes = []
+    h5py_file = h5py.File
+    monkeypatch.setattr(h5py, 'File', lambda path, mode, **kwargs: modes.append(mode) or h5py_file(path, mode, **kwargs))
+    assert np.all(precords[0]['image'] == image)
+    assert modes == ['r']
+    assert precords[0].value == 1
+
+
+def test_h5bucket_incremental(tmpdir):
+    storage = H5Storage(str(tmpdir))
+    bucket = storage.bucket('incremental', incremental=True)
+    computed = []
+
+    def negate(x):
+        computed.append(x)
+        return -x
+
+    def run(values):
+        precords = [PRecord.from_object(value, 'default', id) for id, value in values.items()]
+        (iter(precords) >> map(negate) >> bucket).do()
+        return {precord.id: precord.value for precord in bucket}
+
+    assert run({"a": 1, "b": 2}) == {"a": -1, "b": -2}
+    computed.clear()
+    assert run({"a": 1, "c": 3}) == {"a": -1, "c": -3}
+    assert computed == [3]
@@ -1,7 +1,8 @@
+import os
 import pytest
 import numpy as np
 
-from pipex import PStorage, channel_map, map, source, PRecord
+from pipex import PStorage, channel_map, map, source, PRecord, parallel, done
 
 def test_pstorage():
     storage = PStorage("/tmp")
@@ -57,3 +58,360 @@ def test_p_for_specific_ids():
     (precords >> bucket).do()
     assert list((bucket.with_ids(["id_2", "id_3"]) >> map(lambda x: x + 1)).values()) == [3, 4]
     assert list(bucket.with_ids(["id_999"])) == []
+
+
+def test_pbucket_lazy_loading():
+    storage = PStorage("/tmp")
+    bucket = storage['pipex_test/test_pstorage_lazy']
+    image = np.array([[0, 255], [255, 0]], dtype=np.uint8)
+
+    ([PRecord.from_object(1, 'default', 'id_1')] >> channel_map('image', lambda _: image) >> bucket).do()
+
+    precord = next(iter(bucket.with_ids(['id_1'])))
+    assert precord.value == 1
+    assert precord.get_atom('default').is_loaded
+    assert not precord.get_atom('image').is_loaded
+    assert np.all(precord['image'] == image)
+    assert precord.get_atom('image').is_loaded
+
+
+def test_pbucket_projection_pushdown(mocker):
+    from pipex import select_channels, channel
+    storage = PStorage("/tmp")
+    bucket = storage['pipex_test/test_pstorage_projection']
+    image = np.zeros((2, 2), dtype=np.uint8)
+    precords = [PRecord.from_object(i, 'default', 'id_{}'.format(i)).merge(label=i) for i in range(3)]
+    (precords >> channel_map('image', lambda _: image) >> bucket).do()
+
+    spy = mocker.spy(bucket, 'load_precord')
+    restored = list(bucket >> select_channels('label') | channel('label'))
+    assert sorted(precord['label'] for precord in restored) == [0, 1, 2]
+    assert all(set(precord.channels) == {'label'} for precord in restored)
+    assert all(call.args[2] == {'label'} for call in spy.call_args_list)
+    assert len(spy.call_args_list) == 3
+
+    restored = list(bucket.with_ids(['id_1']) >> select_channels('image', 'label'))
+    assert set(restored[0].channels) == {'image', 'label'}
+    assert spy.call_args_list[-1].args[2] == {'image', 'label'}
+
+
+def test_pbucket_trace(tmpdir):
+    from pipex.pbase import We
+
+    storage = PStorage(str(tmpdir))
+    bucket = storage['test_pbucket_trace']
+    our = We.instrumented(auto_report=False, trace_path=str(tmpdir.join("trace.json")))
+    ([1, 2, 3] >> map(lambda x: x + 1) >> bucket).do(our)
+    names = [event["name"] for event in our.instrumentation.tracer.events]
+    assert names.count("PBucket save_precord") == 3
+
+    num_loads = names.count("PBucket load_precord")
+    list(bucket.with_ids(['1']).execute(our))
+    names = [event["name"] for event in our.instrumentation.tracer.events]
+    assert names.count("PBucket load_precord") == num_loads + 1
+
+
+def test_pbucket_incremental(tmpdir):
+    storage = PStorage(str(tmpdir))
+    bucket = storage.bucket('incremental', incremental=True)
+    computed = []
+
+    def square(x):
+        computed.append(x)
+        return x * x
+
+    def run(values):
+        precords = [PRecord.from_object(value, 'default', id) for id, value in values.items()]
+        # an iterator has no data version, so the bucket always checks it record by record
+        (iter(precords) >> map(square) >> bucket).do()
+        return {precord.id: precord.value for precord in bucket}
+
+    assert run({"a": 1, "b": 2, "c": 3}) == {"a": 1, "b": 4, "c": 9}
+    assert sorted(computed) == [1, 2, 3]
+
+    computed.clear()
+    # b changed, c deleted, d appended
+    assert run({"a": 1, "b": 5, "d": 4}) == {"a": 1, "b": 25, "d": 16}
+    assert sorted(computed) == [4, 5]
+
+    computed.clear()
+    assert run({"a": 1, "b": 5, "d": 4}) == {"a": 1, "b": 25, "d": 16}
+    assert computed == []
+
+
+def test_pbucket_incremental_provenance_index(tmpdir, mocker):
+    from pipex.storages.pstorage import PBucket
+    from pipex.storages.pstorage.id_manifest import IdManifest
+
+    storage = PStorage(str(tmpdir))
+    bucket = storage.bucket('incremental_index', incremental=True)
+    precords = [PRecord.from_object(value, 'default', id) for id, value in {"a": 1, "b": 2, "c": 3}.items()]
+    (iter(precords) >> map(lambda x: x * x) >> bucket).do()
+
+    # Kept in ids.log rather than read from each record
+    provenances = IdManifest(bucket.directory_name, bucket._scan_ids).provenances()
+    assert sorted(provenances) == ["a", "b", "c"]
+    assert all(provenance is not None for provenance in provenances.values())
+
+    load_provenance = mocker.spy(PBucket, 'load_provenance')
+    (iter(precords) >> map(lambda x: x * x) >> bucket).do()
+    assert load_provenance.call_count == 0
+    assert {precord.id: precord.value for precord in bucket} == {"a": 1, "b": 4, "c": 9}
+
+
+def test_pbucket_incremental_chain(tmpdir):
+    storage = PStorage(str(tmpdir))
+    first = storage.bucket('first', incremental=True)
+    second = storage.bucket('second', incremental=True)
+    squared, incremented = [], []
+
+    def square(x):
+        squared.append(x)
+        return x * x
+
+    def increment(x):
+        incremented.append(x)
+        return x + 1
+
+    def run(values):
+        precords = [PRecord.from_object(value, 'default', id) for id, value in values.items()]
+        (iter(precords) >> map(square) >> first >> map(increment) >> second).do()
+        return {precord.id: precord.value for precord in second}
+
+    assert run({"a": 1, "b": 2}) == {"a": 2, "b": 5}
+    # The upstream bucket is written too
+    assert {precord.id: precord.value for precord in first} == {"a": 1, "b": 4}
+    assert sorted(squared) == [1, 2] and sorted(incremented) == [1, 4]
+    # Fingerprints of upstream records come from the bucket, without hashing their values
+    precord = next(iter(first))
+    assert (iter([]) >> map(square) >> first).record_fingerprint(precord) == first.record_fingerprint(precord)
+
+    squared.clear()
+    incremented.clear()
+    assert run({"a": 1, "b": 3}) == {"a": 2, "b": 10}
+    assert squared == [3] and incremented == [9]
+
+    squared.clear()
+    incremented.clear()
+    assert run({"a": 1, "b": 3}) == {"a": 2, "b": 10}
+    assert squared == [] and incremented == []
+
+
+def test_segment_bucket(tmpdir):
+    from pipex.storages.pstorage import SegmentBucket
+    storage = PStorage(str(tmpdir), layout='segments', segment_size=4096)
+    bucket = storage['segments']
+    assert isinstance(bucket, SegmentBucket)
+    image = np.arange(64, dtype=np.uint8).reshape(8, 8)
+    precords = [PRecord.from_object(i, 'default', 'id_{}'.format(i)).merge(label=i) for i in range(50)]
+    (precords >> channel_map('image', lambda x: image + x) >> bucket).do()
+
+    assert len(bucket.log) == 50
+    assert len([name for name in os.listdir(bucket.data_directory_name) if name.endswith('.log')]) > 2
+    assert list((bucket.with_ids(['id_3', 'id_999']) >> map(lambda x: x + 1)).values()) == [4]
+    restored = {precord.id: precord for precord in bucket}
+    assert np.all(restored['id_7']['image'] == image + 7)
+    assert restored['id_7']['label'] == 7
+
+    # A files storage opens it in the layout it was written in
+    assert isinstance(PStorage(str(tmpdir))['segments'], SegmentBucket)
+
+
+def test_segment_log_recovery(tmpdir):
+    from pipex.storages.pstorage.segment_log import SegmentLog
+
+    directory = str(tmpdir.join("log"))
+    log = SegmentLog(directory, segment_size=256)
+    for i in range(40):
+        log.put(str(i), bytes([i]) * 50)
+    for i in range(0, 40, 2):
+        log.put(str(i), b"new")
+    for i in range(30):
+        log.delete(str(i))
+    log.sync()
+    log.compact()
+    assert sorted(int(id) for id in log.ids()) == list(range(30, 40))
+    assert log.get("30") == b"new" and log.get("31") == bytes([31]) * 50
+    assert log.get("1") is None
+    log.put("late", b"x")
+    log.close()
+
+    # Not synced to index.log, found by scanning past its tail
+    log = SegmentLog(directory, segment_size=256)
+    log.put("unsynced", b"y")
+    log._writer.flush()
+    reopened = SegmentLog(directory, segment_size=256)
+    assert reopened.get("unsynced") == b"y" and reopened.get("late") == b"x"
+
+    # Torn entry at the end, and no index at all
+    last = max(name for name in os.listdir(directory) if name.endswith('.log') and name != 'index.log')
+    with open(os.path.join(directory, last), "ab") as f:
+        f.write(b"\x00\x00\x05garbage")
+    os.remove(os.path.join(directory, "index.log"))
+    reopened = SegmentLog(directory, segment_size=256)
+    assert sorted(reopened.ids()) == sorted(log.ids())
+    reopened.put("after", b"z")
+    reopened.close()
+    assert SegmentLog(directory, segment_size=256).get("after") == b"z"
+
+
+def test_migrate_to_segments(tmpdir):
+    from pipex.storages.pstorage import SegmentBucket
+    storage = PStorage(str(tmpdir))
+    bucket = storage['migrated']
+    image = np.ones((4, 4), dtype=np.uint8)
+    (['a', 'b', 'c'] >> channel_map('image', lambda _: image) >> bucket).do()
+    metadata = bucket.load_metadata(None).to_json()
+
+    migrated = storage.migrate_to_segments('migrated', remove_old=True)
+    assert isinstance(storage['migrated'], SegmentBucket)
+    assert not os.path.isdir(os.path.join(str(tmpdir), 'migrated', 'pbkt_data'))
+    assert migrated.load_metadata(None).to_json() == metadata
+    restored = list(storage['migrated'])
+    assert sorted(precord.value for precord in restored) == ['a', 'b', 'c']
+    assert all(np.all(precord['image'] == image) for precord in restored)
+
+
+def test_pbucket_id_manifest(tmpdir, mocker):
+    from pipex.storages.pstorage.id_manifest import IdManifest
+    storage = PStorage(str(tmpdir))
+    bucket = storage['manifest']
+    precords = [PRecord.from_object(i, 'default', 'id_{}'.format(i)) for i in range(5)]
+    (precords >> bucket).do()
+    bucket.delete_precord(None, 'id_2')
+    bucket.flush_metadata(None, bucket.load_metadata(None))
+
+    listdir = mocker.spy(os, 'listdir')
+    assert len(bucket) == 4
+    assert sorted(bucket.load_ids(None)) == ['id_0', 'id_1', 'id_3', 'id_4']
+    assert listdir.call_count == 0
+
+    directory = bucket.directory_name
+    manifest = IdManifest(directory, bucket._scan_ids)
+    assert sorted(manifest.ids()) == ['id_0', 'id_1', 'id_3', 'id_4']
+    assert manifest.latest_timestamp == max(precord.timestamp for precord in precords)
+
+    # A writer that stopped before syncing leaves the manifest dirty
+    manifest.add('id_9', 0)
+    with open(os.path.join(bucket.data_directory_name, 'id_9.json'), 'w') as f:
+        f.write('{}')
+    assert sorted(IdManifest(directory, bucket._scan_ids).ids()) == ['id_0', 'id_1', 'id_3', 'id_4', 'id_9']
+    manifest.sync()
+    assert len(IdManifest(directory, bucket._scan_ids)) == 5
+
+    # Buckets written before the manifest are scanned once, even if only read
+    os.remove(os.path.join(directory, 'ids.json'))
+    os.remove(os.path.join(directory, 'ids.log'))
+    assert len(IdManifest(directory, bucket._scan_ids)) == 5
+    assert os.path.isfile(os.path.join(directory, 'ids.json'))
+    listdir.reset_mock()
+    assert len(IdManifest(directory, bucket._scan_ids)) == 5
+    assert listdir.call_count == 0
+
+
+def test_pbucket_parallel_writers(tmpdir):
+    from pipex.storages.pstorage.id_manifest import IdManifest
+    storage = PStorage(str(tmpdir))
+    (list(range(40)) >> parallel(storage['parallel'], num_workers=4) >> done).do()
+
+    bucket = storage['parallel']
+    assert len(bucket) == 40
+    assert len(IdManifest(bucket.directory_name, bucket._scan_ids)) == 40
+    assert sorted(precord.value for precord in bucket) == list(range(40))
+
+
+@pytest.mark.parametrize('layout', ['files', 'segments'])
+def test_pbucket_array_encodings(tmpdir, layout):
+    storage = PStorage(str(tmpdir), layout=layout)
+    bucket = storage.bucket('arrays', array_encodings={'features': 'npy'})
+    features = np.arange(1000, dtype=np.float32).reshape(10, 100)
+    small = np.array([[1, 2], [3, 4]], dtype=np.int64)
+    (['a', 'b'] >> channel_map('features', lambda _: features) >> channel_map('small', lambda _: small) >> bucket).do()
+
+    for precord in storage.bucket('arrays'):
+        assert np.array_equal(precord['small'], small)
+        assert np.array_equal(precord['features'], features)
+        assert isinstance(precord['features'], np.memmap)
+        assert not isinstance(precord['small'], np.memmap)
+        assert not precord['features'].flags.writeable
+
+    with pytest.raises(ValueError):
+        storage.bucket('arrays', array_encodings={'features': 'tiff'})
+
+
+def test_codecs():
+    from pipex.storages.pstorage.codecs import make_codec
+    image = np.random.RandomState(0).randint(0, 255, (16, 16, 3)).astype(np.uint8)
+    features = np.random.RandomState(0).rand(3, 4, 5).astype(np.float32)
+    for spec in ['png', {'name': 'png', 'compress_level': 1}, 'npz', 'npy', 'raw', {'name': 'zlib', 'level': 1}, {'name': 'lzma', 'preset': 0}]:
+        codec = make_codec(spec)
+        for value in ([image] if codec.name == 'png' else [image, features, features[:, ::2]]):
+            decoded = make_codec(codec.name).decode(codec.encode(value))
+            assert decoded.dtype == value.dtype and np.array_equal(decoded, value)
+    assert make_codec('text').decode(make_codec('text').encode("한글")) == "한글"
+    with pytest.raises(ValueError):
+        make_codec('jpeg2000')
+
+
+@pytest.mark.parametrize('layout', ['files', 'segments'])
+def test_pbucket_codecs(tmpdir, layout):
+    from pipex.storages.pstorage.codecs import RawCodec, register_codec
+
+    class HalfCodec(RawCodec):
+        name = 'half'
+        def encode(self, value):
+            return super().encode(value.astype(np.float16))
+
+    register_codec('half', HalfCodec)
+    storage = PStorage(str(tmpdir), layout=layout)
+    codecs = {'image': {'name': 'png', 'compress_level': 0}, 'depth': {'name': 'zlib', 'level': 1}, 'half': 'half'}
+    bucket = storage.bucket('codecs', codecs=codecs)
+    image = np.full((4, 4, 3), 7, dtype=np.uint8)
+    depth = np.arange(16, dtype=np.uint16).reshape(4, 4)
+    (
+        ['a'] >> channel_map('image', lambda _: image) >> channel_map('depth', lambda _: depth)
+        >> channel_map('half', lambda _: np.ones(3)) >> channel_map('other', lambda _: depth) >> bucket
+    ).do()
+
+    precord, = storage['codecs']
+    assert np.array_equal(precord['image'], image)
+    assert np.array_equal(precord['depth'], depth) and precord['depth'].dtype == np.uint16
+    assert precord['half'].dtype == np.float16
+    assert np.array_equal(precord['other'], depth)
+    if layout == 'files':
+        assert os.listdir(os.path.join(bucket.directory_name, 'pbkt_depth')) == [precord.id + '.zlib']
+        assert os.listdir(os.path.join(bucket.directory_name, 'pbkt_other')) == [precord.id + '.npz']
+
+
+def test_pbucket_write_behind(tmpdir, mocker, leftover_threads):
+    import time
+    import threading
+    from pipex.storages.pstorage import PBucket
+
+    storage = PStorage(str(tmpdir))
+    bucket = storage.bucket('write_behind', writers=4, use_batch=False)
+    save_precord = PBucket.save_precord
+    threads = set()
+    def slow_save_precord(self, our, precord, provenance=None):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        save_precord(self, our, precord, provenance)
+    mocker.patch.object(PBucket, 'save_precord', slow_save_precord)
+
+    begin = time.perf_counter()
+    (list(range(20)) >> map(lambda x: x * 2) >> bucket).do()
+    assert time.perf_counter() - begin < 0.6
+    assert all(name.startswith("PBucketWriter") for name in threads)
+    assert sorted(precord.value for precord in storage['write_behind']) == [x * 2 for x in range(20)]
+    assert storage['write_behind'].load_metadata(None).data_hash is not None
+
+    def failing_save_precord(self, our, precord, provenance=None):
+        if precord.value == 10:
+            raise IOError("disk full")
+        save_precord(self, our, precord, provenance)
+    mocker.patch.object(PBucket, 'save_precord', failing_save_precord)
+    bucket = storage.bucket('write_behind_error', writers=2)
+    with pytest.raises(IOError):
+        (list(range(20)) >> bucket).do()
+    assert storage['write_behind_error'].load_metadata(None).data_hash is None
+    assert leftover_threads() == []
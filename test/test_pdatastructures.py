@@ -41,3 +41,122 @@ def test_precord_from_object():
     precord_1 = PRecord.from_object(obj, 'file_name')
     assert precord_1.id == str(id(obj))
     assert precord_1.active_channel == 'file_name'
+
+def test_precord_batch():
+    from pipex.pdatastructures import PRecordBatch
+    precords = [
+        PRecord.from_object(np.full((2, 2), i, dtype=np.uint8), 'image', str(i)).merge(label=i, name='n' + str(i))
+        for i in range(3)
+    ]
+    precords[2] = precords[2].merge(extra=b'blob')
+
+    batch = PRecordBatch.from_precords(precords)
+    assert len(batch) == 3
+    assert batch.ids == ['0', '1', '2']
+    assert batch.active_channel == 'image'
+    assert batch.column('image').shape == (3, 2, 2)
+    assert batch.column('label').tolist() == [0, 1, 2]
+    assert batch.column('name') == ['n0', 'n1', 'n2']
+    assert np.array_equal(batch.stacked_value(), batch.stacked('image'))
+
+    batch = batch.with_value(batch.value * 2).with_column('score', batch.column('label') / 2)
+    restored = list(batch)
+    for i, precord in enumerate(restored):
+        assert precord.id == str(i)
+        assert precord.timestamp == precords[i].timestamp
+        assert precord.active_channel == 'image'
+        assert precord.value_format == 'image'
+        assert np.all(precord.value == 2 * i)
+        assert precord['label'] == i and isinstance(precord['label'], int)
+        assert precord['score'] == i / 2 and precord.get_atom('score').format == 'data'
+    assert 'extra' not in restored[0].channels
+    assert restored[2]['extra'] == b'blob'
+    assert restored[2].get_atom('extra').format == 'blob'
+
+
+def test_precord_batch_mixed_active_channels():
+    from pipex.pdatastructures import PRecordBatch
+    precords = [PRecord.from_object(1, 'a'), PRecord.from_object(2, 'b')]
+    batch = PRecordBatch.from_precords(precords)
+    with pytest.raises(ValueError):
+        batch.value
+    with pytest.raises(ValueError):
+        batch.stacked_value()
+    assert [precord.active_channel for precord in batch] == ['a', 'b']
+
+
+def test_channel_map_sharing():
+    from pipex.pdatastructures import ChannelMap
+    precord = PRecord.from_object(0).merge(**{'c{}'.format(i): i for i in range(20)})
+    base = precord.channel_atoms
+
+    derived = precord
+    for i in range(ChannelMap.MAX_UPDATES * 3):
+        derived = derived.with_value(i).merge(extra=i)
+        assert derived.value == i
+        assert derived['extra'] == i
+    assert precord.value == 0
+    assert 'extra' not in precord.channels
+    assert list(derived.channels) == ['default'] + ['c{}'.format(i) for i in range(20)] + ['extra']
+    assert len(derived.channel_atoms) == 22
+
+    new_precord = precord.with_value(100)
+    assert new_precord.channel_atoms._base is base._base
+    assert new_precord.get('c3') == 3
+    assert new_precord.get('nothing', 'x') == 'x'
+    with pytest.raises(KeyError):
+        new_precord['nothing']
+
+    selected = new_precord.select_channels({'c1', 'default'})
+    assert list(selected.channels) == ['default', 'c1']
+    assert selected.value == 100
+    assert dict(selected.channel_atoms.copy()) == {
+        'default': new_precord.get_atom('default'),
+        'c1': new_precord.get_atom('c1'),
+    }
+
+
+def test_lazy_atom():
+    import pickle
+    calls = []
+    def loader():
+        calls.append(1)
+        return np.arange(3)
+
+    atom = PAtom.lazy(loader, 'numpy.ndarray')
+    precord = PRecord(id='1', channel_atoms={'array': atom}).merge(label=1)
+    assert not atom.is_loaded
+    assert precord['label'] == 1
+    assert calls == []
+
+    assert precord.get('array').tolist() == [0, 1, 2]
+    assert precord['array'].tolist() == [0, 1, 2]
+    assert atom.is_loaded
+    assert calls == [1]
+
+    restored = pickle.loads(pickle.dumps(PAtom.lazy(lambda: 'value', 'data')))
+    assert restored.is_loaded and restored.value == 'value'
+
+
+def test_precord_pickle():
+    import pickle
+    from pipex.pqueue import dumps_out_of_band, loads_out_of_band
+
+    precord = PRecord.from_object(np.arange(1 << 16), id='1').merge(
+        raw=b'x' * (1 << 17), small=b'y', label=3,
+    )
+    for protocol in [2, 4, 5]:
+        restored = pickle.loads(pickle.dumps(precord, protocol=protocol))
+        assert restored.id == '1' and restored.timestamp == precord.timestamp
+        assert list(restored.channels) == list(precord.channels)
+        assert np.array_equal(restored.value, precord.value)
+        assert restored['raw'] == precord['raw'] and type(restored['raw']) is bytes
+        assert restored['small'] == b'y' and restored['label'] == 3
+
+    body, buffers = dumps_out_of_band([precord])
+    # the array and the large bytes travel apart from the pickle
+    assert sorted(buffer.nbytes for buffer in buffers) == sorted([precord.value.nbytes, 1 << 17])
+    assert len(body) < 1024
+    restored, = loads_out_of_band(body, [bytearray(buffer) for buffer in buffers])
+    assert np.array_equal(restored.value, precord.value)
+    assert restored['raw'] == precord['raw']
@@ -0,0 +1,72 @@
+import json
+import numpy as np
+
+from pipex.pbase import We
+from pipex.operators.funcs import map, filter
+from pipex.operators.concurrency import parallel, threaded
+
+
+def negate(x):
+    return -x
+
+
+def test_stage_stats():
+    arr = []
+    our = ([1, 2, 3, 4, 5, 6] >> map(lambda x: x * 2) | filter(lambda x: x > 4) >> arr).do(
+        We.instrumented(auto_report=False)
+    )
+    assert [precord.value for precord in arr] == [6, 8, 10, 12]
+
+    stages = list(our.instrumentation.stages.values())
+    assert [stats.records for stats in stages] == [6, 6, 4, 4]
+    assert stages[-1].name.endswith("(sink)")
+    for stats in stages:
+        assert stats.wall_time >= stats.upstream_wait >= 0
+    assert "records/s" in our.instrumentation.summary()
+
+
+def test_channel_bytes():
+    arr = []
+    our = ([np.zeros(10, dtype=np.uint8)] * 3 >> map(np.copy) >> arr).do(We.instrumented(track_bytes=True, auto_report=False))
+    stats = list(our.instrumentation.stages.values())[0]
+    assert stats.channel_bytes == {'default': 30}
+
+
+def test_fork_join_stats():
+    for fork_join in [threaded(map(negate)), parallel(map(negate))]:
+        arr = []
+        our = (list(range(100)) >> fork_join >> arr).do(We.instrumented(auto_report=False))
+        assert len(arr) == 100
+
+        instrumentation = our.instrumentation
+        worker_stages = [
+            stats for stats in instrumentation.stages.values()
+            if stats.name.startswith(repr(fork_join) + " / ")
+        ]
+        assert worker_stages
+        assert worker_stages[-1].records == 100
+
+        queues = {stats.name: stats for stats in instrumentation.queues.values()}
+        in_q = queues[repr(fork_join) + " / in_q"]
+        out_q = queues[repr(fork_join) + " / out_q"]
+        assert in_q.puts == out_q.puts == 100
+        assert in_q.gets >= 100 and out_q.gets >= 100
+
+
+def test_trace_events(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    arr = []
+    (list(range(20)) >> parallel(map(negate), num_workers=2) >> arr).do(
+        We.instrumented(auto_report=False, trace_path=path)
+    )
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+
+    spans = [event for event in events if event["ph"] == "X"]
+    names = set(event["name"] for event in spans)
+    assert {"Worker.run", "in_q.put", "pipex.map(negate)"} <= names
+    assert sum(1 for event in spans if event["name"] == "Worker.run") == 2
+    # events of the workers are shipped back from their processes
+    assert len(set(event["pid"] for event in spans)) == 3
+    for event in spans:
+        assert event["dur"] >= 0
@@ -75,3 +75,71 @@ def test_set_sink():
     s = set_sink(my_set)
     ([1] >> adder >> s).do()
     assert my_set == set([2])
+
+def test_fused_pipe_maps():
+    from pipex.pbase import FusedMapTransformer
+    from pipex.operators import map, filter, tap, channel
+
+    tapped = []
+    chain = (
+        adder() | select_even() | map(lambda x: x * 10) | tap(tapped.append) |
+        channel('default') | adder(3) | filter(lambda x: x > 50)
+    )
+    stages = chain.stages
+    assert len(stages) == 3
+    assert isinstance(stages[0], FusedMapTransformer)
+    assert len(stages[0].transformers) == 4
+    assert isinstance(stages[2], FusedMapTransformer)
+
+    assert list(([1, 2, 3, 4, 5] >> chain).values()) == [63]
+    assert tapped == [20, 40, 60]
+
+
+class with_table(pipe_map):
+    def __init__(self, table):
+        self.table = table
+
+    def map(self, value):
+        return self.table[value]
+
+
+def test_chain_hash_structural():
+    table = np.arange(10000)
+    changed = table.copy()
+    changed[5000] = -1
+    # str() of a large array elides the middle
+    assert str(table) == str(changed)
+    assert with_table(table).chain_hash() == with_table(table.copy()).chain_hash()
+    assert with_table(table).chain_hash() != with_table(changed).chain_hash()
+    assert with_table(table).chain_hash() != with_table(table.astype(np.int32)).chain_hash()
+    assert with_table(b"abc").chain_hash() != with_table(b"abd").chain_hash()
+    assert with_table({1, 2, 3}).chain_hash() == with_table({3, 2, 1}).chain_hash()
+
+
+def test_chain_hash_registry():
+    from pipex.pbase import register_hasher
+
+    class Model:
+        def __init__(self, version):
+            self.version = version
+
+    register_hasher(Model, lambda model: "Model-{}".format(model.version))
+    assert with_table(Model(1)).chain_hash() == with_table(Model(1)).chain_hash()
+    assert with_table(Model(1)).chain_hash() != with_table(Model(2)).chain_hash()
+
+
+def test_chain_hash_memoized():
+    from pipex.pbase import memoized_chain_hash
+
+    calls = []
+
+    class counted(with_table):
+        def chain_hash(self):
+            calls.append(self)
+            return super().chain_hash()
+
+    tr1, tr2 = counted(np.arange(10)), counted(np.arange(20))
+    first = memoized_chain_hash(tr1 | tr2)
+    assert len(calls) == 2
+    assert memoized_chain_hash(tr1 | tr2) == first
+    assert len(calls) == 2